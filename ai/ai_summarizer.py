@@ -1,15 +1,97 @@
 # /ai/ai_summarizer.py
 
 import os
-import streamlit as st
-from openai import OpenAI
+import sys
 from dotenv import load_dotenv
 # 引入剛剛寫好的模板服務
 from db.template_service import get_all_templates
+from data.lab_normalizer import ABNORMAL_FLAGS, FLAG_LABELS
+from ai.note_retriever import select_relevant_notes
+from db.single_flight import single_flight, make_key
+from ai.prompt_builder import (
+    DEFAULT_SYSTEM_PROMPT, build_system_prompt, build_prompt, describe_prompt, canonicalize_text, sort_focus_areas
+)
+from ai.phi_scrubber import scrub_text
+from ai.note_compressor import compress_nursing_notes, describe_compression
+from ai.llm_cassette import wrap_client
 
 load_dotenv()
 
-def generate_nursing_summary(patient_id, patient_data, template_name, custom_system_prompt=None, focus_areas=None):
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+GROQ_MODEL = "llama-3.3-70b-versatile"
+
+def get_groq_api_key():
+    """
+    讀取 Groq API Key：優先使用環境變數 GROQ_API_KEY (CLI / worker)，
+    在 Streamlit 中執行且未設定環境變數時，才退回 st.secrets。
+    這裡不主動 import streamlit，核心模組不依賴 UI 套件。
+    """
+    key = os.getenv("GROQ_API_KEY")
+    if key:
+        return key
+    st = sys.modules.get("streamlit")
+    if st:
+        try:
+            return st.secrets["groq"]["api_key"]
+        except Exception:
+            return None
+    return None
+
+def select_labs_for_prompt(labs_list, limit):
+    """
+    檢驗筆數超過上限時，優先保留已標記異常的項目，剩餘名額再給最新的正常值。
+    回傳結果維持原本的時間順序。
+    """
+    indexed = list(enumerate(labs_list))
+    abnormal = [pair for pair in indexed if pair[1].get('ABN_FLAG') in ABNORMAL_FLAGS][-limit:]
+    remaining = limit - len(abnormal)
+    chosen = {i for i, _ in abnormal}
+    if remaining > 0:
+        normal = [pair for pair in indexed if pair[0] not in chosen][-remaining:]
+        chosen.update(i for i, _ in normal)
+    return [item for i, item in indexed if i in chosen]
+
+def load_reports_for_prompt(patient_id, orders_list, limit, char_limit, report_loader=None):
+    """
+    從檢查醫囑表頭中挑出最新 limit 筆「有報告」的項目，才以單一批次查詢讀取報告全文。
+    沒有報告的醫囑不會觸發任何查詢。
+
+    Returns:
+        list of (表頭 dict, 報告文字)，依時間排序
+    """
+    headers = [o for o in orders_list if o.get('HAS_REPORT')][-limit:]
+    if not headers:
+        return []
+
+    if report_loader is None:
+        from db.patient_service import get_order_report_texts as report_loader
+    texts = report_loader([o['CHAD4GREQNO'] for o in headers], patient_id=patient_id)
+
+    reports = []
+    for header in headers:
+        candidates = texts.get(header['CHAD4GREQNO'], [])
+        # 同一申請號可能有多個檢查項目，以項目名稱與開立時間對應
+        match = next((c for c in candidates
+                      if c['CHAD4ORDNAME'] == header['CHAD4ORDNAME'] and c['CHAD4CDATE'] == header['CHAD4CDATE']), None)
+        if match:
+            text = " ".join(match['CHTEXT'].split())
+            reports.append((header, text[:char_limit] + ("…" if len(text) > char_limit else "")))
+    return reports
+
+def _summary_key(patient_id, patient_data, template_name, custom_system_prompt=None, focus_areas=None,
+                 report_loader=None):
+    # 病患資料本身的雜湊已涵蓋查詢的時間範圍；Prompt 與關注項目以組裝時相同的方式正規化
+    return (patient_id, template_name,
+            make_key(canonicalize_text(custom_system_prompt), sort_focus_areas(focus_areas)),
+            make_key(patient_data))
+
+def is_failed_summary(summary):
+    """generate_nursing_summary 失敗時回傳的是錯誤訊息字串，以開頭判斷。"""
+    return not summary or summary.startswith(("錯誤", "AI 生成失敗"))
+
+@single_flight(_summary_key, cache_if=lambda summary: not is_failed_summary(summary))
+def generate_nursing_summary(patient_id, patient_data, template_name, custom_system_prompt=None, focus_areas=None,
+                             report_loader=None):
     """
     接收病患結構化資料，發送給 AI 生成摘要。
     
@@ -19,6 +101,7 @@ def generate_nursing_summary(patient_id, patient_data, template_name, custom_sys
         template_name: 模板名稱 (對應資料庫中的 template_name)
         custom_system_prompt: (選用) 自定義 Prompt (優先權最高)
         focus_areas: list of str，使用者指定的重點關注項目
+        report_loader: (選用) 讀取檢查報告全文的函式，預設為 db.patient_service.get_order_report_texts
     """
     if not patient_data:
         return "錯誤：無資料可分析。"
@@ -29,7 +112,7 @@ def generate_nursing_summary(patient_id, patient_data, template_name, custom_sys
     
     # 確保有模板可用 (若資料庫連線失敗或無資料，使用備用預設值)
     if not db_templates:
-        base_system_prompt = "你是專業醫療人員，請撰寫病程摘要。"
+        base_system_prompt = DEFAULT_SYSTEM_PROMPT
         print("⚠️ 警告：無法從資料庫讀取模板，使用預設值。")
     else:
         # 嘗試根據名稱獲取內容，若找不到則預設用第一個抓到的
@@ -45,67 +128,160 @@ def generate_nursing_summary(patient_id, patient_data, template_name, custom_sys
     else:
         selected_system_prompt = base_system_prompt
 
-    # === 3. 加入關注項目 (Focus Areas) ===
-    if focus_areas and len(focus_areas) > 0:
-        focus_instruction = f"""
-        
-**【⚠️ 特別指令：重點關注項目】**
-使用者要求你特別詳細分析以下面向，請務必在摘要中包含相關細節，並將其優先呈現：
-- {", ".join(focus_areas)}
-        """
-        selected_system_prompt += focus_instruction
+    # === 3. 組出固定前綴 (模板 + 關注項目 + 資料格式說明) ===
+    # 病患資料全部放在 user 訊息，相同模板 / 關注項目的請求前綴逐字相同，可命中供應商的前綴快取
+    system_prompt = build_system_prompt(selected_system_prompt, focus_areas)
 
     # === 4. 資料截斷 (避免 Token 爆量) ===
     LIMIT_NURSING = 25
     LIMIT_LABS = 40
     LIMIT_VITALS = 25
+    NURSING_CHAR_BUDGET = 6000
+    LIMIT_REPORTS = 6
+    REPORT_CHAR_LIMIT = 500
+    LIMIT_PENDING_LABS = 10
 
     nursing_list = patient_data.get('nursing', [])
     labs_list = patient_data.get('labs', [])
     vitals_list = patient_data.get('vitals', [])
 
-    if len(nursing_list) > LIMIT_NURSING: nursing_list = nursing_list[-LIMIT_NURSING:]
-    if len(labs_list) > LIMIT_LABS: labs_list = labs_list[-LIMIT_LABS:]
+    # 護理紀錄依關注項目 / 模板挑選最相關的內容 (本機向量，不呼叫外部服務)
+    nursing_list = select_relevant_notes(
+        nursing_list, focus_areas, template_name,
+        limit=LIMIT_NURSING, char_budget=NURSING_CHAR_BUDGET
+    )
+    if len(labs_list) > LIMIT_LABS: labs_list = select_labs_for_prompt(labs_list, LIMIT_LABS)
     if len(vitals_list) > LIMIT_VITALS: vitals_list = vitals_list[-LIMIT_VITALS:]
 
     # === 5. 建構 User Prompt (資料內容) ===
-    data_text = f"=== 病患 ID: {patient_id} 急診病程資料 (部分摘錄) ===\n\n"
+    # 重複的主訴與制式語句只寫一次 (片語表見 ai/note_compressor.py)
+    nursing_lines, phrase_legend, compression = compress_nursing_notes(nursing_list)
+    data_sections = [
+        ("【常用語對照】", phrase_legend),
+        (f"【護理紀錄】(依關注項目挑選 {len(nursing_list)} 筆，依時間排序)", nursing_lines),
+        (f"【生理徵象】(最新 {len(vitals_list)} 筆)", [
+            f"- {item.get('PROCDTTM')} | T:{item.get('ETEMPUTER')} | P:{item.get('EPLUSE')} | R:{item.get('EBREATHE')} | BP:{item.get('EPRESSURE')}/{item.get('EDIASTOLIC')} | SpO2:{item.get('ESAO2')} | GCS:{item.get('GCS')}"
+            for item in vitals_list
+        ]),
+        (f"【檢驗報告】(最新 {len(labs_list)} 筆)", [
+            f"- {item.get('CHRCPDTM')} | {item.get('CHHEAD')} : {item.get('CHVAL')} {item.get('CHUNIT')} (Ref: {item.get('REF_RANGE')}){_flag_text(item)}"
+            for item in labs_list
+        ]),
+    ]
 
-    data_text += f"【護理紀錄】(最新 {len(nursing_list)} 筆)\n"
-    for item in nursing_list:
-        data_text += f"- {item.get('PROCDTTM', '')} | {item.get('SUBJECT', '')} | {item.get('DIAGNOSIS', '')}\n"
-    
-    data_text += f"\n【生理徵象】(最新 {len(vitals_list)} 筆)\n"
-    for item in vitals_list:
-        data_text += f"- {item.get('PROCDTTM')} | T:{item.get('ETEMPUTER')} | P:{item.get('EPLUSE')} | R:{item.get('EBREATHE')} | BP:{item.get('EPRESSURE')}/{item.get('EDIASTOLIC')} | SpO2:{item.get('ESAO2')} | GCS:{item.get('GCS')}\n"
+    # 影像 / 心電圖等檢查報告：只有真的要放進 Prompt 時才讀取全文
+    reports = load_reports_for_prompt(
+        patient_id, patient_data.get('orders', []), LIMIT_REPORTS, REPORT_CHAR_LIMIT, report_loader
+    )
+    data_sections.append((f"【檢查報告】(最新 {len(reports)} 份)", [
+        f"- {header.get('CHAD4CDATE')} | {header.get('CHAD4ORDNAME')} : {text}" for header, text in reports
+    ]))
+
+    # 已申請但尚未收件的檢驗，交班時需要追蹤
+    pending_labs = [o for o in patient_data.get('lab_orders', []) if not o.get('CHRCPDTM')][-LIMIT_PENDING_LABS:]
+    data_sections.append((f"【尚未收件的檢驗】({len(pending_labs)} 項)", [
+        f"- {item.get('CHAPPDTM')} | {item.get('CHORDNAM')} ({item.get('CHSPECI')})" for item in pending_labs
+    ]))
 
-    data_text += f"\n【檢驗報告】(最新 {len(labs_list)} 筆)\n"
-    for item in labs_list:
-        data_text += f"- {item.get('CHRCPDTM')} | {item.get('CHHEAD')} : {item.get('CHVAL')} {item.get('CHUNIT')} (Ref: {item.get('REF_RANGE')})\n"
+    prompt = build_prompt(system_prompt, data_sections, header=f"=== 病患 ID: {patient_id} 急診病程資料 (部分摘錄) ===")
 
     # === Debug 輸出 ===
     print("\n" + "="*50)
     print(f"🚀 [DEBUG] Template: {template_name} | Custom: {bool(custom_system_prompt)}")
+    print(f"   {describe_prompt(prompt)}")
+    print(f"   {describe_compression(compression)}")
     print("-" * 50)
     print(selected_system_prompt[-500:]) 
     print("="*50 + "\n")
 
     # === 6. 呼叫 AI API (Groq) ===
-    client = OpenAI(
-    api_key=st.secrets["groq"]["api_key"], 
-    base_url="https://api.groq.com/openai/v1"
-    )
-    
+    return _call_llm(prompt["system"], prompt["user"], patient_data=patient_data)
+
+
+def _flag_text(item):
+    flag = item.get('ABN_FLAG')
+    return f" [{FLAG_LABELS[flag]}]" if flag in ABNORMAL_FLAGS else ""
+
+
+def _make_client():
+    # openai 套件只在真的要生成時才載入，縮短 CLI / UI 的啟動時間
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_groq_api_key(), base_url=GROQ_BASE_URL)
+
+
+def _call_llm(system_prompt, user_prompt, patient_data=None):
+    """
+    呼叫 Groq (OpenAI 相容 API)；失敗時回傳以「AI 生成失敗」開頭的訊息。
+    送出前把病患資料中的姓名、病歷號等換成佔位符 (ai.phi_scrubber)，收到回覆後再換回原文。
+    """
+    # LLM_CASSETTE_MODE 啟用時改用錄製 / 重播的 client (見 ai/llm_cassette.py)
+    client = wrap_client(_make_client)
+
+    # system prompt 是固定前綴 (模板)，不含病患資料，不做替換以免影響前綴快取
+    user_prompt, phi_mapping = scrub_text(user_prompt, patient_data=patient_data)
+    if phi_mapping:
+        print(f"ℹ️ 去識別化：替換 {len(phi_mapping)} 種識別資訊")
+
     try:
         response = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
+            model=GROQ_MODEL,
             messages=[
-                {"role": "system", "content": selected_system_prompt},
-                {"role": "user", "content": data_text}
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
             ],
             temperature=0.3, 
         )
-        return response.choices[0].message.content
+        # 供應商有回報前綴快取命中量時印出，用來確認固定前綴是否生效
+        details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None)
+        if cached_tokens is not None:
+            print(f"ℹ️ Prompt 快取命中 {cached_tokens} / {response.usage.prompt_tokens} tokens")
+        return phi_mapping.restore(response.choices[0].message.content)
     except Exception as e:
         print(f"❌ API Error: {e}")
-        return f"AI 生成失敗: {e}"
\ No newline at end of file
+        return f"AI 生成失敗: {e}"
+
+
+def generate_incremental_update(patient_id, previous_summary, new_data, template_name, summary_time=None):
+    """
+    增量更新：把「先前的摘要 + 之後新增的紀錄」交給 AI 改寫，
+    不必重新送出整段病程，適合交班前預先產生的摘要。
+
+    Args:
+        previous_summary: 先前產生的摘要全文
+        new_data: get_patient_full_history(start_time=摘要涵蓋到的時間) 的結果
+        summary_time: (選用) 先前摘要涵蓋到的時間，顯示在 Prompt 中
+    """
+    if not new_data or not any(new_data.get(k) for k in ("nursing", "vitals", "labs")):
+        return previous_summary
+
+    db_templates = get_all_templates() or {}
+    template_prompt = db_templates.get(template_name, DEFAULT_SYSTEM_PROMPT)
+    system_prompt = build_system_prompt(template_prompt, extra_instructions="""
+**【增量更新指令】**
+使用者會提供一份先前完成的摘要，以及摘要完成後新增的紀錄。
+請輸出更新後的完整摘要：保留原本格式與仍然正確的內容，納入新增紀錄，
+並以「(更新)」標示有變動的段落；不要臆測新增紀錄中沒有的資訊。""", include_data_guide=False)
+
+    LIMIT_NEW_ITEMS = 40
+    new_items = [
+        f"- 護理 {item.get('PROCDTTM', '')} | {item.get('DIAGNOSIS', '')}"
+        for item in new_data.get('nursing', [])[-LIMIT_NEW_ITEMS:]
+    ]
+    new_items += [
+        f"- 生理 {item.get('PROCDTTM')} | T:{item.get('ETEMPUTER')} | P:{item.get('EPLUSE')} | R:{item.get('EBREATHE')} | BP:{item.get('EPRESSURE')}/{item.get('EDIASTOLIC')} | SpO2:{item.get('ESAO2')} | GCS:{item.get('GCS')}"
+        for item in new_data.get('vitals', [])[-LIMIT_NEW_ITEMS:]
+    ]
+    new_items += [
+        f"- 檢驗 {item.get('CHRCPDTM')} | {item.get('CHHEAD')} : {item.get('CHVAL')} {item.get('CHUNIT')}{_flag_text(item)}"
+        for item in select_labs_for_prompt(new_data.get('labs', []), LIMIT_NEW_ITEMS)
+    ]
+
+    prompt = build_prompt(system_prompt, [
+        (f"【先前摘要】(資料截至 {summary_time or '不詳'})", [previous_summary]),
+        ("【摘要完成後新增的紀錄】", new_items),
+    ], header=f"=== 病患 ID: {patient_id} ===")
+    print(f"[增量更新] {describe_prompt(prompt)}")
+
+    return _call_llm(prompt["system"], prompt["user"], patient_data=new_data)
@@ -0,0 +1,341 @@
+# /ai/extractive_summarizer.py
+
+# 規則式摘要 (不呼叫 AI)：直接從結構化病歷挑出關鍵資訊，毫秒內完成、結果固定。
+#   - 未設定 GROQ_API_KEY、供應商故障或被限流時作為備援
+#   - UI 在等待 AI 摘要時先顯示，當作預覽
+#
+# 擷取內容：主訴 (SUBJECT)、到院紀錄、生命徵象最低 / 最高 / 最新、異常檢驗、
+# 醫囑時間軸與尚未收件的檢驗；依模板格式 (SOAP / ISBAR / 時間軸 / 條列) 排版。
+
+from collections import Counter, OrderedDict
+
+from data.lab_normalizer import ABNORMAL_FLAGS, FLAG_LABELS
+from data.time_utils import parse_his_datetime, format_display_time
+
+FORMAT_SOAP = "soap"
+FORMAT_ISBAR = "isbar"
+FORMAT_TIMELINE = "timeline"
+FORMAT_LIST = "list"
+
+# 模板內容的關鍵字 -> 格式 (依序比對，第一個符合者為準)
+_FORMAT_KEYWORDS = [
+    (FORMAT_ISBAR, ("ISBAR",)),
+    (FORMAT_SOAP, ("SOAP",)),
+    (FORMAT_TIMELINE, ("時間軸", "時間先後", "TIMELINE")),
+]
+
+# 生命徵象：欄位 -> (顯示名稱, 單位, 偏低門檻, 偏高門檻)
+VITAL_SIGNS = OrderedDict([
+    ("ETEMPUTER", ("體溫", "°C", 36.0, 38.0)),
+    ("EPLUSE", ("脈搏", "次/分", 50, 100)),
+    ("EBREATHE", ("呼吸", "次/分", 12, 24)),
+    ("EPRESSURE", ("收縮壓", "mmHg", 90, 160)),
+    ("EDIASTOLIC", ("舒張壓", "mmHg", 50, 100)),
+    ("ESAO2", ("SpO2", "%", 94, None)),
+])
+
+# 到院紀錄通常包含這些字詞
+_ARRIVAL_KEYWORDS = ("主訴", "自訴", "GCS", "到院", "步入", "檢傷", "送入")
+
+LIMIT_ABNORMAL_LABS = 12
+LIMIT_TIMELINE = 15
+LIMIT_PENDING = 10
+LIMIT_NOTE_CHARS = 160
+
+DISCLAIMER = "> ⚙️ 本摘要由系統規則自動擷取 (非 AI 生成)，僅整理原始紀錄，請以原始資料為準。"
+
+
+# ==========================================
+# 1. 格式判斷
+# ==========================================
+
+def detect_format(template_text=None, template_name=None):
+    """依模板內容 / 名稱判斷輸出格式。"""
+    text = f"{template_name or ''}\n{template_text or ''}".upper()
+    for fmt, keywords in _FORMAT_KEYWORDS:
+        if any(k.upper() in text for k in keywords):
+            return fmt
+    if "交班" in text:
+        return FORMAT_ISBAR
+    return FORMAT_LIST
+
+
+# ==========================================
+# 2. 擷取重點
+# ==========================================
+
+def _to_float(value):
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _short(text, limit=LIMIT_NOTE_CHARS):
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _time(raw):
+    """顯示用時間 (MM-DD HH:MM)。"""
+    dt = parse_his_datetime(raw)
+    return dt.strftime("%m-%d %H:%M") if dt else str(raw or "")
+
+
+def _vital_stats(vitals_list):
+    stats = OrderedDict()
+    for column, (label, unit, low, high) in VITAL_SIGNS.items():
+        readings = [(item.get("PROCDTTM"), _to_float(item.get(column))) for item in vitals_list]
+        readings = [(t, v) for t, v in readings if v is not None and v > 0]
+        if not readings:
+            continue
+        values = [v for _, v in readings]
+        out_of_range = [v for v in values if (low is not None and v < low) or (high is not None and v > high)]
+        stats[column] = {
+            "label": label, "unit": unit,
+            "min": min(values), "max": max(values),
+            "last": readings[-1][1], "last_time": readings[-1][0],
+            "abnormal_count": len(out_of_range), "count": len(values),
+        }
+
+    gcs = [item.get("GCS") for item in vitals_list if item.get("GCS") and "None" not in item.get("GCS")]
+    return stats, (gcs[-1] if gcs else None)
+
+
+def _abnormal_labs(labs_list):
+    """每個檢驗項目只取最新一筆異常值，依嚴重度排序。"""
+    latest = OrderedDict()
+    for item in labs_list:
+        if item.get("ABN_FLAG") in ABNORMAL_FLAGS:
+            latest[item.get("CHHEAD")] = item
+    ranked = sorted(latest.values(), key=lambda i: (-(i.get("ABN_SEVERITY") or 0), str(i.get("CHRCPDTM"))))
+    return ranked[:LIMIT_ABNORMAL_LABS]
+
+
+def _order_timeline(orders, lab_orders):
+    """同一時間開立的醫囑合併為一行 (例如 CBC 的各項目)；回傳 [(datetime, 文字)]。"""
+    grouped = OrderedDict()
+    events = [(parse_his_datetime(o.get("CHAD4CDATE")), o.get("CHAD4ORDNAME")) for o in orders]
+    events += [(parse_his_datetime(o.get("CHAPPDTM")), o.get("CHORDNAM")) for o in lab_orders]
+    for when, name in sorted((e for e in events if e[0] and e[1]), key=lambda e: e[0]):
+        names = grouped.setdefault(when.replace(second=0), [])
+        if name not in names:
+            names.append(name)
+
+    timeline = [
+        (when, "、".join(names[:4]) + (f" 等 {len(names)} 項" if len(names) > 4 else ""))
+        for when, names in grouped.items()
+    ]
+    return timeline[-LIMIT_TIMELINE:]
+
+
+def extract_key_facts(patient_data):
+    """
+    從 get_patient_full_history 的結果擷取摘要需要的重點。
+
+    Returns:
+        dict: chief_complaint, arrival, latest_note, period, vitals, gcs, abnormal_labs,
+              reports, timeline, pending_labs
+    """
+    nursing = patient_data.get("nursing", [])
+    vitals = patient_data.get("vitals", [])
+    labs = patient_data.get("labs", [])
+    orders = patient_data.get("orders", [])
+    lab_orders = patient_data.get("lab_orders", [])
+
+    subjects = Counter(item.get("SUBJECT").strip() for item in nursing if (item.get("SUBJECT") or "").strip())
+    arrival = next((item for item in nursing if any(k in (item.get("DIAGNOSIS") or "") for k in _ARRIVAL_KEYWORDS)),
+                   nursing[0] if nursing else None)
+
+    times = [parse_his_datetime(item.get("PROCDTTM")) for item in nursing + vitals]
+    times = [t for t in times if t]
+    vital_stats, gcs = _vital_stats(vitals)
+
+    return {
+        "chief_complaint": subjects.most_common(1)[0][0] if subjects else None,
+        "arrival": arrival,
+        "latest_note": nursing[-1] if nursing else None,
+        "period": (min(times), max(times)) if times else None,
+        "vitals": vital_stats,
+        "gcs": gcs,
+        "abnormal_labs": _abnormal_labs(labs),
+        "reports": [o for o in orders if o.get("HAS_REPORT")],
+        "timeline": _order_timeline(orders, lab_orders),
+        "pending_labs": [o for o in lab_orders if not o.get("CHRCPDTM")][-LIMIT_PENDING:],
+    }
+
+
+# ==========================================
+# 3. 排版
+# ==========================================
+
+def _fmt_number(value):
+    return f"{value:g}"
+
+
+def _vital_lines(facts):
+    lines = []
+    for stat in facts["vitals"].values():
+        flag = f" ⚠️ {stat['abnormal_count']}/{stat['count']} 次超出範圍" if stat["abnormal_count"] else ""
+        lines.append(
+            f"- {stat['label']}：最新 {_fmt_number(stat['last'])} {stat['unit']} ({_time(stat['last_time'])})，"
+            f"範圍 {_fmt_number(stat['min'])}–{_fmt_number(stat['max'])}{flag}"
+        )
+    if facts["gcs"]:
+        lines.append(f"- GCS：{facts['gcs']}")
+    return lines or ["- 無生命徵象紀錄"]
+
+
+def _ref_text(ref_range):
+    """'低~高' 參考範圍；只有單邊時改寫為 ≥ / ≤。"""
+    low, _, high = str(ref_range or "").partition("~")
+    low = "" if low.strip() in ("", "None") else low.strip()
+    high = "" if high.strip() in ("", "None") else high.strip()
+    if low and high:
+        return f" (Ref: {low}~{high})"
+    if low or high:
+        return f" (Ref: {'≥' + low if low else '≤' + high})"
+    return ""
+
+
+def _lab_lines(facts):
+    lines = []
+    for item in facts["abnormal_labs"]:
+        ref_text = _ref_text(item.get("REF_RANGE"))
+        lines.append(
+            f"- {item.get('CHHEAD')}：{item.get('CHVAL')} {item.get('CHUNIT') or ''}".rstrip()
+            + f" [{FLAG_LABELS[item['ABN_FLAG']]}]{ref_text} ({_time(item.get('CHRCPDTM'))})"
+        )
+    return lines or ["- 無異常檢驗值"]
+
+
+def _timeline_lines(facts):
+    return [f"- [{_time(when)}] {text}" for when, text in facts["timeline"]] or ["- 無醫囑紀錄"]
+
+
+def _pending_lines(facts):
+    lines = [f"- 待收件：{o.get('CHORDNAM')} ({o.get('CHSPECI')})，申請於 {_time(o.get('CHAPPDTM'))}"
+             for o in facts["pending_labs"]]
+    if facts["reports"]:
+        names = "、".join(dict.fromkeys(o.get("CHAD4ORDNAME") for o in facts["reports"]))
+        lines.append(f"- 已有報告可查閱：{names}")
+    return lines or ["- 無待追蹤項目"]
+
+
+def _note_line(item):
+    if not item:
+        return "無護理紀錄"
+    return f"({_time(item.get('PROCDTTM'))}) {_short(item.get('DIAGNOSIS'))}"
+
+
+def _period_text(facts):
+    if not facts["period"]:
+        return "不詳"
+    start, end = facts["period"]
+    return f"{format_display_time(start)} ~ {format_display_time(end)}"
+
+
+def _render_soap(patient_id, facts):
+    return [
+        "### **S (Subjective)**",
+        f"- 主訴：{facts['chief_complaint'] or '未記錄'}",
+        f"- 到院紀錄：{_note_line(facts['arrival'])}",
+        "### **O (Objective)**",
+        *_vital_lines(facts),
+        "**異常檢驗**",
+        *_lab_lines(facts),
+        "### **A (Assessment)**",
+        "- (規則摘要不做臨床評估，請參考上述異常項目)",
+        "### **P (Plan)**",
+        *_timeline_lines(facts),
+        *_pending_lines(facts),
+    ]
+
+
+def _render_isbar(patient_id, facts):
+    return [
+        "### **I (Identity)**",
+        f"- 病歷號：{patient_id}，紀錄期間：{_period_text(facts)}",
+        "### **S (Situation)**",
+        f"- 主訴：{facts['chief_complaint'] or '未記錄'}",
+        f"- 最新紀錄：{_note_line(facts['latest_note'])}",
+        "### **B (Background)**",
+        f"- 到院紀錄：{_note_line(facts['arrival'])}",
+        *_timeline_lines(facts),
+        "### **A (Assessment)**",
+        *_vital_lines(facts),
+        *_lab_lines(facts),
+        "### **R (Recommendation)**",
+        *_pending_lines(facts),
+    ]
+
+
+def _render_timeline(patient_id, facts):
+    events = [(when, f"醫囑：{text}") for when, text in facts["timeline"]]
+    if facts["arrival"]:
+        events.append((parse_his_datetime(facts["arrival"].get("PROCDTTM")),
+                       f"到院：{_short(facts['arrival'].get('DIAGNOSIS'))}"))
+    for item in facts["abnormal_labs"]:
+        events.append((parse_his_datetime(item.get("CHRCPDTM")),
+                       f"檢驗異常：{item.get('CHHEAD')} {item.get('CHVAL')} [{FLAG_LABELS[item['ABN_FLAG']]}]"))
+
+    lines = [f"- 主訴：{facts['chief_complaint'] or '未記錄'}", "", "**時間軸**"]
+    lines += [f"- [{_time(when)}] {text}" for when, text in sorted((e for e in events if e[0]), key=lambda e: e[0])]
+    lines += ["", "**生命徵象**", *_vital_lines(facts), "**待追蹤**", *_pending_lines(facts)]
+    return lines
+
+
+def _render_list(patient_id, facts):
+    return [
+        "1. **【病況概述】**",
+        f"- 主訴：{facts['chief_complaint'] or '未記錄'}",
+        f"- 到院紀錄：{_note_line(facts['arrival'])}",
+        f"- 最新紀錄：{_note_line(facts['latest_note'])}",
+        "2. **【重要檢查發現】**",
+        *_vital_lines(facts),
+        *_lab_lines(facts),
+        "3. **【處置經過】**",
+        *_timeline_lines(facts),
+        "4. **【目前狀態 / 待追蹤】**",
+        *_pending_lines(facts),
+    ]
+
+
+_RENDERERS = {
+    FORMAT_SOAP: _render_soap,
+    FORMAT_ISBAR: _render_isbar,
+    FORMAT_TIMELINE: _render_timeline,
+    FORMAT_LIST: _render_list,
+}
+
+
+def generate_extractive_summary(patient_id, patient_data, template_name=None, template_text=None, output_format=None):
+    """
+    產生規則式摘要 (Markdown)。
+
+    Args:
+        patient_id: 病歷號
+        patient_data: get_patient_full_history 的結果
+        template_name / template_text: 用來判斷格式 (SOAP / ISBAR / 時間軸)
+        output_format: (選用) 直接指定格式，見 FORMAT_* 常數
+    """
+    if not patient_data or not any(patient_data.get(k) for k in ("nursing", "vitals", "labs")):
+        return "錯誤：無資料可分析。"
+
+    facts = extract_key_facts(patient_data)
+    fmt = output_format or detect_format(template_text, template_name)
+    lines = [DISCLAIMER, ""] + _RENDERERS[fmt](patient_id, facts)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from data.csv_index import get_patient_full_history
+
+    patient_id = sys.argv[1] if len(sys.argv) > 1 else "0002452972"
+    data = get_patient_full_history(patient_id)
+    for fmt in _RENDERERS:
+        started = time.perf_counter()
+        text = generate_extractive_summary(patient_id, data, output_format=fmt)
+        print(f"\n===== {fmt} ({(time.perf_counter() - started) * 1000:.1f} ms) =====\n{text}")
@@ -0,0 +1,236 @@
+# /ai/llm_cassette.py
+
+# LLM 錄製 / 重播 (cassette)：不需要網路與 API Key 也能完整執行摘要流程 (main.py、worker.py)。
+#
+#   LLM_CASSETTE_MODE=record   照常呼叫供應商，並把請求與回應寫入 LLM_CASSETTE_DIR
+#   LLM_CASSETTE_MODE=replay   只讀取錄製檔，不連線；找不到對應的錄製檔視為呼叫失敗
+#   LLM_CASSETTE_MODE=auto     有錄製檔就重播，沒有就呼叫並錄製
+#   LLM_CASSETTE_MODE=stub     不連線，回傳固定的測試內容 (壓力測試用，見 load_test.py)
+#   (未設定)                    直接呼叫供應商
+#
+#   - 錄製檔以請求內容 (model / messages / 參數) 的 SHA-256 命名，相同請求對應同一個檔案
+#   - 串流回應 (stream=True) 逐塊記錄內容與相對時間
+#   - LLM_CASSETTE_LATENCY：重播時的延遲，none (預設，立即回傳) / recorded (依錄製時間) / 倍率 (例如 0.5)
+#   - LLM_STUB_LATENCY_MS：stub 模式模擬的回應時間 (±50% 隨機)
+#   - 送出的內容已經過去識別化 (ai.phi_scrubber)，錄製檔中是佔位符而不是原始姓名 / 病歷號
+#
+# 用法：
+#   LLM_CASSETTE_MODE=record python main.py      # 有網路時錄一次
+#   LLM_CASSETTE_MODE=replay python main.py      # 之後離線重播
+
+import os
+import json
+import time
+import random
+import hashlib
+from types import SimpleNamespace
+
+CASSETTE_MODES = ("record", "replay", "auto", "stub")
+CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "").lower()
+CASSETTE_DIR = os.getenv(
+    "LLM_CASSETTE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cassettes")
+)
+CASSETTE_LATENCY = os.getenv("LLM_CASSETTE_LATENCY", "none").lower()
+STUB_LATENCY_MS = float(os.getenv("LLM_STUB_LATENCY_MS", "1500"))
+
+STUB_SUMMARY = "【測試用摘要】此內容由 LLM stub 產生，未實際呼叫 AI。"
+
+
+class CassetteMissError(RuntimeError):
+    """replay 模式下找不到對應請求的錄製檔。"""
+
+
+def cassette_enabled():
+    return CASSETTE_MODE in CASSETTE_MODES
+
+
+def is_offline_mode():
+    """replay / stub 模式不連線，也不需要 API Key。"""
+    return CASSETTE_MODE in ("replay", "stub")
+
+
+# ==========================================
+# 1. 錄製檔
+# ==========================================
+
+def request_key(request):
+    """請求內容的雜湊 (欄位順序不影響結果)。"""
+    canonical = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def cassette_path(key, cassette_dir=None):
+    return os.path.join(cassette_dir or CASSETTE_DIR, f"{key[:16]}.json")
+
+
+def _load(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _to_dict(obj):
+    """openai 回應物件 -> 可存成 JSON 的 dict。"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    if isinstance(obj, dict):
+        return obj
+    return json.loads(json.dumps(obj, default=lambda o: getattr(o, "__dict__", str(o))))
+
+
+def _to_namespace(value):
+    """dict -> 可用屬性存取的物件，讓呼叫端照常使用 response.choices[0].message.content。"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _to_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+def _latency_scale():
+    if CASSETTE_LATENCY in ("", "none", "0"):
+        return 0.0
+    if CASSETTE_LATENCY == "recorded":
+        return 1.0
+    try:
+        return max(0.0, float(CASSETTE_LATENCY))
+    except ValueError:
+        return 0.0
+
+
+# ==========================================
+# 2. 相容 OpenAI client 的包裝
+# ==========================================
+
+class _RecordingStream:
+    """包住供應商的串流回應：逐塊轉交給呼叫端，同時記錄內容與時間，結束時寫檔。"""
+
+    def __init__(self, stream, path, request, started):
+        self._stream = stream
+        self._path = path
+        self._request = request
+        self._started = started
+        self._chunks = []
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._chunks.append({"t": round(time.perf_counter() - self._started, 4), "chunk": _to_dict(chunk)})
+            yield chunk
+        _save(self._path, {
+            "request": self._request,
+            "stream": True,
+            "elapsed": round(time.perf_counter() - self._started, 4),
+            "chunks": self._chunks,
+            "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+
+def _replay_stream(record, scale):
+    started = time.perf_counter()
+    for item in record["chunks"]:
+        if scale:
+            delay = item["t"] * scale - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield _to_namespace(item["chunk"])
+
+
+def _stub_response(request):
+    time.sleep(STUB_LATENCY_MS / 1000 * random.uniform(0.5, 1.5))
+    prompt_tokens = sum(len(m.get("content") or "") for m in request.get("messages", []))
+    if request.get("stream"):
+        return iter([_to_namespace({"choices": [{"delta": {"content": STUB_SUMMARY}}]})])
+    return _to_namespace({
+        "choices": [{"message": {"role": "assistant", "content": STUB_SUMMARY}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(STUB_SUMMARY),
+                  "prompt_tokens_details": None},
+    })
+
+
+class _Completions:
+    def __init__(self, cassette):
+        self._cassette = cassette
+
+    def create(self, **kwargs):
+        return self._cassette.create(**kwargs)
+
+
+class CassetteClient:
+    """
+    取代 OpenAI client 的 chat.completions.create。
+
+    Args:
+        client_factory: 建立真正 client 的函式；只有需要實際呼叫時才執行 (replay 不會建立)
+        mode: record / replay / auto / stub，預設讀取 LLM_CASSETTE_MODE
+        cassette_dir: 錄製檔目錄，預設讀取 LLM_CASSETTE_DIR
+    """
+
+    def __init__(self, client_factory=None, mode=None, cassette_dir=None):
+        self.mode = mode or CASSETTE_MODE
+        self.cassette_dir = cassette_dir or CASSETTE_DIR
+        self._client_factory = client_factory
+        self._client = None
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def _real_client(self):
+        if self._client is None:
+            if self._client_factory is None:
+                raise RuntimeError("沒有可用的 LLM client")
+            self._client = self._client_factory()
+        return self._client
+
+    def create(self, **kwargs):
+        if self.mode == "stub":
+            return _stub_response(kwargs)
+
+        key = request_key(kwargs)
+        path = cassette_path(key, self.cassette_dir)
+
+        if self.mode in ("replay", "auto"):
+            record = _load(path)
+            if record is not None:
+                print(f"📼 重播 LLM 回應 {os.path.basename(path)}")
+                scale = _latency_scale()
+                if record.get("stream"):
+                    return _replay_stream(record, scale)
+                if scale:
+                    time.sleep(record.get("elapsed", 0) * scale)
+                return _to_namespace(record["response"])
+            if self.mode == "replay":
+                raise CassetteMissError(f"找不到錄製檔 {path} (請先以 LLM_CASSETTE_MODE=record 執行)")
+
+        started = time.perf_counter()
+        response = self._real_client().chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return iter(_RecordingStream(response, path, kwargs, started))
+
+        _save(path, {
+            "request": kwargs,
+            "stream": False,
+            "elapsed": round(time.perf_counter() - started, 4),
+            "response": _to_dict(response),
+            "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        print(f"📼 已錄製 LLM 回應 {os.path.basename(path)}")
+        return response
+
+
+def wrap_client(client_factory):
+    """
+    依 LLM_CASSETTE_MODE 回傳 client：未啟用時直接回傳 client_factory() 的結果，
+    啟用時回傳 CassetteClient (replay / stub 不會呼叫 client_factory，因此不需要 openai 套件與 API Key)。
+    """
+    if not cassette_enabled():
+        return client_factory()
+    return CassetteClient(client_factory)
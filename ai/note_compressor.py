@@ -0,0 +1,264 @@
+# /ai/note_compressor.py
+
+# 護理紀錄壓縮：同一份 Prompt 中重複出現的制式語句與主訴只寫一次。
+#
+#   1. 離線學習 (learn)：掃描全部 ENSDATA 紀錄，統計以標點切開的「子句序列」出現在多少筆紀錄中，
+#      常見的制式語句 (例如「經醫師診視後，依醫囑給予醫療處置，續觀察」) 存成片語表
+#      data/note_phrases.json
+#   2. 組 Prompt 時 (compress_nursing_notes)：
+#      - 主訴 (SUBJECT) 與上一筆相同時改寫為「同上」
+#      - 片語表中的語句在本次資料出現多次、且換成代碼後確實較省 token 時，
+#        內文改寫為 〈P1〉 等代碼，並在【常用語對照】區塊列出原文
+#      - 回傳壓縮前後的 token 估計值
+#
+# 用法：
+#   python -m ai.note_compressor learn              # 重建片語表 (HISTORY_SOURCE=csv 時讀 data/ 的 CSV)
+#   python -m ai.note_compressor show 0002452972    # 顯示某位病患的壓縮結果與節省量
+
+import os
+import re
+import json
+import threading
+from collections import Counter
+
+from ai.prompt_builder import count_tokens
+from ai.phi_scrubber import harvest_signatures
+
+NOTE_COMPRESSION_ENABLED = os.getenv("NOTE_COMPRESSION", "1").lower() in ("1", "true", "yes")
+PHRASE_TABLE_PATH = os.getenv(
+    "NOTE_PHRASE_TABLE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "note_phrases.json")
+)
+
+# 學習參數：至少出現在幾筆紀錄、最短字數、最多串接幾個子句、片語表上限
+MIN_PHRASE_NOTES = 3
+MIN_PHRASE_CHARS = 6
+MAX_CLAUSES = 4
+MAX_PHRASES = 300
+
+SAME_SUBJECT = "同上"
+
+# 子句：到下一個標點 (含) 為止
+_CLAUSE_RE = re.compile(r"[^，,。；;\n]+[，,。；;\n]?")
+_TRAILING_PUNCT = "，,。；;\n "
+
+_lock = threading.Lock()
+_table = None
+_table_mtime = None
+
+
+# ==========================================
+# 1. 離線學習片語表
+# ==========================================
+
+def _clauses(text):
+    return [c for c in _CLAUSE_RE.findall(text or "") if c.strip()]
+
+
+def _strip_signature(text, names):
+    text = (text or "").rstrip()
+    for name in names:
+        if text.endswith(name):
+            return text[:-len(name)].rstrip(" /")
+    return text
+
+
+def learn_phrase_table(notes, min_notes=MIN_PHRASE_NOTES, max_phrases=MAX_PHRASES):
+    """
+    從紀錄內容統計常見片語。
+
+    Args:
+        notes: 紀錄內容字串的可迭代物件
+        min_notes: 片語至少要出現在幾筆不同紀錄中
+
+    Returns:
+        list of dict (phrase, notes)，依預估節省量排序
+    """
+    notes = list(notes)
+    # 結尾的人員簽名不屬於制式語句 (也不該寫進片語表)，學習前先去除
+    names = sorted(harvest_signatures(notes), key=len, reverse=True)
+    counts = Counter()
+    for note in notes:
+        clauses = _clauses(_strip_signature(note, names))
+        seen = set()
+        for i in range(len(clauses)):
+            for n in range(1, MAX_CLAUSES + 1):
+                if i + n > len(clauses):
+                    break
+                phrase = "".join(clauses[i:i + n]).strip().rstrip(_TRAILING_PUNCT)
+                if len(phrase) >= MIN_PHRASE_CHARS:
+                    seen.add(phrase)
+        counts.update(seen)
+
+    candidates = [(phrase, n) for phrase, n in counts.items() if n >= min_notes]
+    # 預估節省量：出現次數 × 可省下的字數 (代碼約佔 4 個字)
+    candidates.sort(key=lambda item: (-item[1] * (len(item[0]) - 4), item[0]))
+    return [{"phrase": phrase, "notes": n} for phrase, n in candidates[:max_phrases]]
+
+
+def _load_corpus_notes():
+    """讀取全部護理紀錄內容；HISTORY_SOURCE=csv 時讀 data/ 下的匯出檔，否則讀資料庫。"""
+    if os.getenv("HISTORY_SOURCE", "db").lower() == "csv":
+        import csv
+        from data.csv_index import DATA_DIR, TABLE_LAYOUTS
+        from data.check_patients import detect_encoding
+
+        layout = TABLE_LAYOUTS["nursing"]
+        path = os.path.join(DATA_DIR, layout["filename"])
+        col = layout["columns"].index("DIAGNOSIS")
+        with open(path, encoding=detect_encoding(path), newline="") as f:
+            return [row[col] for row in csv.reader(f) if len(row) > col]
+
+    import psycopg2
+    from db.db_connector import get_db_connection
+
+    conn = get_db_connection(readonly=True, statement_timeout_ms=0)
+    if not conn: return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT DIAGNOSIS FROM ENSDATA WHERE DIAGNOSIS IS NOT NULL")
+            return [row[0] for row in cur.fetchall()]
+    except psycopg2.Error as e:
+        print(f"讀取護理紀錄失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+def build_phrase_table(path=PHRASE_TABLE_PATH):
+    """重新學習並寫入片語表，回傳片語數。"""
+    notes = _load_corpus_notes()
+    if not notes:
+        print("沒有護理紀錄可供學習，片語表未更新。")
+        return 0
+    phrases = learn_phrase_table(notes)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"corpus_notes": len(notes), "phrases": phrases}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return len(phrases)
+
+
+def load_phrase_table(path=PHRASE_TABLE_PATH):
+    """
+    讀取片語表 (檔案更新後自動重新載入)。
+
+    Returns:
+        (片語列表 (長到短), 比對用正規表示式)；檔案不存在時為 ([], None)
+    """
+    global _table, _table_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return [], None
+    with _lock:
+        if _table is None or mtime != _table_mtime:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    phrases = [p["phrase"] for p in json.load(f).get("phrases", [])]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"讀取片語表失敗: {e}")
+                phrases = []
+            # 較長的片語優先比對
+            phrases.sort(key=len, reverse=True)
+            pattern = re.compile("|".join(map(re.escape, phrases))) if phrases else None
+            _table, _table_mtime = (phrases, pattern), mtime
+        return _table
+
+
+# ==========================================
+# 2. 組 Prompt 時壓縮
+# ==========================================
+
+def _nursing_line(time_text, subject, diagnosis):
+    return f"- {time_text} | {subject} | {diagnosis}"
+
+
+def compress_nursing_notes(nursing_items, table=None):
+    """
+    產生【護理紀錄】的內容行，重複的主訴與制式語句只出現一次。
+
+    Args:
+        nursing_items: 護理紀錄列表 (PROCDTTM / SUBJECT / DIAGNOSIS)
+        table: (選用) load_phrase_table 的結果，預設讀取 data/note_phrases.json
+
+    Returns:
+        (lines, legend_lines, stats)
+        stats: tokens_before, tokens_after (含對照區塊), tokens_saved, subjects_collapsed, phrases_used
+    """
+    plain = [
+        _nursing_line(item.get('PROCDTTM', ''), item.get('SUBJECT', ''), item.get('DIAGNOSIS', ''))
+        for item in nursing_items
+    ]
+    tokens_before = count_tokens("\n".join(plain))
+    if not NOTE_COMPRESSION_ENABLED or not nursing_items:
+        stats = {"tokens_before": tokens_before, "tokens_after": tokens_before, "tokens_saved": 0,
+                 "subjects_collapsed": 0, "phrases_used": 0}
+        return plain, [], stats
+
+    phrases, pattern = table if table is not None else load_phrase_table()
+    diagnoses = [item.get('DIAGNOSIS') or '' for item in nursing_items]
+
+    # 片語：本次出現多次，且「代碼 × 次數 + 對照行」比原文短才替換
+    codes = {}
+    if pattern is not None:
+        occurrences = Counter(m.group(0) for text in diagnoses for m in pattern.finditer(text))
+        for phrase, n in sorted(occurrences.items(), key=lambda item: -item[1] * len(item[0])):
+            if n < 2:
+                continue
+            code = f"〈P{len(codes) + 1}〉"
+            cost = count_tokens(f"{code} = {phrase}") + n * count_tokens(code)
+            if cost < n * count_tokens(phrase):
+                codes[phrase] = code
+
+    lines, previous_subject, subjects_collapsed = [], None, 0
+    for item, text in zip(nursing_items, diagnoses):
+        if codes:
+            text = pattern.sub(lambda m: codes.get(m.group(0), m.group(0)), text)
+        subject = item.get('SUBJECT', '')
+        if subject and subject == previous_subject:
+            shown_subject = SAME_SUBJECT
+            subjects_collapsed += 1
+        else:
+            shown_subject = subject
+        previous_subject = subject
+        lines.append(_nursing_line(item.get('PROCDTTM', ''), shown_subject, text))
+
+    legend = [f"{code} = {phrase}" for phrase, code in codes.items()]
+    tokens_after = count_tokens("\n".join(lines + legend))
+    stats = {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+        "subjects_collapsed": subjects_collapsed,
+        "phrases_used": len(codes),
+    }
+    return lines, legend, stats
+
+
+def describe_compression(stats):
+    """一行摘要，供 log 使用。"""
+    before = stats["tokens_before"]
+    ratio = stats["tokens_saved"] / before if before else 0
+    return (f"護理紀錄約 {before} → {stats['tokens_after']} tokens (節省 {ratio:.0%})，"
+            f"主訴合併 {stats['subjects_collapsed']} 筆、常用語 {stats['phrases_used']} 組")
+
+
+if __name__ == "__main__":
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "learn"
+    if command == "learn":
+        print(f"片語表已更新：{build_phrase_table()} 組 ({PHRASE_TABLE_PATH})")
+    elif command == "show":
+        if os.getenv("HISTORY_SOURCE", "db").lower() == "csv":
+            from data.csv_index import get_patient_full_history
+        else:
+            from db.patient_service import get_patient_full_history
+
+        data = get_patient_full_history(sys.argv[2] if len(sys.argv) > 2 else "0002452972")
+        lines, legend, stats = compress_nursing_notes((data or {}).get("nursing", []))
+        print("\n".join(legend + [""] + lines))
+        print(f"\n{describe_compression(stats)}")
+    else:
+        print("用法: python -m ai.note_compressor [learn | show <病歷號>]")
@@ -0,0 +1,258 @@
+# /ai/note_retriever.py
+
+# 護理紀錄檢索：依「重點關注項目 + 模板」挑出最相關的護理紀錄放進 Prompt，
+# 取代固定送出最新 N 筆的做法。
+#
+#   - 向量模型：若有安裝 sentence-transformers 則使用本機小型模型 (CPU 即可)，
+#     否則退回「字元 n-gram 雜湊向量」，完全不需要外部服務
+#   - 向量快取：ai_note_embeddings (migrations 版本 7)，以紀錄內容雜湊為鍵，
+#     只計算新出現的紀錄；資料庫無法連線時僅使用本程序內的快取
+
+import os
+import math
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2.extras import execute_values
+from db.db_connector import get_db_connection
+
+# 本機模型 (選用)，可用環境變數替換成其他 sentence-transformers 模型
+EMBED_MODEL_NAME = os.getenv("NOTE_EMBED_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+HASH_MODEL_NAME = "char-ngram-hash-v1"
+HASH_DIM = 512
+
+# 最新的幾筆紀錄不論相似度都保留，確保摘要看得到目前狀況
+KEEP_LATEST = 5
+
+# 重點關注項目 -> 擴充查詢用的關鍵詞 (護理紀錄常見寫法)
+FOCUS_QUERY_HINTS = {
+    "生命徵象趨勢": "生命徵象 血壓 BP 心跳 脈搏 體溫 發燒 呼吸 喘 血氧 SpO2 監測",
+    "檢驗報告異常值": "抽血 檢驗 報告 異常 追蹤 數值 血糖 Glucose 電解質 CBC",
+    "護理處置經過": "給予 予 依醫囑 inj 注射 IVD 點滴 藥物 處置 護理 STAT 衛教",
+    "病患主訴": "主訴 自訴 病人表示 疼痛 不適 胸悶 頭暈 噁心",
+    "管路狀況": "管路 導管 Foley NG 鼻胃管 尿管 留置針 CVC 引流管 氣管內管 固定",
+    "意識狀態(GCS)": "意識 GCS 清醒 嗜睡 混亂 躁動 瞳孔 對光反射 昏迷",
+}
+
+# 模板名稱關鍵字 -> 情境查詢詞
+TEMPLATE_QUERY_HINTS = {
+    "交班": "目前狀況 待追蹤 處置 管路 意識",
+    "出院": "出院 轉院 處置經過 衛教 病情穩定",
+    "會診": "檢驗 異常 影像 症狀 評估",
+    "創傷": "外傷 出血 傷口 急救 CPR 插管",
+}
+
+# 程序內向量快取的上限筆數 (LRU)；持久快取在資料庫，這裡只保留最近用到的紀錄
+MEMORY_CACHE_SIZE = int(os.getenv("NOTE_EMBED_CACHE_SIZE", "5000"))
+
+_embed_model = None
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+# ==========================================
+# 1. 向量計算
+# ==========================================
+
+def _load_model():
+    """延遲載入本機模型；未安裝或載入失敗時回傳 None (改用雜湊向量)。"""
+    global _embed_model
+    if _embed_model is None:
+        try:
+            from sentence_transformers import SentenceTransformer
+            _embed_model = SentenceTransformer(EMBED_MODEL_NAME, device="cpu")
+        except Exception as e:
+            print(f"ℹ️ 未使用本機向量模型 ({e})，改用字元 n-gram 雜湊向量。")
+            _embed_model = False
+    return _embed_model or None
+
+
+def active_model_name():
+    return EMBED_MODEL_NAME if _load_model() else HASH_MODEL_NAME
+
+
+def _normalize(vec):
+    norm = math.sqrt(sum(v * v for v in vec))
+    return [v / norm for v in vec] if norm else list(vec)
+
+
+def hash_embed(text, dim=HASH_DIM):
+    """
+    字元 1~3-gram 雜湊向量。中文沒有空白斷詞，以字元 n-gram 表示即可涵蓋
+    「鼻胃管」「GCS」這類關鍵詞；英數字一律轉小寫。
+    """
+    vec = [0.0] * dim
+    text = (text or "").lower()
+    for n, weight in ((1, 0.5), (2, 1.0), (3, 1.0)):
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            if gram.isspace():
+                continue
+            digest = hashlib.md5(gram.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % dim
+            vec[index] += weight if digest[4] & 1 else -weight
+    return _normalize(vec)
+
+
+def embed_texts(texts):
+    """批次計算向量 (已正規化為單位長度)。"""
+    model = _load_model()
+    if model:
+        return [_normalize(list(map(float, v))) for v in model.encode(texts, batch_size=32)]
+    return [hash_embed(t) for t in texts]
+
+
+def _note_text(note):
+    # SUBJECT 是整次就診的主訴 (每筆都相同)，DIAGNOSIS 才是該筆紀錄的內容
+    return (note.get("DIAGNOSIS") or note.get("SUBJECT") or "").strip()
+
+
+def _note_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# ==========================================
+# 2. 向量快取 (資料庫 + 程序內)
+# ==========================================
+
+def _load_cached(hashes, model):
+    conn = get_db_connection(readonly=True)
+    if not conn: return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT note_hash, vector FROM ai_note_embeddings WHERE model = %s AND note_hash = ANY(%s)",
+                (model, list(hashes))
+            )
+            return {h: array("f", bytes(blob)).tolist() for h, blob in cur.fetchall()}
+    except psycopg2.Error as e:
+        print(f"讀取向量快取失敗: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def _store_cached(vectors, model):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO ai_note_embeddings (note_hash, model, dim, vector) VALUES %s
+                ON CONFLICT (note_hash, model) DO NOTHING
+            """, [(h, model, len(v), psycopg2.Binary(array("f", v).tobytes())) for h, v in vectors.items()])
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"寫入向量快取失敗: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def get_note_vectors(texts):
+    """
+    取得多段紀錄文字的向量：程序內快取 -> 資料庫快取 -> 只計算剩下的新紀錄。
+
+    Returns:
+        dict: {note_hash: vector}
+    """
+    model = active_model_name()
+    hashes = {_note_hash(t): t for t in texts}
+    result = {}
+    with _memory_lock:
+        for h in hashes:
+            vec = _memory_cache.get((h, model))
+            if vec is not None:
+                _memory_cache.move_to_end((h, model))
+                result[h] = vec
+
+    missing = [h for h in hashes if h not in result]
+    if missing:
+        fetched = _load_cached(missing, model)
+        new_hashes = [h for h in missing if h not in fetched]
+        if new_hashes:
+            new_vectors = dict(zip(new_hashes, embed_texts([hashes[h] for h in new_hashes])))
+            _store_cached(new_vectors, model)
+            fetched.update(new_vectors)
+        result.update(fetched)
+        _remember(fetched, model)
+    return result
+
+
+def _remember(vectors, model):
+    """加入程序內快取，超過 MEMORY_CACHE_SIZE 時淘汰最久未使用的紀錄。"""
+    with _memory_lock:
+        for h, v in vectors.items():
+            _memory_cache[(h, model)] = v
+            _memory_cache.move_to_end((h, model))
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+# ==========================================
+# 3. 依相關性挑選紀錄
+# ==========================================
+
+def build_query_text(focus_areas=None, template_name=None):
+    parts = []
+    for area in focus_areas or []:
+        parts.append(area)
+        parts.append(FOCUS_QUERY_HINTS.get(area, ""))
+    for keyword, hint in TEMPLATE_QUERY_HINTS.items():
+        if template_name and keyword in template_name:
+            parts.append(hint)
+    return " ".join(p for p in parts if p)
+
+
+def select_relevant_notes(nursing_list, focus_areas=None, template_name=None, limit=25, char_budget=None):
+    """
+    從護理紀錄中挑出與關注項目 / 模板最相關的紀錄。
+    最新 KEEP_LATEST 筆一定保留，其餘依相似度遞減填入，直到筆數或字數上限。
+    回傳結果維持原本的時間順序。
+
+    Args:
+        nursing_list: get_patient_full_history 回傳的 nursing 列表 (時間由舊到新)
+        limit: 最多筆數
+        char_budget: (選用) 紀錄內容總字數上限
+    """
+    texts = [_note_text(n) for n in nursing_list]
+    if len(nursing_list) <= limit and (char_budget is None or sum(map(len, texts)) <= char_budget):
+        return nursing_list
+
+    newest_first = list(range(len(nursing_list) - 1, -1, -1))
+    query = build_query_text(focus_areas, template_name)
+    if not query:
+        # 沒有關注項目時由新到舊填入，同樣受筆數與字數上限限制
+        return _fill(nursing_list, texts, newest_first, limit, char_budget)
+
+    # 查詢文字只在記憶體中計算，不寫入 ai_note_embeddings (快取只存護理紀錄本身)
+    vectors = get_note_vectors([t for t in texts if t])
+    query_vec = embed_texts([query])[0]
+
+    def score(i):
+        vec = vectors.get(_note_hash(texts[i])) if texts[i] else None
+        return sum(a * b for a, b in zip(vec, query_vec)) if vec else -1.0
+
+    latest = newest_first[:KEEP_LATEST]
+    ranked = sorted(newest_first[KEEP_LATEST:], key=score, reverse=True)
+    return _fill(nursing_list, texts, latest + ranked, limit, char_budget)
+
+
+def _fill(nursing_list, texts, order, limit, char_budget):
+    """依 order 的優先順序挑選紀錄，直到筆數或字數上限；回傳結果維持時間順序。"""
+    chosen, used_chars, seen = [], 0, set()
+    for i in order:
+        if len(chosen) >= limit:
+            break
+        # 同一段文字 (例如重複開立的醫囑) 只放一次
+        if texts[i] in seen:
+            continue
+        if char_budget is not None and used_chars + len(texts[i]) > char_budget:
+            continue
+        chosen.append(i)
+        seen.add(texts[i])
+        used_chars += len(texts[i])
+    return [nursing_list[i] for i in sorted(chosen)]
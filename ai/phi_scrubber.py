@@ -0,0 +1,501 @@
+# /ai/phi_scrubber.py
+
+# 去識別化 (PHI scrubbing)：資料送往外部 LLM 前，把人員 / 病患姓名、病歷號、身分證字號、
+# 電話與文字中的日期換成佔位符 (例如 [人員1])，AI 回傳摘要後再換回原文。
+#
+#   - 姓名：字典比對。字典來源為資料表 phi_terms (migrations 版本 11)，以及從本次病患的護理紀錄
+#     結尾簽名擷取的人員姓名 (harvest_signatures，只用於該次請求，不會加入共用字典)
+#   - 病患姓名：匯入的五張 HIS 表都沒有姓名欄位，無法自動取得。只有以
+#     python -m ai.phi_scrubber add-patients <檔案> 匯入 phi_terms (category = 'patient') 的姓名會被替換，
+#     未匯入時自由文字中的病患姓名會原樣送往 LLM
+#   - 字典比對預設使用 trie 結構的單一正規表示式；PHI_SCRUB_BACKEND=automaton 時改用
+#     Aho-Corasick 自動機 (選用套件 pyahocorasick)。兩者都只需掃描文字一次，
+#     但在 5000 筆字典的量測中正規表示式較快 (見下方 bench)，因此不預設使用自動機
+#   - 病歷號 / 身分證 / 電話 / 日期使用預先編譯的正規表示式
+#   - 同一次請求中相同原文對應同一個佔位符，可完整還原
+#
+# 效能量測：
+#   python -m ai.phi_scrubber bench 20 5    # 以 data/ 的護理紀錄放大到 20 MB，每項 5 次取中位數
+
+import os
+import re
+import time
+import threading
+from collections import Counter
+from operator import itemgetter
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+PHI_SCRUB_ENABLED = os.getenv("PHI_SCRUB", "1").lower() in ("1", "true", "yes")
+# 姓名比對方式：regex (預設) / automaton (需要 pyahocorasick)
+PHI_SCRUB_BACKEND = os.getenv("PHI_SCRUB_BACKEND", "regex").lower()
+# 資料庫字典的快取秒數
+PHI_TERMS_TTL = int(os.getenv("PHI_TERMS_TTL", "600"))
+# 簽名至少出現在幾筆「不同」紀錄的結尾，才視為人員姓名 (單次請求 / 寫入 phi_terms)
+PHI_HARVEST_MIN_NOTES = int(os.getenv("PHI_HARVEST_MIN_NOTES", "2"))
+PHI_REFRESH_MIN_NOTES = int(os.getenv("PHI_REFRESH_MIN_NOTES", "5"))
+
+# 類別 -> 佔位符名稱
+CATEGORY_LABELS = {
+    "staff": "人員",
+    "patient": "病患",
+    "mrn": "病歷號",
+    "national_id": "身分證",
+    "phone": "電話",
+    "date": "日期",
+}
+
+# 結構化識別碼。每個正規表示式都以固定字元類別開頭 (邊界檢查放在第一個字元之後)，
+# re 才能用開頭字元快速略過不可能相符的位置；多個模式合併成一個交替式會失去這個最佳化，
+# 所以分成少數幾次掃描再合併結果。
+_NATIONAL_ID_RE = re.compile(r"[A-Z](?<![A-Za-z0-9][A-Z])[12]\d{8}(?!\d)")
+# 數字開頭的候選字串 (含 / . - 年月日)，再逐一判斷是病歷號、電話或日期；
+# 一般數值 (37.5、120/80) 長度不足或格式不符會被略過
+_NUMERIC_CANDIDATE_RE = re.compile(r"\d(?<![\d.]\d)[\d/.\-年月日]{4,14}")
+_NUMERIC_PATTERNS = [
+    ("mrn", re.compile(r"\d{10}")),
+    ("phone", re.compile(r"09\d{2}-?\d{3}-?\d{3}|0\d{1,2}-\d{6,8}")),
+    ("date", re.compile(r"(?:19|20)\d{2}[/.-]\d{1,2}[/.-]\d{1,2}|\d{2,4}年\d{1,2}月\d{1,2}日")),
+]
+
+_RESTORE_RE = re.compile(
+    r"[\[［【](" + "|".join(CATEGORY_LABELS.values()) + r")(\d+)[\]］】]"
+)
+
+# 護理紀錄結尾的簽名，例如「... 依醫囑給予處置 張家瑜」、「... 送住院。/ 羅士恆」
+_SIGNATURE_RE = re.compile(r"(?:\s|/)\s*([一-鿿]{2,4})\s*$")
+# 常見姓氏 (含複姓)，避免把結尾的一般詞彙誤當成人名
+_SURNAMES = set(
+    "陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴周徐蘇葉莊呂江何蕭羅高簡朱鍾施游詹沈彭胡余盧潘顏梁趙"
+    "柯翁魏方孫戴范宋鄧杜侯曹薛傅丁溫紀蔣歐藍連唐馬董石卓程姚康馮古姜湯汪白田涂鄒巫尤鐘龔嚴韓黎"
+    "阮袁童陸金錢邵夏"
+)
+_COMPOUND_SURNAMES = ("歐陽", "司馬", "諸葛", "張簡", "范姜", "上官")
+# 以常見姓氏開頭、也可能出現在紀錄結尾的臨床 / 一般詞彙，不可當成人名
+_NOT_NAMES = frozenset("""
+白血球 白蛋白 白內障 白色痰 白血病 黃疸 黃色痰 黃膿痰 高燒 高熱 高血壓 高血糖 高血鉀 高血鈉 高流量 高處跌落
+溫度 溫水 溫敷 溫熱 張力 張口 紀錄 方式 方向 方法 葉克膜 林格氏液 周邊 周圍 連續 連接 連結 程度 康復 石膏
+金屬 許可 施打 施行 施予 游離 曾經 馬上 陸續 丁字帶 戴口罩 藍色 唐氏症 馬桶 古柯鹼 湯匙 湯藥 尤其 鐘頭 嚴重
+嚴密 夏天 石頭 顏面 顏色 陳述 陳舊 余量 何時 何處 蘇醒 葉酸 簡單 簡短 簡易 程序 金額 金黃色 周期 錢包 邱疹
+""".split())
+
+
+# ==========================================
+# 1. 佔位符對照
+# ==========================================
+
+class PhiMapping:
+    """原文 <-> 佔位符對照表；一次請求 (一位病患) 使用一個。"""
+
+    def __init__(self):
+        self.to_placeholder = {}
+        self.to_original = {}
+        self._counters = Counter()
+
+    def placeholder(self, category, original):
+        key = (category, original)
+        if key not in self.to_placeholder:
+            label = CATEGORY_LABELS[category]
+            self._counters[label] += 1
+            token = f"[{label}{self._counters[label]}]"
+            self.to_placeholder[key] = token
+            self.to_original[(label, self._counters[label])] = original
+        return self.to_placeholder[key]
+
+    def restore(self, text):
+        """把 AI 回傳文字中的佔位符換回原文 (也接受全形括號)。"""
+        if not text or not self.to_original:
+            return text
+
+        def _replace(match):
+            original = self.to_original.get((match.group(1), int(match.group(2))))
+            return original if original is not None else match.group(0)
+
+        return _RESTORE_RE.sub(_replace, text)
+
+    def __len__(self):
+        return len(self.to_placeholder)
+
+
+# ==========================================
+# 2. 比對器
+# ==========================================
+
+def _trie_pattern(terms):
+    """把詞彙清單轉成 trie 形式的正規表示式 (共用前綴只比對一次，且優先最長相符)。"""
+    trie = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def _build(node):
+        terminal = "" in node
+        branches = [re.escape(ch) + _build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if terminal:
+            return f"(?:{body})?"
+        return body if len(branches) == 1 else body
+
+    return _build(trie)
+
+
+def _numeric_spans(text):
+    for m in _NUMERIC_CANDIDATE_RE.finditer(text):
+        candidate = m.group(0).rstrip("/.-")
+        for category, pattern in _NUMERIC_PATTERNS:
+            if pattern.fullmatch(candidate):
+                yield m.start(), m.start() + len(candidate), category, candidate
+                break
+
+
+class PhiScrubber:
+    """
+    依字典 (姓名) 與識別碼規則替換文字。字典不會在建立後變動，需要更新時建立新的實例。
+
+    Args:
+        terms: dict {詞彙: 類別 ('staff' / 'patient')}
+        backend: 'regex' / 'automaton' (pyahocorasick)；預設為 PHI_SCRUB_BACKEND
+        identifiers: 是否比對病歷號 / 身分證 / 電話 / 日期 (只補比對單次請求的姓名時為 False)
+    """
+
+    def __init__(self, terms, backend=None, identifiers=True):
+        self.terms = {t: c for t, c in terms.items() if t and len(t) >= 2}
+        self.identifiers = identifiers
+        self.backend = backend or PHI_SCRUB_BACKEND
+        if backend is None and self.backend == "automaton" and ahocorasick is None:
+            print("⚠️ PHI_SCRUB_BACKEND=automaton 但未安裝 pyahocorasick，改用正規表示式比對。")
+            self.backend = "regex"
+        self._automaton = None
+        self._terms_re = None
+
+        if self.backend == "automaton":
+            if ahocorasick is None:
+                raise RuntimeError("需要 pyahocorasick：pip install -r requirements-optional.txt")
+            if self.terms:
+                self._automaton = ahocorasick.Automaton()
+                for term, category in self.terms.items():
+                    self._automaton.add_word(term, (term, category))
+                self._automaton.make_automaton()
+        elif self.terms:
+            self._terms_re = re.compile(_trie_pattern(self.terms))
+
+    def _term_spans(self, text):
+        if self._automaton is not None:
+            for end, (term, category) in self._automaton.iter_long(text):
+                yield end - len(term) + 1, end + 1, category, term
+        elif self._terms_re is not None:
+            for m in self._terms_re.finditer(text):
+                yield m.start(), m.end(), self.terms[m.group(0)], m.group(0)
+
+    def _spans(self, text):
+        """回傳不重疊的 (start, end, 類別, 原文)，依位置排序；重疊時保留較早開始者。"""
+        spans = list(self._term_spans(text))
+        if self.identifiers:
+            spans += [(m.start(), m.end(), "national_id", m.group(0)) for m in _NATIONAL_ID_RE.finditer(text)]
+            spans += _numeric_spans(text)
+        # 各來源本身已依位置排序，穩定排序幾乎是線性時間
+        spans.sort(key=itemgetter(0))
+        last_end = 0
+        for span in spans:
+            if span[0] >= last_end:
+                yield span
+                last_end = span[1]
+
+    def scrub(self, text, mapping):
+        if not text:
+            return text
+        parts, last = [], 0
+        tokens = mapping.to_placeholder
+        for start, end, category, original in self._spans(text):
+            parts.append(text[last:start])
+            token = tokens.get((category, original))
+            parts.append(token if token is not None else mapping.placeholder(category, original))
+            last = end
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+# ==========================================
+# 3. 字典來源
+# ==========================================
+
+def _looks_like_name(term):
+    """
+    自動擷取的姓名只接受「常見姓氏 + 名字」共 3~4 字 (複姓 3~4 字)，且不在臨床詞彙排除清單中。
+    兩個字的姓名與一般詞彙 (溫度、張力、紀錄...) 難以區分，需要時請手動加入 phi_terms。
+    """
+    if term in _NOT_NAMES:
+        return False
+    if term[:2] in _COMPOUND_SURNAMES:
+        return 3 <= len(term) <= 4
+    return term[0] in _SURNAMES and 3 <= len(term) <= 4
+
+
+def harvest_signatures(notes, min_notes=PHI_HARVEST_MIN_NOTES):
+    """
+    從護理紀錄結尾的簽名 (「... / 姓名」或以空白隔開的最後一段) 擷取人員姓名。
+    同一個詞必須出現在至少 min_notes 筆內容不同的紀錄結尾，只出現一次的結尾詞彙不算。
+
+    Args:
+        notes: 紀錄內容字串，或 get_patient_full_history 的 nursing 列表
+    """
+    seen = {}
+    for note in notes:
+        text = note.get("DIAGNOSIS") if isinstance(note, dict) else note
+        match = _SIGNATURE_RE.search(text or "")
+        if match and _looks_like_name(match.group(1)):
+            seen.setdefault(match.group(1), set()).add(text)
+    return {term for term, texts in seen.items() if len(texts) >= min_notes}
+
+
+def load_phi_terms():
+    """讀取 phi_terms 字典 {詞彙: 類別}；資料庫無法使用時回傳空字典。"""
+    try:
+        import psycopg2
+        from db.db_connector import get_db_connection
+    except ImportError:
+        return {}
+
+    conn = get_db_connection(readonly=True)
+    if not conn: return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT term, category FROM phi_terms")
+            return {term: category for term, category in cur.fetchall()}
+    except psycopg2.Error as e:
+        print(f"讀取去識別化字典失敗: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def refresh_phi_terms_from_notes(min_notes=PHI_REFRESH_MIN_NOTES):
+    """
+    掃描 ENSDATA 全部紀錄的結尾簽名，把新出現的人員姓名寫入 phi_terms。
+    先前自動擷取 (source = 'notes')、但已不符合條件的詞彙 (例如新加入排除清單的臨床詞彙) 會一併移除；
+    手動加入的詞彙不受影響。建議在匯入資料後執行 (python -m ai.phi_scrubber refresh)。
+
+    Returns:
+        int: 新增的詞彙數
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+    from db.db_connector import get_db_connection
+
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return 0
+    try:
+        with conn.cursor() as cur:
+            # 在資料庫端擷取簽名並彙總，不需把所有紀錄傳回來
+            cur.execute(r"""
+                SELECT sig, COUNT(DISTINCT DIAGNOSIS) FROM (
+                    SELECT substring(DIAGNOSIS FROM '(?:\s|/)\s*([一-鿿]{2,4})\s*$') AS sig, DIAGNOSIS FROM ENSDATA
+                ) s
+                WHERE sig IS NOT NULL
+                GROUP BY sig HAVING COUNT(DISTINCT DIAGNOSIS) >= %s
+            """, (min_notes,))
+            names = [(term, "staff", "notes") for term, _ in cur.fetchall() if _looks_like_name(term)]
+            added = 0
+            if names:
+                execute_values(cur, """
+                    INSERT INTO phi_terms (term, category, source) VALUES %s
+                    ON CONFLICT (term) DO NOTHING
+                """, names)
+                added = cur.rowcount
+            cur.execute(
+                "DELETE FROM phi_terms WHERE source = 'notes' AND NOT (term = ANY(%s))",
+                ([term for term, _, _ in names],)
+            )
+            if cur.rowcount:
+                print(f"移除 {cur.rowcount} 筆已不符合條件的自動擷取詞彙")
+        conn.commit()
+        return max(added, 0)
+    except psycopg2.Error as e:
+        print(f"更新去識別化字典失敗: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+
+def add_phi_terms(terms, category="patient", source="manual"):
+    """
+    將姓名清單寫入 phi_terms (例如從掛號系統匯出的病患姓名)。
+    已存在的詞彙不會覆蓋；各程序在 PHI_TERMS_TTL 秒內重新讀取字典後生效。
+
+    Returns:
+        int: 新增的詞彙數
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+    from db.db_connector import get_db_connection
+
+    rows = [(term, category, source) for term in dict.fromkeys(t.strip() for t in terms) if len(term) >= 2]
+    if not rows:
+        return 0
+
+    conn = get_db_connection()
+    if not conn: return 0
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO phi_terms (term, category, source) VALUES %s
+                ON CONFLICT (term) DO NOTHING
+            """, rows)
+            added = cur.rowcount
+        conn.commit()
+        return max(added, 0)
+    except psycopg2.Error as e:
+        print(f"寫入去識別化字典失敗: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+
+_lock = threading.Lock()
+_db_terms = {}
+_db_terms_loaded_at = 0.0
+_scrubber = None
+
+
+def get_scrubber():
+    """
+    取得 phi_terms 字典對應的比對器 (程序內共用)。
+    字典每 PHI_TERMS_TTL 秒重新讀取，內容有變動時才重建比對器。
+    """
+    global _db_terms, _db_terms_loaded_at, _scrubber
+    with _lock:
+        changed = False
+        if time.monotonic() - _db_terms_loaded_at > PHI_TERMS_TTL:
+            terms = load_phi_terms()
+            changed = terms != _db_terms
+            _db_terms, _db_terms_loaded_at = terms, time.monotonic()
+        if _scrubber is None or changed:
+            _scrubber = PhiScrubber(_db_terms)
+        return _scrubber
+
+
+# ==========================================
+# 4. 對外介面
+# ==========================================
+
+def scrub_text(text, mapping=None, patient_data=None):
+    """
+    去識別化一段文字。
+
+    Args:
+        mapping: (選用) 沿用既有的 PhiMapping，讓多段文字共用同一組佔位符
+        patient_data: (選用) 病患資料；從其護理紀錄擷取的簽名只用於這次替換，不會加入共用字典
+
+    Returns:
+        (去識別化後的文字, PhiMapping)
+    """
+    mapping = mapping if mapping is not None else PhiMapping()
+    if not PHI_SCRUB_ENABLED or not text:
+        return text, mapping
+    scrubber = get_scrubber()
+    text = scrubber.scrub(text, mapping)
+
+    harvested = harvest_signatures(patient_data.get("nursing", [])) if patient_data else ()
+    extra = {term: "staff" for term in harvested if term not in scrubber.terms}
+    if extra:
+        text = PhiScrubber(extra, identifiers=False).scrub(text, mapping)
+    return text, mapping
+
+
+def restore_text(text, mapping):
+    """把佔位符換回原文。"""
+    return mapping.restore(text) if mapping else text
+
+
+# ==========================================
+# 5. 效能量測
+# ==========================================
+
+def _load_sample_notes():
+    import csv
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "data", "ENSDATA-急診護理紀錄.csv")
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return [row[6] for row in csv.reader(f) if len(row) > 6]
+
+
+def _median_seconds(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return sorted(times)[len(times) // 2]
+
+
+def benchmark(target_mb=20, repeat=5):
+    """
+    以 data/ 的護理紀錄放大到 target_mb 測試吞吐量；每項重複 repeat 次取中位數，
+    並分別列出姓名比對、識別碼比對與完整替換 (含佔位符對照) 的速度。
+    """
+    notes = _load_sample_notes()
+    terms = {t: "staff" for t in harvest_signatures(notes)}
+    # 模擬完整的人員字典：加入大量不會出現的姓名，確認字典大小不影響速度
+    surnames = sorted(_SURNAMES)
+    for i in range(5000):
+        terms.setdefault(surnames[i % len(surnames)] + chr(0x4E00 + (i * 7919) % 20000) + chr(0x4E00 + i % 20000), "staff")
+
+    chunk = "\n".join(notes)
+    text = chunk * max(1, int(target_mb * 1024 * 1024 / len(chunk.encode("utf-8"))))
+    size_mb = len(text.encode("utf-8")) / 1024 / 1024
+    print(f"測試文字 {size_mb:.1f} MB，字典 {len(terms)} 筆，每項 {repeat} 次取中位數")
+
+    identifiers = PhiScrubber({}, backend="regex")
+    seconds = _median_seconds(lambda: list(identifiers._spans(text)), repeat)
+    print(f"{'識別碼':<10} {size_mb / seconds:8.1f} MB/s  (病歷號 / 身分證 / 電話 / 日期)")
+
+    backends = ["regex"] + (["automaton"] if ahocorasick else [])
+    for backend in backends:
+        scrubber = PhiScrubber(terms, backend=backend)
+        names_seconds = _median_seconds(lambda: list(scrubber._term_spans(text)), repeat)
+        results = []
+
+        def _full():
+            mapping = PhiMapping()
+            results[:] = [scrubber.scrub(text, mapping), mapping]
+
+        full_seconds = _median_seconds(_full, repeat)
+        scrubbed, mapping = results
+        restored = mapping.restore(scrubbed)
+        print(f"{backend:<10} 姓名 {size_mb / names_seconds:8.1f} MB/s  完整替換 {size_mb / full_seconds:8.1f} MB/s  "
+              f"佔位符 {len(mapping)} 種  可還原: {'是' if restored == text else '否'}")
+    if not ahocorasick:
+        print("(未安裝 pyahocorasick，略過 automaton；pip install -r requirements-optional.txt)")
+
+
+if __name__ == "__main__":
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    if command == "refresh":
+        print(f"新增 {refresh_phi_terms_from_notes()} 筆人員姓名至 phi_terms")
+    elif command == "add-patients":
+        if len(sys.argv) < 3:
+            print("用法: python -m ai.phi_scrubber add-patients <病患姓名檔 (每行一個)>")
+            sys.exit(1)
+        with open(sys.argv[2], encoding="utf-8") as f:
+            print(f"新增 {add_phi_terms(f.read().splitlines())} 筆病患姓名至 phi_terms")
+    elif command == "bench":
+        benchmark(float(sys.argv[2]) if len(sys.argv) > 2 else 20,
+                  int(sys.argv[3]) if len(sys.argv) > 3 else 5)
+    else:
+        sample = " ".join(sys.argv[1:])
+        scrubbed, m = scrub_text(sample)
+        print(scrubbed)
+        print(m.restore(scrubbed))
@@ -0,0 +1,185 @@
+# /ai/prompt_builder.py
+
+# Prompt 組裝：固定內容在前、病患資料在後，讓供應商的 prompt 前綴快取 (prefix / KV cache) 能命中。
+#
+#   system：模板 → 呈現風格 → 重點關注項目 → 資料格式說明  (同模板、同設定時逐字相同)
+#   user  ：病患 ID 與各項資料                            (每次都不同)
+#
+#   - 所有固定內容先經過 canonicalize_text (統一換行、去除行尾空白與多餘空行)，
+#     在 UI 中編輯過但內容相同的模板也會得到相同前綴
+#   - 重點關注項目依固定順序排列，勾選順序不同不影響前綴
+#   - 回傳可快取前綴的 token 估計值與雜湊，方便確認同模板的請求確實共用前綴
+
+import re
+import hashlib
+import unicodedata
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 供應商通常要求前綴達一定長度才會快取 (以 token 計)
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+DEFAULT_SYSTEM_PROMPT = "你是專業醫療人員，請撰寫病程摘要。"
+
+# 呈現風格 (UI 的選項名稱 -> 附加在模板後的指令)
+STYLE_INSTRUCTIONS = {
+    "列點式 (Bullet Points)": "【格式要求】：請務必使用列點方式呈現，保持條理。",
+    "短文式 (Narrative)": "【格式要求】：請整合為一篇流暢的短文，禁止使用列點。",
+}
+
+# UI 預設選取的呈現風格 (第一個選項)；排程預產生也使用同一個，結果才能對應到 UI 的預設設定
+DEFAULT_STYLE_OPTION = next(iter(STYLE_INSTRUCTIONS))
+
+# 重點關注項目的固定排列順序 (與 UI 選項相同)，不在清單中的項目依字母順序排在最後
+FOCUS_ORDER = ["生命徵象趨勢", "檢驗報告異常值", "護理處置經過", "病患主訴", "管路狀況", "意識狀態(GCS)"]
+
+# 模板名稱關鍵字 -> 預設勾選的重點關注項目 (依序比對，第一個符合者為準)
+TEMPLATE_DEFAULT_FOCUS = [
+    ("會診", ["檢驗報告異常值", "生命徵象趨勢"]),
+    ("交班", ["護理處置經過", "意識狀態(GCS)"]),
+    ("出院", ["護理處置經過", "生命徵象趨勢"]),
+]
+
+# 固定的資料格式說明，放在前綴最後；內容不隨病患改變
+DATA_FORMAT_GUIDE = """【資料格式說明】
+使用者訊息會依序提供以下區塊 (沒有資料的區塊會省略)：
+- 【常用語對照】〈P1〉 = 原文；護理紀錄中的 〈P1〉 等代碼代表對應的原文
+- 【護理紀錄】時間 | 主訴 | 紀錄內容 (主訴與上一筆相同時寫為「同上」)
+- 【生理徵象】時間 | T 體溫 | P 脈搏 | R 呼吸 | BP 血壓 | SpO2 | GCS
+- 【檢驗報告】時間 | 項目 : 數值 單位 (Ref: 參考範圍) [異常標記]
+- 【檢查報告】時間 | 檢查名稱 : 報告摘錄
+- 【尚未收件的檢驗】申請時間 | 項目 (檢體)
+請只根據提供的資料撰寫，不要臆測資料中沒有的資訊。"""
+
+_TRAILING_SPACE_RE = re.compile(r"[ \t\u3000]+$", re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_CJK_RANGES = "\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef"
+_CJK_RE = re.compile(f"[{_CJK_RANGES}]")
+_WORD_RE = re.compile(f"[A-Za-z0-9_]+|[^\\sA-Za-z0-9_{_CJK_RANGES}]")
+
+_encoding = None
+
+
+# ==========================================
+# 1. 正規化與 token 估計
+# ==========================================
+
+def canonicalize_text(text):
+    """統一換行與 Unicode 形式，去除行尾空白、連續空行與首尾空白。"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFC", str(text)).replace("\r\n", "\n").replace("\r", "\n")
+    text = _TRAILING_SPACE_RE.sub("", text)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def count_tokens(text):
+    """
+    token 數。安裝 tiktoken 時使用 cl100k_base 編碼；
+    否則以「中日韓字元各 1、英數字詞與符號各 1」粗估 (各家模型的分詞不同，僅供參考)。
+    """
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text))
+    return len(_CJK_RE.findall(text)) + len(_WORD_RE.findall(text))
+
+
+# ==========================================
+# 2. 固定前綴 (system prompt)
+# ==========================================
+
+def apply_style(template_text, style_option):
+    """在模板後加上呈現風格指令 (UI 預覽用)。"""
+    instruction = STYLE_INSTRUCTIONS.get(style_option)
+    base = canonicalize_text(template_text)
+    return f"{base}\n\n{instruction}" if instruction else base
+
+
+def default_focus_areas(template_name):
+    """模板預設的重點關注項目 (UI 預設勾選與排程預產生共用)。"""
+    for keyword, areas in TEMPLATE_DEFAULT_FOCUS:
+        if keyword in (template_name or ""):
+            return list(areas)
+    return []
+
+
+def sort_focus_areas(focus_areas):
+    """依固定順序排列並去除重複的關注項目。"""
+    unique = {area.strip() for area in (focus_areas or []) if area and area.strip()}
+    known = [area for area in FOCUS_ORDER if area in unique]
+    return known + sorted(unique - set(FOCUS_ORDER))
+
+
+def build_focus_instruction(focus_areas):
+    areas = sort_focus_areas(focus_areas)
+    if not areas:
+        return ""
+    return (
+        "**【⚠️ 特別指令：重點關注項目】**\n"
+        "使用者要求你特別詳細分析以下面向，請務必在摘要中包含相關細節，並將其優先呈現：\n"
+        f"- {', '.join(areas)}"
+    )
+
+
+def build_system_prompt(template_text, focus_areas=None, extra_instructions=None, include_data_guide=True):
+    """
+    組出固定前綴：模板 (已含呈現風格) → 重點關注項目 → 其他指令 → 資料格式說明。
+    相同輸入一定得到逐字相同的結果。
+    """
+    sections = [canonicalize_text(template_text) or DEFAULT_SYSTEM_PROMPT]
+    focus_instruction = build_focus_instruction(focus_areas)
+    if focus_instruction:
+        sections.append(focus_instruction)
+    if extra_instructions:
+        sections.append(canonicalize_text(extra_instructions))
+    if include_data_guide:
+        sections.append(DATA_FORMAT_GUIDE)
+    return "\n\n".join(sections)
+
+
+# ==========================================
+# 3. 組合完整 Prompt
+# ==========================================
+
+def build_prompt(system_prompt, data_sections, header=None):
+    """
+    組合 system / user 訊息並計算前綴資訊。
+
+    Args:
+        system_prompt: build_system_prompt 的結果 (固定前綴)
+        data_sections: list of (標題, 內容行列表)；沒有內容的區塊會略過
+        header: (選用) user 訊息開頭，例如病患 ID
+
+    Returns:
+        dict: system, user, prefix_hash (前綴 SHA-1 前 12 碼), prefix_tokens, total_tokens, cacheable
+    """
+    blocks = [header] if header else []
+    for title, lines in data_sections:
+        if lines:
+            blocks.append(title + "\n" + "\n".join(lines))
+    user_prompt = "\n\n".join(blocks) + "\n"
+
+    prefix_tokens = count_tokens(system_prompt)
+    return {
+        "system": system_prompt,
+        "user": user_prompt,
+        "prefix_hash": hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()[:12],
+        "prefix_tokens": prefix_tokens,
+        "total_tokens": prefix_tokens + count_tokens(user_prompt),
+        "cacheable": prefix_tokens >= PROMPT_CACHE_MIN_TOKENS,
+    }
+
+
+def describe_prompt(prompt):
+    """一行摘要，供 log 使用。"""
+    ratio = prompt["prefix_tokens"] / prompt["total_tokens"] if prompt["total_tokens"] else 0
+    note = "" if prompt["cacheable"] else f"，未達快取門檻 {PROMPT_CACHE_MIN_TOKENS}"
+    return (f"前綴 {prompt['prefix_hash']}：約 {prompt['prefix_tokens']} tokens "
+            f"({ratio:.0%} / 總計約 {prompt['total_tokens']}{note})")
@@ -2,16 +2,26 @@
 
 import streamlit as st
 import os
-import pandas as pd
 import json
 from dotenv import load_dotenv
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 from feedback_component import show_feedback_ui
 
 # 引入後端模組
-from db.patient_service import get_patient_full_history, get_all_patients_overview
+from db.patient_service import (
+    get_patient_full_history, get_all_patients_overview, get_ward_board, search_clinical_text,
+    list_patient_encounters
+)
 from db.template_service import get_all_templates, create_template, update_template
-from ai.ai_summarizer import generate_nursing_summary
+from ai.ai_summarizer import generate_nursing_summary, generate_incremental_update, get_groq_api_key, is_failed_summary
+from ai.extractive_summarizer import generate_extractive_summary
+from ai.prompt_builder import apply_style, default_focus_areas, STYLE_INSTRUCTIONS, FOCUS_ORDER
+from db.migrations import run_migrations
+from db.job_queue import enqueue_summary_job, get_job, get_latest_summary, summary_params_key
+from data.time_utils import parse_his_datetime, format_display_time
+from db.feedback_analytics import (
+    get_template_quality_summary, get_template_daily_trend, get_recent_template_comments
+)
 
 # --- 設定網頁 ---
 st.set_page_config(page_title="AI 醫療模板系統", layout="wide", page_icon="")
@@ -30,6 +40,7 @@ if "last_style_option" not in st.session_state:
 # ===== 全域預設（避免 NameError）=====
 selected_info = None
 target_patient_id = None
+selected_encounter = None
 earliest_dt = None
 DB_HOST = st.secrets["database"]["host"]
 DB_PORT = st.secrets["database"]["port"]
@@ -38,36 +49,72 @@ DB_USER = st.secrets["database"]["user"]
 DB_PASSWORD = st.secrets["database"]["password"]
 
 # 讀取 GROQ API Key
-GROQ_API_KEY = st.secrets["groq"]["api_key"]
+GROQ_API_KEY = get_groq_api_key()
 TAB_LIBRARY = "模板庫管理"
 TAB_CREATE = "建立新模板"
+TAB_QUALITY = "模板品質分析"
+WARD_BOARD_REFRESH_SECONDS = 30
+JOB_POLL_SECONDS = 3
+JOB_PRIORITY_UI = 10
+# 預先產生的摘要超過此時間 (分) 就不再自動顯示
+PREGENERATED_MAX_AGE_MINUTES = 120
+SEARCH_RANGE_OPTIONS = {"24 小時內": 24, "3 天內": 72, "7 天內": 168, "不限": None}
 
 # ==========================================
 # 輔助函數
 # ==========================================
-def format_time_str(raw_time):
-    if not raw_time or len(str(raw_time)) < 12:
-        return raw_time
-    s = str(raw_time)
-    return f"{s[:4]}-{s[4:6]}-{s[6:8]} {s[8:10]}:{s[10:12]}"
+@st.cache_resource
+def init_database():
+    # 每個程序只執行一次 Schema 更新 (只含 DDL，既有資料回填另以指令分批執行)，之後的頁面渲染不再碰資料表結構
+    return run_migrations()
+
+init_database()
 
 @st.cache_data(ttl=60)
 def load_patient_list():
     raw_list = get_all_patients_overview()
     for p in raw_list:
-        p['最早紀錄_顯示'] = format_time_str(p['最早紀錄'])
-        p['最晚紀錄_顯示'] = format_time_str(p['最晚紀錄'])
+        p['最早紀錄_顯示'] = format_display_time(p['最早紀錄'])
+        p['最晚紀錄_顯示'] = format_display_time(p['最晚紀錄'])
         p['label'] = f"{p['病歷號']} (共 {p['資料筆數']} 筆資料)"
     return raw_list
 
 patients_list = load_patient_list()
 
+@st.cache_data(ttl=60)
+def load_encounters(patient_id):
+    return list_patient_encounters(patient_id)
+
+def encounter_label(enc, is_current):
+    span = f"{enc['start']:%Y-%m-%d %H:%M} ~ {enc['end']:%m-%d %H:%M}" if enc["start"] and enc["end"] else "時間不詳"
+    subject = (enc["subject"] or "")[:20]
+    suffix = " (目前就診)" if is_current else ""
+    return f"急診號 {enc['encounter_id']}｜{span}｜{subject}{suffix}"
+
+@st.cache_data(ttl=WARD_BOARD_REFRESH_SECONDS)
+def load_ward_board(active_hours):
+    # 多位使用者同時開著總覽時共用同一次查詢結果
+    board = get_ward_board(active_hours=active_hours)
+    for p in board:
+        p['最後護理紀錄'] = format_display_time(p['最後護理紀錄'])
+        p['生理測量時間'] = format_display_time(p['生理測量時間'])
+        p['GCS時間'] = format_display_time(p['GCS時間'])
+    return board
+
+@st.cache_data(ttl=60)
+def load_search_results(query, range_hours, include_reports):
+    since = datetime.now() - timedelta(hours=range_hours) if range_hours else None
+    hits = search_clinical_text(query, since=since, include_reports=include_reports)
+    for h in hits:
+        h['時間'] = format_display_time(h['時間'])
+    return hits
+
 # ==========================================
 # 側邊欄：全域導航
 # ==========================================
 with st.sidebar:
     st.title(" 醫療摘要系統")
-    app_mode = st.radio("請選擇功能模式：", [" 摘要生成器", " 模板設計師"], index=0)
+    app_mode = st.radio("請選擇功能模式：", [" 摘要生成器", " 病房總覽", " 紀錄搜尋", " 模板設計師"], index=0)
     st.divider()
 
 # ==============================================================================
@@ -83,16 +130,27 @@ if app_mode == " 摘要生成器":
     
     target_patient_id = None
     selected_info = None
+    selected_encounter = None
     if selected_label != "請選擇...":
         selected_info = next((p for p in patients_list if p['label'] == selected_label), None)
         target_patient_id = selected_info['病歷號']
         st.success(f"已選定：{target_patient_id}")
 
+        # 預設只看目前 (最近) 這次就診，過去就診的紀錄不必撈取、也不會送進 Prompt
+        encounters = load_encounters(target_patient_id)
+        if encounters:
+            encounter_options = [encounter_label(e, i == 0) for i, e in enumerate(encounters)] + ["全部就診"]
+            encounter_choice = st.selectbox(f"就診 (共 {len(encounters)} 次)：", encounter_options, index=0)
+            if encounter_choice != "全部就診":
+                selected_encounter = encounters[encounter_options.index(encounter_choice)]
+
+encounter_id = selected_encounter["encounter_id"] if selected_encounter else None
+
 earliest_dt = None
 
 if selected_info and selected_info.get("最早紀錄"):
     raw_time = selected_info["最早紀錄"]
-    earliest_dt = datetime.strptime(raw_time, "%Y%m%d%H%M%S")
+    earliest_dt = selected_encounter["start"] if selected_encounter else parse_his_datetime(raw_time)
 
     # 2. 選擇模板
     st.subheader("2. 選擇摘要模板")
@@ -106,22 +164,15 @@ if selected_info and selected_info.get("最早紀錄"):
     selected_template_name = st.selectbox("請選擇適用情境：", template_names, index=0)
 
     # 3. 呈現風格
-    style_option = st.radio("呈現風格：", ["列點式 (Bullet Points)", "短文式 (Narrative)"], horizontal=True)
+    style_option = st.radio("呈現風格：", list(STYLE_INSTRUCTIONS), horizontal=True)
 
     # ===== 模板或呈現風格變更時，自動刷新 Prompt =====
     if (
         selected_template_name != st.session_state.last_template_name
         or style_option != st.session_state.last_style_option
     ):
-        base_prompt = db_templates[selected_template_name]
-
-        style_instruction = (
-            "\n\n【格式要求】：請整合為一篇流暢的短文，禁止使用列點。"
-            if style_option == "短文式 (Narrative)"
-            else "\n\n【格式要求】：請務必使用列點方式呈現，保持條理。"
-        )
-
-        st.session_state.preview_prompt = base_prompt + style_instruction
+        # 風格指令由 prompt_builder 統一提供，相同模板 + 風格的前綴才會逐字相同
+        st.session_state.preview_prompt = apply_style(db_templates[selected_template_name], style_option)
         st.session_state.last_template_name = selected_template_name
         st.session_state.last_style_option = style_option
 
@@ -138,15 +189,8 @@ if selected_info and selected_info.get("最早紀錄"):
     st.subheader("4. 重點關注項目")
     st.write("請勾選 **重點關注項目** (AI 將加強分析)：")
     
-    focus_options = ["生命徵象趨勢", "檢驗報告異常值", "護理處置經過", "病患主訴", "管路狀況", "意識狀態(GCS)"]
-    
-    default_focus = []
-    if "會診" in selected_template_name:
-        default_focus = ["檢驗報告異常值", "生命徵象趨勢"]
-    elif "交班" in selected_template_name:
-        default_focus = ["護理處置經過", "意識狀態(GCS)"]
-    elif "出院" in selected_template_name:
-        default_focus = ["護理處置經過", "生命徵象趨勢"]
+    focus_options = FOCUS_ORDER
+    default_focus = default_focus_areas(selected_template_name)
     
     selected_focus_areas = []
     cols = st.columns(3)
@@ -154,10 +198,12 @@ if selected_info and selected_info.get("最早紀錄"):
         if cols[i % 3].checkbox(option, value=option in default_focus):
             selected_focus_areas.append(option)
 
+    labs_abnormal_only = st.checkbox("檢驗報告僅納入異常值 (依匯入時預先標記的旗標)", value=False)
+
     # 5. 時間範圍篩選
     with st.expander(" 時間範圍篩選 (選填)"):
         use_time_filter = st.checkbox("啟用篩選")
-        start_dt_str = None
+        start_dt = None
 
     if use_time_filter:
         default_date = earliest_dt.date() if earliest_dt else datetime.now().date()
@@ -167,32 +213,118 @@ if selected_info and selected_info.get("最早紀錄"):
         d1 = c1.date_input("開始日期", default_date)
         t1 = c2.time_input("開始時間", default_time)
 
-        start_dt_str = f"{d1.year}{d1.month:02d}{d1.day:02d}{t1.hour:02d}{t1.minute:02d}00"
+        start_dt = datetime.combine(d1, t1.replace(second=0))
 
-    # 6. 執行按鈕（使用編輯後 Prompt）
+    # 6. 已預先產生的摘要 (交班前排程或先前的背景工作)；只提供產生參數與目前設定相同的結果
     if target_patient_id:
-        if st.button(" 開始生成摘要", type="primary", use_container_width=True):
-            load_dotenv()
-            if not st.secrets["groq"]["api_key"]:
-                st.error("未設定 API Key")
-                st.stop()
-                
-            with st.spinner("正在分析資料並撰寫摘要..."):
-                p_data = get_patient_full_history(target_patient_id, start_time=start_dt_str)
+        pregenerated = get_latest_summary(
+            target_patient_id, selected_template_name,
+            summary_params_key(start_dt, None, labs_abnormal_only,
+                               st.session_state.preview_prompt, selected_focus_areas, encounter_id),
+            encounter_id=encounter_id, max_age_minutes=PREGENERATED_MAX_AGE_MINUTES
+        )
+        if pregenerated:
+            source_text = "交班前預先產生" if pregenerated["source"] == "schedule" else "背景產生"
+            data_until_text = f"{pregenerated['data_until']:%Y-%m-%d %H:%M}" if pregenerated["data_until"] else "不詳"
+            with st.expander(
+                f" 已有{source_text}的摘要 (產生於 {pregenerated['created_at']:%m-%d %H:%M}，資料截至 {data_until_text})",
+                expanded=True
+            ):
+                refresh_key = f"incremental_{pregenerated['job_id']}"
+                if st.button(" 增量更新 (只納入之後的新紀錄)", key=f"btn_{refresh_key}"):
+                    with st.spinner("正在讀取新紀錄並更新摘要..."):
+                        new_data = None
+                        if pregenerated["data_until"]:
+                            new_data = get_patient_full_history(
+                                target_patient_id,
+                                start_time=pregenerated["data_until"] + timedelta(seconds=1),
+                                encounter_id=encounter_id
+                            )
+                        st.session_state[refresh_key] = generate_incremental_update(
+                            target_patient_id, pregenerated["summary"], new_data,
+                            selected_template_name, summary_time=data_until_text
+                        )
+
+                st.markdown(st.session_state.get(refresh_key, pregenerated["summary"]))
+
+    # 7. 執行按鈕（使用編輯後 Prompt）
+    if target_patient_id:
+        run_in_background = st.checkbox(
+            "背景生成 (交由 worker 執行，離開頁面也不會中斷)", value=False
+        )
 
-                summary = generate_nursing_summary(
-                    target_patient_id,
-                    p_data,
-                    selected_template_name,
+        if run_in_background:
+            if st.button(" 送出背景摘要工作", type="primary", use_container_width=True):
+                job_id = enqueue_summary_job(
+                    target_patient_id, selected_template_name,
+                    start_time=start_dt, abnormal_only=labs_abnormal_only,
                     custom_system_prompt=st.session_state.preview_prompt,
-                    focus_areas=selected_focus_areas
+                    focus_areas=selected_focus_areas, priority=JOB_PRIORITY_UI, encounter_id=encounter_id
                 )
+                if job_id:
+                    st.session_state.summary_job_id = job_id
+                else:
+                    st.error("無法建立背景工作，請確認資料庫連線。")
+
+            if st.session_state.get("summary_job_id"):
+                # 只有這個區塊定時重跑，查詢工作狀態
+                @st.fragment(run_every=JOB_POLL_SECONDS)
+                def render_summary_job():
+                    job = get_job(st.session_state.summary_job_id)
+                    if not job:
+                        st.warning("找不到背景工作。")
+                        return
+                    if job["status"] == "done":
+                        st.markdown("###  生成結果")
+                        st.caption(f"背景工作 #{job['id']}｜完成於 {job['finished_at']:%Y-%m-%d %H:%M:%S}")
+                        st.markdown("---")
+                        st.markdown(job["summary"])
+                        show_feedback_ui(job["patient_id"], job["template_name"])
+                    elif job["status"] == "failed":
+                        st.error(f"背景工作 #{job['id']} 失敗：{job['error']}")
+                    else:
+                        status_text = "排隊中" if job["status"] == "queued" else "生成中"
+                        st.info(f"背景工作 #{job['id']} {status_text}... (每 {JOB_POLL_SECONDS} 秒自動更新)")
+
+                render_summary_job()
+
+        elif st.button(" 開始生成摘要", type="primary", use_container_width=True):
+            load_dotenv()
+            p_data = get_patient_full_history(
+                target_patient_id, start_time=start_dt, abnormal_only=labs_abnormal_only,
+                encounter_id=encounter_id
+            )
+
+            # 規則式摘要毫秒內完成：等待 AI 時先顯示，AI 無法使用時作為備援
+            quick_summary = generate_extractive_summary(
+                target_patient_id, p_data, selected_template_name, st.session_state.preview_prompt
+            )
+            st.markdown("###  生成結果")
+            st.markdown("---")
+            notice_area = st.empty()
+            result_area = st.empty()
+            result_area.markdown(quick_summary)
+
+            summary = None
+            if not get_groq_api_key():
+                notice_area.warning("未設定 API Key，以下為系統規則擷取的摘要。")
+            else:
+                with st.spinner("AI 正在撰寫摘要 (下方為規則擷取的預覽)..."):
+                    summary = generate_nursing_summary(
+                        target_patient_id,
+                        p_data,
+                        selected_template_name,
+                        custom_system_prompt=st.session_state.preview_prompt,
+                        focus_areas=selected_focus_areas
+                    )
 
-                st.markdown("###  生成結果")
-                st.markdown("---")
-                st.markdown(summary)
+                if is_failed_summary(summary):
+                    notice_area.warning(f"{summary}\n\n以下為系統規則擷取的摘要。")
+                else:
+                    result_area.markdown(summary)
 
-                show_feedback_ui(target_patient_id, template_names)
+            if summary and not is_failed_summary(summary):
+                show_feedback_ui(target_patient_id, selected_template_name)
 
                 
 
@@ -215,7 +347,7 @@ elif app_mode == " 模板設計師":
 
     tab = st.radio(
     "功能頁籤",
-    [TAB_LIBRARY, TAB_CREATE],
+    [TAB_LIBRARY, TAB_CREATE, TAB_QUALITY],
     horizontal=True,
     key="template_tab"
     )
@@ -269,6 +401,8 @@ elif app_mode == " 模板設計師":
                 mime_type = "text/plain"
 
                 if export_format == "CSV (Excel)":
+                    # pandas 只有匯出 CSV 時才需要
+                    import pandas as pd
                     df_export = pd.DataFrame(
                         export_templates.items(),
                         columns=["模板名稱", "System Prompt 內容"]
@@ -523,4 +657,99 @@ elif app_mode == " 模板設計師":
                 else:
                     st.error("建立失敗 (名稱可能重複)。")
             else:
-                st.warning("名稱與內容不得為空。")
\ No newline at end of file
+                st.warning("名稱與內容不得為空。")
+
+    # =======================
+    # Tab 3：模板品質分析
+    # =======================
+    elif st.session_state.template_tab == TAB_QUALITY:
+
+        st.markdown("####  模板回饋品質")
+        st.caption("資料來自每日預先彙總的回饋統計，不會掃描完整的回饋紀錄。")
+
+        quality_days = st.radio("統計區間：", [7, 30, 90], index=1, horizontal=True,
+                                format_func=lambda d: f"最近 {d} 天")
+        quality_rows = get_template_quality_summary(days=quality_days)
+
+        if not quality_rows:
+            st.info("此區間內尚無任何回饋。")
+        else:
+            df_quality = [
+                {
+                    "模板名稱": q["模板名稱"],
+                    "回饋筆數": q["回饋筆數"],
+                    "平均分數": q["平均分數"],
+                    **{f"{star}★": q["評分分布"][star] for star in range(1, 6)},
+                    "留言筆數": q["留言筆數"],
+                    "最近回饋日": q["最近回饋日"],
+                }
+                for q in quality_rows
+            ]
+            st.dataframe(df_quality, hide_index=True, use_container_width=True)
+
+            quality_target = st.selectbox("查看單一模板趨勢：", [q["模板名稱"] for q in quality_rows])
+            trend_rows = get_template_daily_trend(quality_target, days=quality_days)
+            if trend_rows:
+                st.line_chart(trend_rows, x="日期", y=["平均分數"])
+                st.bar_chart(trend_rows, x="日期", y=["回饋筆數", "留言筆數"])
+
+            with st.expander("最近的文字回饋"):
+                for c in get_recent_template_comments(quality_target):
+                    st.markdown(f"**{c['時間']:%Y-%m-%d %H:%M}** ｜ 評分 {c['評分']}\n\n{c['意見']}")
+                    st.divider()
+
+# ==============================================================================
+# 模式 C：病房總覽 (Ward Board)
+# ==============================================================================
+elif app_mode == " 病房總覽":
+    st.header(" 急診病房即時總覽")
+
+    board_hours = st.select_slider(
+        "顯示最近多久內仍有護理紀錄的病患：",
+        options=[6, 12, 24, 48, 72],
+        value=24,
+        format_func=lambda h: f"{h} 小時"
+    )
+
+    # 只有這個區塊會定時重跑，頁面其餘部分不受影響
+    @st.fragment(run_every=WARD_BOARD_REFRESH_SECONDS)
+    def render_ward_board():
+        board = load_ward_board(board_hours)
+        st.caption(f"共 {len(board)} 位病患｜每 {WARD_BOARD_REFRESH_SECONDS} 秒自動更新｜最後更新 {datetime.now():%H:%M:%S}")
+
+        if not board:
+            st.info("目前沒有符合條件的病患。")
+            return
+
+        st.dataframe(
+            board,
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                "異常檢驗數": st.column_config.NumberColumn(format="%d ⚠️"),
+                "距上次紀錄(分)": st.column_config.NumberColumn(format="%d 分"),
+            }
+        )
+
+    render_ward_board()
+
+# ==============================================================================
+# 模式 D：紀錄搜尋 (跨病患全文搜尋)
+# ==============================================================================
+elif app_mode == " 紀錄搜尋":
+    st.header(" 護理紀錄 / 檢查報告搜尋")
+
+    col_q, col_range = st.columns([3, 1])
+    with col_q:
+        search_query = st.text_input("關鍵字 (多個關鍵字以空白分隔，需全部符合)：", placeholder="例如：心導管、GCS：E1")
+    with col_range:
+        search_range = st.selectbox("時間範圍：", list(SEARCH_RANGE_OPTIONS.keys()), index=0)
+    search_reports = st.checkbox("一併搜尋檢查報告內容", value=True)
+
+    if search_query.strip():
+        results = load_search_results(search_query.strip(), SEARCH_RANGE_OPTIONS[search_range], search_reports)
+        st.caption(f"共 {len(results)} 筆符合")
+        if results:
+            st.dataframe(results, hide_index=True, use_container_width=True)
+        else:
+            st.info("查無符合的紀錄。")
@@ -0,0 +1,78 @@
+# check_import_time.py
+
+# 啟動時間檢查：以全新的 Python 程序 (python -X importtime) 量測核心模組的冷啟動匯入時間，
+# 並確認它們沒有順帶載入 UI / 重量級套件。超過預算或載入了禁止的套件時以非 0 結束，
+# 可放在 CI 或部署前執行。
+#
+# 用法：
+#   python check_import_time.py
+#   IMPORT_BUDGET_MS=500 python check_import_time.py
+
+import os
+import re
+import sys
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "400"))
+
+# 模組 -> (匯入時間預算 ms, 不得在匯入時載入的套件)
+CHECKS = {
+    "ai.ai_summarizer": (DEFAULT_BUDGET_MS, ["streamlit", "openai", "pandas"]),
+    "db.patient_service": (DEFAULT_BUDGET_MS, ["streamlit", "openai", "pandas"]),
+    "data.csv_index": (DEFAULT_BUDGET_MS, ["streamlit", "openai", "pandas", "psycopg2"]),
+    "main": (DEFAULT_BUDGET_MS, ["streamlit", "pandas"]),
+}
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(module, forbidden):
+    """
+    在子程序中匯入 module，回傳 (累計匯入時間 ms, 被載入的禁止套件, 錯誤訊息)。
+    """
+    probe = (
+        f"import sys, importlib; importlib.import_module({module!r}); "
+        f"print(','.join(m for m in {forbidden!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=ROOT_DIR, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return None, [], proc.stderr.strip().splitlines()[-1] if proc.stderr else "匯入失敗"
+
+    cumulative_us = 0
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        # 縮排最淺 (頂層) 的 import 才計入，避免巢狀匯入重複累加
+        if match and len(match.group(3)) == 1:
+            cumulative_us += int(match.group(2))
+    loaded = [m for m in proc.stdout.strip().split(",") if m]
+    return cumulative_us / 1000, loaded, None
+
+
+def main():
+    failed = False
+    print(f"{'模組':<22}{'匯入時間':>10}  {'預算':>8}  結果")
+    for module, (budget_ms, forbidden) in CHECKS.items():
+        elapsed_ms, loaded, error = measure(module, forbidden)
+        if error:
+            print(f"{module:<22}{'-':>10}  {budget_ms:>6.0f}ms  ❌ {error}")
+            failed = True
+            continue
+
+        problems = []
+        if elapsed_ms > budget_ms:
+            problems.append("超過預算")
+        if loaded:
+            problems.append(f"載入了 {', '.join(loaded)}")
+        status = "✅" if not problems else "❌ " + "；".join(problems)
+        failed = failed or bool(problems)
+        print(f"{module:<22}{elapsed_ms:>8.1f}ms  {budget_ms:>6.0f}ms  {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
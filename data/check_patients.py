@@ -1,7 +1,32 @@
-# check_patients.py (自動搜尋路徑版)
+# check_patients.py (平行掃描版)
+#
+# 掃描 HIS 匯出的五個 CSV，統計每位病患的最早 / 最晚時間、資料筆數與來源檔案。
+# - 每個檔案依位元組範圍切塊，多個行程平行處理，最後合併各塊的部分統計
+# - 有安裝 pyarrow 時使用欄位式 CSV 讀取 (只解析病歷號與時間兩欄)，否則退回 csv 模組
+# - 自動判斷 UTF-8 / UTF-8 BOM / Big5 (cp950) 編碼
+#
+# 用法 (在專案根目錄以模組方式執行；直接執行 python data/check_patients.py 時找不到 data 套件)：
+#   python -m data.check_patients [--data-dir DIR] [--workers N] [--chunk-mb MB]
+#                                 [--json out.json] [--parquet out.parquet] [--quiet]
 
+import argparse
+import codecs
 import csv
+import io
+import json
+import mmap
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from data.time_utils import format_his_datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
 
 # 定義檔案名稱設定
 FILES_CONFIG = {
@@ -12,81 +37,281 @@ FILES_CONFIG = {
     'DB_ADM_ORDER_ER-急診檢驗檢查主檔.csv': {'id_idx': 1, 'time_idx': 3}
 }
 
-def find_file_path(filename):
-    """嘗試在 'data' 資料夾或 '目前目錄' 尋找檔案"""
-    # 1. 檢查 data/ 資料夾
-    path_in_data = os.path.join('data', filename)
-    if os.path.exists(path_in_data):
-        return path_in_data
-    
-    # 2. 檢查目前目錄 (根目錄)
-    path_in_root = filename
-    if os.path.exists(path_in_root):
-        return path_in_root
-        
+DEFAULT_CHUNK_MB = 64
+SAMPLE_BYTES = 1 << 16
+
+
+def find_file_path(filename, data_dir=None):
+    """嘗試在指定資料夾、'data' 資料夾或 '目前目錄' 尋找檔案"""
+    candidates = []
+    if data_dir:
+        candidates.append(os.path.join(data_dir, filename))
+    candidates += [
+        os.path.join('data', filename),
+        filename,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), filename),
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
     return None
 
-def scan_patients():
+
+# ==========================================
+# 1. 編碼判斷與切塊
+# ==========================================
+
+def detect_encoding(filepath):
+    """讀取檔案開頭判斷編碼：UTF-8 BOM -> utf-8-sig，能以 UTF-8 解碼 -> utf-8，否則視為 Big5 (cp950)。"""
+    with open(filepath, 'rb') as f:
+        sample = f.read(SAMPLE_BYTES)
+
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    for encoding in ('utf-8', 'cp950', 'big5'):
+        try:
+            # final=False：樣本尾端被截斷的多位元組字元不算錯誤
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return 'latin-1'
+
+
+def chunk_ranges(filepath, chunk_bytes):
+    """
+    將檔案切成約 chunk_bytes 大小的位元組範圍，切點一律落在「引號外」的換行之後，
+    避免把含換行的引號欄位 (例如護理紀錄全文) 切成兩半。
+    UTF-8 與 Big5 的多位元組字元都不會出現 0x0A / 0x22，可直接以位元組判斷。
+    """
+    size = os.path.getsize(filepath)
+    if size <= chunk_bytes:
+        return [(0, size)]
+
+    bounds = [0]
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos, quotes = 0, 0
+        while bounds[-1] + chunk_bytes < size:
+            target = bounds[-1] + chunk_bytes
+            quotes += mm[pos:target].count(b'"')
+            pos = target
+            # 往後找到第一個「累計引號數為偶數」的換行
+            while pos < size:
+                nl = mm.find(b'\n', pos)
+                end = size if nl == -1 else nl + 1
+                quotes += mm[pos:end].count(b'"')
+                pos = end
+                if quotes % 2 == 0:
+                    break
+            if pos >= size:
+                break
+            bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# ==========================================
+# 2. 單一區塊的部分統計 (在子行程中執行)
+# ==========================================
+
+def _read_chunk_bytes(filepath, start, end, encoding):
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start)
+    if encoding in ('utf-8', 'utf-8-sig'):
+        return raw[3:] if raw.startswith(codecs.BOM_UTF8) else raw
+    # Big5 等編碼先轉成 UTF-8，讓兩條解析路徑都只需處理 UTF-8
+    return raw.decode(encoding, errors='replace').encode('utf-8')
+
+
+def _aggregate_arrow(raw, id_idx, time_idx):
+    """pyarrow 欄位式讀取：只轉換病歷號與時間兩欄，統計也在 Arrow 內完成。"""
+    invalid_rows = []
+
+    def on_invalid(row):
+        invalid_rows.append(row)
+        return 'skip'
+
+    id_col, time_col = f"f{id_idx}", f"f{time_idx}"
+    table = pa_csv.read_csv(
+        io.BytesIO(raw),
+        read_options=pa_csv.ReadOptions(autogenerate_column_names=True, use_threads=False),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=on_invalid),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=[id_col, time_col],
+            column_types={id_col: pa.string(), time_col: pa.string()},
+        ),
+    )
+    if invalid_rows:
+        # 欄位數不一致的列無法在 Arrow 內處理，整塊改走 csv 模組以免漏算
+        return None
+
+    ids = pc.utf8_trim_whitespace(table[id_col])
+    times = pc.utf8_trim_whitespace(table[time_col])
+    valid = pc.and_(
+        pc.greater(pc.utf8_length(ids), 0),
+        pc.match_substring_regex(times, r'^[0-9]{12}([0-9]{2})?$'),
+    )
+    ids = pc.filter(ids, valid)
+    times = pc.filter(times, valid)
+    # 12 碼時間補成 14 碼，跨檔比較才一致
+    times = pc.if_else(pc.equal(pc.utf8_length(times), 12),
+                       pc.binary_join_element_wise(times, '00', ''), times)
+
+    grouped = pa.table({"id": ids, "t": times}).group_by("id").aggregate(
+        [("t", "min"), ("t", "max"), ("t", "count")]
+    )
+    return {
+        pat_id: [start, end, count]
+        for pat_id, start, end, count in zip(
+            grouped["id"].to_pylist(), grouped["t_min"].to_pylist(),
+            grouped["t_max"].to_pylist(), grouped["t_count"].to_pylist()
+        )
+    }
+
+
+def _aggregate_python(raw, id_idx, time_idx):
+    partial = {}
+    reader = csv.reader(io.StringIO(raw.decode('utf-8', errors='replace')))
+    for row in reader:
+        if len(row) <= max(id_idx, time_idx):
+            continue
+        pat_id = row[id_idx].strip()
+        time_str = format_his_datetime(row[time_idx])
+        if not pat_id or not time_str:
+            continue
+        p = partial.get(pat_id)
+        if p is None:
+            partial[pat_id] = [time_str, time_str, 1]
+        else:
+            if time_str < p[0]: p[0] = time_str
+            if time_str > p[1]: p[1] = time_str
+            p[2] += 1
+    return partial
+
+
+def scan_chunk(task):
+    """子行程入口：回傳 (來源名稱, {病歷號: [最早, 最晚, 筆數]})"""
+    filepath, source, encoding, start, end, id_idx, time_idx = task
+    raw = _read_chunk_bytes(filepath, start, end, encoding)
+    partial = _aggregate_arrow(raw, id_idx, time_idx) if pa is not None else None
+    if partial is None:
+        partial = _aggregate_python(raw, id_idx, time_idx)
+    return source, partial
+
+
+# ==========================================
+# 3. 主流程：切塊 -> 平行掃描 -> 合併
+# ==========================================
+
+def merge_partials(results):
     patients = {}
-    print(f"目前工作目錄: {os.getcwd()}")
-    print("-" * 80)
-    print(f"{'病歷號':<12} | {'最早時間':<16} | {'最晚時間':<16} | {'資料筆數':<5} | {'來源檔案'}")
-    print("-" * 80)
+    for source, partial in results:
+        for pat_id, (start, end, count) in partial.items():
+            p = patients.get(pat_id)
+            if p is None:
+                patients[pat_id] = {'start': start, 'end': end, 'count': count, 'sources': {source}}
+                continue
+            if start < p['start']: p['start'] = start
+            if end > p['end']: p['end'] = end
+            p['count'] += count
+            p['sources'].add(source)
+    return patients
 
-    files_found_count = 0
 
+def scan_patients(data_dir=None, workers=None, chunk_mb=DEFAULT_CHUNK_MB, verbose=True):
+    """
+    平行掃描所有 CSV 並回傳 {病歷號: {'start', 'end', 'count', 'sources'}}。
+    找不到任何檔案時回傳 None。
+    """
+    tasks = []
     for filename, config in FILES_CONFIG.items():
-        # 自動尋找檔案位置
-        filepath = find_file_path(filename)
-        
+        filepath = find_file_path(filename, data_dir)
         if not filepath:
-            print(f"找不到檔案: {filename}")
+            if verbose: print(f"找不到檔案: {filename}")
             continue
-            
-        files_found_count += 1
-        
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                for row in reader:
-                    if not row: continue
-                    try:
-                        pat_id = row[config['id_idx']].strip()
-                        time_str = row[config['time_idx']].strip()
-                        
-                        if not pat_id or time_str in ['(null)', '', None]: continue
-                            
-                        if pat_id not in patients:
-                            patients[pat_id] = {'start': time_str, 'end': time_str, 'count': 0, 'sources': set()}
-                        
-                        p = patients[pat_id]
-                        p['count'] += 1
-                        p['sources'].add(filename.split('-')[0])
-                        
-                        if time_str < p['start']: p['start'] = time_str
-                        if time_str > p['end']: p['end'] = time_str
-                        
-                    except IndexError:
-                        continue
-        except UnicodeDecodeError:
-            # 嘗試 Big5
-             try:
-                with open(filepath, 'r', encoding='big5') as f:
-                    reader = csv.reader(f)
-                    # ... (簡化版：僅為偵測，略過 Big5 重複邏輯以節省篇幅) ...
-                    pass
-             except: pass
-
-    if files_found_count == 0:
+
+        encoding = detect_encoding(filepath)
+        ranges = chunk_ranges(filepath, int(chunk_mb * 1024 * 1024))
+        if verbose: print(f"{filename}: 編碼 {encoding}，切成 {len(ranges)} 塊")
+        source = filename.split('-')[0]
+        for start, end in ranges:
+            tasks.append((filepath, source, encoding, start, end, config['id_idx'], config['time_idx']))
+
+    if not tasks:
+        return None
+
+    # 只有少量區塊時直接在本行程處理，省去建立子行程的成本
+    if len(tasks) <= 1 or workers == 1:
+        results = [scan_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(scan_chunk, tasks))
+
+    return merge_partials(results)
+
+
+def write_json(patients, path):
+    payload = [
+        {"patient_id": pat_id, "start": info['start'], "end": info['end'],
+         "count": info['count'], "sources": sorted(info['sources'])}
+        for pat_id, info in sorted(patients.items())
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def write_parquet(patients, path):
+    if pa is None:
+        raise RuntimeError("輸出 Parquet 需要安裝 pyarrow")
+    import pyarrow.parquet as pq
+    ids = sorted(patients)
+    table = pa.table({
+        "patient_id": ids,
+        "start": [patients[i]['start'] for i in ids],
+        "end": [patients[i]['end'] for i in ids],
+        "count": pa.array([patients[i]['count'] for i in ids], type=pa.int64()),
+        "sources": [sorted(patients[i]['sources']) for i in ids],
+    })
+    pq.write_table(table, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="掃描 HIS 匯出 CSV 的病患清單")
+    parser.add_argument("--data-dir", help="CSV 所在資料夾 (預設自動尋找)")
+    parser.add_argument("--workers", type=int, default=None, help="平行行程數 (預設為 CPU 數)")
+    parser.add_argument("--chunk-mb", type=float, default=DEFAULT_CHUNK_MB, help="每塊大小 (MB)")
+    parser.add_argument("--json", help="將結果輸出為 JSON")
+    parser.add_argument("--parquet", help="將結果輸出為 Parquet (需要 pyarrow)")
+    parser.add_argument("--quiet", action="store_true", help="不在終端機列出病患清單")
+    args = parser.parse_args(argv)
+
+    print(f"目前工作目錄: {os.getcwd()}")
+    print(f"CSV 解析器: {'pyarrow' if pa is not None else 'csv 模組'}")
+    patients = scan_patients(args.data_dir, args.workers, args.chunk_mb)
+
+    if patients is None:
         print("\n錯誤：完全找不到任何 CSV 檔案！")
         print("請確認您是否已經將 CSV 檔案拖入 VS Code 的專案資料夾中。")
-        return
+        return 1
+
+    if args.json:
+        write_json(patients, args.json)
+        print(f"已輸出 JSON: {args.json}")
+    if args.parquet:
+        write_parquet(patients, args.parquet)
+        print(f"已輸出 Parquet: {args.parquet}")
+
+    if not args.quiet:
+        print("-" * 80)
+        print(f"{'病歷號':<12} | {'最早時間':<16} | {'最晚時間':<16} | {'資料筆數':<5} | {'來源檔案'}")
+        print("-" * 80)
+        sorted_patients = sorted(patients.items(), key=lambda x: x[1]['count'], reverse=True)
+        for pat_id, info in sorted_patients:
+            sources_str = ", ".join(sorted(info['sources']))
+            print(f"{pat_id:<12} | {info['start']:<16} | {info['end']:<16} | {info['count']:<8} | {sources_str}")
+    return 0
 
-    # 輸出結果
-    sorted_patients = sorted(patients.items(), key=lambda x: x[1]['count'], reverse=True)
-    for pat_id, info in sorted_patients:
-        sources_str = ", ".join(info['sources'])
-        print(f"{pat_id:<12} | {info['start']:<16} | {info['end']:<16} | {info['count']:<8} | {sources_str}")
 
 if __name__ == '__main__':
-    scan_patients()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,460 @@
+# /data/csv_index.py
+
+# 不經資料庫、直接從 HIS 匯出 CSV 查詢單一病患資料。
+#
+# 1. build_index()：為每個 CSV 建立旁邊的 .idx 索引檔，記錄「病歷號 -> 依時間排序的列位元組位置」
+# 2. CsvHistoryProvider：以 mmap 開啟 CSV，只讀取該病患的列，
+#    回傳格式與 db.patient_service.get_patient_full_history 完全相同
+#
+# 用法 (在專案根目錄)：
+#   python -m data.csv_index build            # 建立 / 更新 data/ 下所有 CSV 的索引
+#   python -m data.csv_index show 0002452972  # 直接查詢一位病患
+
+import os
+import csv
+import io
+import sys
+import json
+import mmap
+import bisect
+import struct
+from datetime import datetime
+
+from data.check_patients import detect_encoding
+from data.lab_normalizer import evaluate_lab, ABNORMAL_FLAGS
+from data.time_utils import parse_his_datetime, format_his_datetime
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INDEX_MAGIC = b"HISIDX01"
+# 每筆索引：時間 (YYYYMMDDHHMMSS 整數)、列起始位元組、列長度
+RECORD = struct.Struct("<qQI")
+
+# 各 CSV 的欄位順序 (與 data_processor 匯入時相同)
+TABLE_LAYOUTS = {
+    "nursing": {
+        "filename": "ENSDATA-急診護理紀錄.csv",
+        "columns": ["TRINO", "PATID", "VISITDT", "SEQ", "SUBJECT", "PROCDTTM",
+                    "DIAGNOSIS", "CLOSE", "FIINISH"],
+        "id_col": "PATID", "time_col": "PROCDTTM", "encounter_col": "TRINO",
+    },
+    "vitals": {
+        "filename": "v_ai_hisensnes-急診生理監測-.csv",
+        "columns": ["TRINO", "PATID", "VISITDT", "EWEIGHT", "ETEMPUTER", "ETREGION", "EPLUSE",
+                    "EBREATHE", "EPRESSURE", "EDIASTOLIC", "ESAO2", "GCS_E", "GCS_V", "GCS_M",
+                    "PUPIL_L", "PUPIL_R", "ENESKIND", "PROCDTTM"],
+        "id_col": "PATID", "time_col": "PROCDTTM", "encounter_col": "TRINO",
+    },
+    "labs": {
+        "filename": "DB_ADM_LABDATA_ER-急診檢驗明細.csv",
+        "columns": ["CHAD1CASENO", "CHMRNO", "CHGREQNO", "CHAPPDTM", "CHRCPDTM",
+                    "CHLREQNO", "CHORDNO", "CHITEMNO", "CHHEAD", "CHTEAMNAM",
+                    "CHSTAT", "CHSPECI", "CHVAL", "CHUNIT", "CHCOMMT",
+                    "CHNL", "CHNH", "CHITEMSEQ", "CHREPORTDATE", "CHTEXT",
+                    "CHSIGNDTTM", "CHLABAPCODE"],
+        "id_col": "CHMRNO", "time_col": "CHRCPDTM", "encounter_col": "CHAD1CASENO",
+    },
+    "lab_orders": {
+        "filename": "DB_ADM_LABORDER_ER-急診檢驗頭檔.csv",
+        "columns": ["CHCASENO", "CHMRNO", "CHGREQNO", "CHAPPDTM", "CHLREQNO", "CHORDNO", "CHORDNAM",
+                    "CHTEAMNAM", "CHSTAT", "CHSPECI", "SOURCETYPE", "ORDSEQ", "CHTAPPDT", "CHRCPDTM",
+                    "CHRCONNAME", "CONCODE", "LABMCHNO", "LABUNIFNO", "LABCLASS", "ORDPROCDTTM"],
+        "id_col": "CHMRNO", "time_col": "CHAPPDTM", "encounter_col": "CHCASENO",
+    },
+    "orders": {
+        "filename": "DB_ADM_ORDER_ER-急診檢驗檢查主檔.csv",
+        "columns": ["CHAD1CASENO", "CHAD1MRNO", "CHAD4GREQNO", "CHAD4CDATE", "CHAD1ORDNO",
+                    "CHAD4ORDNAME", "CHTEAMNAM", "CHAD4SPECT", "CHAD4DCDATE", "CHAD4STAT",
+                    "CHAD4REP1", "CHRCPDTM", "CHREPORTDATE", "CHTEXT", "SOURCETYPE"],
+        "id_col": "CHAD1MRNO", "time_col": "CHAD4CDATE", "encounter_col": "CHAD1CASENO",
+    },
+}
+
+
+def _clean(val):
+    return None if val is None or val.strip() in ['(null)', ''] else val
+
+
+def _time_key(raw):
+    """HIS 時間字串 -> 14 碼整數 (可直接比較大小)；無法解析回傳 0。"""
+    text = format_his_datetime(raw)
+    return int(text) if text else 0
+
+
+# ==========================================
+# 1. 建立索引
+# ==========================================
+
+def _iter_row_spans(mm):
+    """逐列回傳 (起始位元組, 長度)；引號內的換行視為同一列。"""
+    size = len(mm)
+    pos = 0
+    while pos < size:
+        start, quotes = pos, 0
+        while pos < size:
+            nl = mm.find(b"\n", pos)
+            end = size if nl == -1 else nl + 1
+            quotes += mm[pos:end].count(b'"')
+            pos = end
+            if quotes % 2 == 0:
+                break
+        yield start, pos - start
+
+
+def _parse_row(raw_bytes, encoding):
+    text = raw_bytes.decode(encoding, errors="replace")
+    return next(csv.reader(io.StringIO(text)), [])
+
+
+def index_path_for(csv_path):
+    return csv_path + ".idx"
+
+
+def build_index(csv_path, id_idx, time_idx):
+    """
+    為單一 CSV 建立 .idx 索引檔。
+
+    Returns:
+        int: 已索引的列數
+    """
+    encoding = detect_encoding(csv_path)
+    stat = os.stat(csv_path)
+    entries = {}
+
+    with open(csv_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for offset, length in _iter_row_spans(mm):
+            row = _parse_row(mm[offset:offset + length], encoding)
+            if len(row) <= max(id_idx, time_idx):
+                continue
+            pat_id = row[id_idx].strip()
+            if not pat_id:
+                continue
+            entries.setdefault(pat_id, []).append((_time_key(row[time_idx]), offset, length))
+
+    patients = {}
+    records = bytearray()
+    position = 0
+    for pat_id in sorted(entries):
+        rows = sorted(entries[pat_id])
+        patients[pat_id] = [position, len(rows)]
+        for ts, offset, length in rows:
+            records += RECORD.pack(ts, offset, length)
+        position += len(rows)
+
+    header = json.dumps({
+        "csv_size": stat.st_size,
+        "csv_mtime_ns": stat.st_mtime_ns,
+        "encoding": encoding,
+        "patients": patients,
+    }, ensure_ascii=False).encode("utf-8")
+
+    tmp_path = index_path_for(csv_path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(records)
+    os.replace(tmp_path, index_path_for(csv_path))
+    return position
+
+
+def build_all_indexes(data_dir=DATA_DIR, force=False):
+    """為 data_dir 下所有已知的 CSV 建立索引；未變更的檔案會略過。"""
+    for stream, layout in TABLE_LAYOUTS.items():
+        csv_path = os.path.join(data_dir, layout["filename"])
+        if not os.path.exists(csv_path):
+            print(f"找不到檔案: {layout['filename']}")
+            continue
+        if not force and _load_index(csv_path) is not None:
+            print(f"索引已是最新: {layout['filename']}")
+            continue
+        count = build_index(csv_path, layout["columns"].index(layout["id_col"]),
+                            layout["columns"].index(layout["time_col"]))
+        print(f"已建立索引: {layout['filename']} ({count} 列)")
+
+
+def _load_index(csv_path):
+    """讀取索引檔；不存在或與 CSV 不一致 (大小 / 修改時間不同) 時回傳 None。"""
+    idx_path = index_path_for(csv_path)
+    if not os.path.exists(idx_path):
+        return None
+    with open(idx_path, "rb") as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            return None
+        header_len = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+
+    stat = os.stat(csv_path)
+    if header["csv_size"] != stat.st_size or header["csv_mtime_ns"] != stat.st_mtime_ns:
+        return None
+    header["records_offset"] = len(INDEX_MAGIC) + 4 + header_len
+    return header
+
+
+# ==========================================
+# 2. 以索引查詢的歷史資料提供者
+# ==========================================
+
+class _IndexedCsv:
+    """單一 CSV + 索引的 mmap 讀取器。"""
+
+    def __init__(self, csv_path, layout, build_missing=True):
+        self.layout = layout
+        self.columns = layout["columns"]
+        header = _load_index(csv_path)
+        if header is None:
+            if not build_missing:
+                raise FileNotFoundError(f"索引不存在或已過期: {index_path_for(csv_path)}")
+            build_index(csv_path, self.columns.index(layout["id_col"]), self.columns.index(layout["time_col"]))
+            header = _load_index(csv_path)
+
+        self.encoding = header["encoding"]
+        self.patients = header["patients"]
+        self._records_offset = header["records_offset"]
+
+        self._csv_file = open(csv_path, "rb")
+        self._idx_file = open(index_path_for(csv_path), "rb")
+        self._csv_mm = mmap.mmap(self._csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._idx_mm = mmap.mmap(self._idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def rows(self, patient_id, start_key=None, end_key=None):
+        """回傳該病患在時間範圍內的所有列 (dict)，依時間排序。"""
+        entry = self.patients.get(patient_id)
+        if not entry:
+            return []
+        first, count = entry
+        base = self._records_offset + first * RECORD.size
+        records = [RECORD.unpack_from(self._idx_mm, base + i * RECORD.size) for i in range(count)]
+
+        keys = [r[0] for r in records]
+        lo = bisect.bisect_left(keys, start_key) if start_key else 0
+        hi = bisect.bisect_right(keys, end_key) if end_key else len(keys)
+
+        result = []
+        for _, offset, length in records[lo:hi]:
+            row = _parse_row(self._csv_mm[offset:offset + length], self.encoding)
+            row += [None] * (len(self.columns) - len(row))
+            result.append({col: _clean(val) for col, val in zip(self.columns, row)})
+        return result
+
+    def close(self):
+        self._csv_mm.close()
+        self._idx_mm.close()
+        self._csv_file.close()
+        self._idx_file.close()
+
+
+class CsvHistoryProvider:
+    """
+    直接讀取 HIS 匯出 CSV 的病患資料來源，介面與 db.patient_service 相同，
+    可在沒有 PostgreSQL 的環境 (離線開發、匯入前檢查) 使用。
+    """
+
+    def __init__(self, data_dir=DATA_DIR, build_missing=True):
+        self.data_dir = data_dir
+        self.build_missing = build_missing
+        self._tables = {}
+
+    def _table(self, stream):
+        if stream not in self._tables:
+            layout = TABLE_LAYOUTS[stream]
+            csv_path = os.path.join(self.data_dir, layout["filename"])
+            if not os.path.exists(csv_path):
+                self._tables[stream] = None
+            else:
+                self._tables[stream] = _IndexedCsv(csv_path, layout, self.build_missing)
+        return self._tables[stream]
+
+    def _rows(self, stream, patient_id, start_key, end_key, encounter_id=None):
+        table = self._table(stream)
+        if not table:
+            return []
+        rows = table.rows(patient_id, start_key, end_key)
+        if encounter_id:
+            # 索引以病歷號為鍵，單次就診在該病患的列中再篩選
+            column = TABLE_LAYOUTS[stream]["encounter_col"]
+            rows = [row for row in rows if (row[column] or "").strip() == str(encounter_id)]
+        return rows
+
+    def get_patient_full_history(self, patient_id, start_time=None, end_time=None, abnormal_only=False,
+                                 encounter_id=None):
+        """回傳格式同 db.patient_service.get_patient_full_history。"""
+        start_dt = parse_his_datetime(start_time)
+        end_dt = parse_his_datetime(end_time)
+        if (start_time and not start_dt) or (end_time and not end_dt):
+            print(f"時間格式錯誤: {start_time} ~ {end_time}")
+            return None
+
+        start_key = int(start_dt.strftime("%Y%m%d%H%M%S")) if start_dt else None
+        # 檢驗時間只到「分」，起始時間截到分鐘 (與資料庫版本相同的範圍語意)
+        lab_start_key = int(start_dt.strftime("%Y%m%d%H%M00")) if start_dt else None
+        end_key = int(end_dt.strftime("%Y%m%d%H%M%S")) if end_dt else None
+
+        patient_data = {"nursing": [], "vitals": [], "labs": [], "orders": [], "lab_orders": []}
+
+        for row in self._rows("nursing", patient_id, start_key, end_key, encounter_id):
+            patient_data["nursing"].append({
+                "PROCDTTM": row["PROCDTTM"],
+                "SUBJECT": row["SUBJECT"],
+                "DIAGNOSIS": row["DIAGNOSIS"]
+            })
+
+        for row in self._rows("vitals", patient_id, start_key, end_key, encounter_id):
+            patient_data["vitals"].append({
+                "PROCDTTM": row["PROCDTTM"],
+                "ETEMPUTER": row["ETEMPUTER"],
+                "EPLUSE": row["EPLUSE"],
+                "EBREATHE": row["EBREATHE"],
+                "EPRESSURE": row["EPRESSURE"],
+                "EDIASTOLIC": row["EDIASTOLIC"],
+                "ESAO2": row["ESAO2"],
+                "GCS": f"E{row['GCS_E']}V{row['GCS_V']}M{row['GCS_M']}"
+            })
+
+        for row in self._rows("labs", patient_id, lab_start_key, end_key, encounter_id):
+            flags = evaluate_lab(row["CHVAL"], row["CHNL"], row["CHNH"])
+            if abnormal_only and flags["ABN_FLAG"] not in ABNORMAL_FLAGS:
+                continue
+            patient_data["labs"].append({
+                "CHRCPDTM": row["CHRCPDTM"],
+                "CHHEAD": row["CHHEAD"],
+                "CHVAL": row["CHVAL"],
+                "CHUNIT": row["CHUNIT"],
+                "REF_RANGE": f"{row['CHNL']}~{row['CHNH']}",
+                "ABN_FLAG": flags["ABN_FLAG"],
+                "ABN_SEVERITY": flags["ABN_SEVERITY"]
+            })
+
+        # 檢查主檔只回傳表頭，報告全文由 get_order_report_texts 另外讀取
+        for row in self._rows("orders", patient_id, lab_start_key, end_key, encounter_id):
+            patient_data["orders"].append({
+                "CHAD4GREQNO": row["CHAD4GREQNO"],
+                "CHAD4CDATE": row["CHAD4CDATE"],
+                "CHAD4ORDNAME": row["CHAD4ORDNAME"],
+                "CHTEAMNAM": row["CHTEAMNAM"],
+                "CHAD4STAT": row["CHAD4STAT"],
+                "CHRCPDTM": row["CHRCPDTM"],
+                "CHREPORTDATE": row["CHREPORTDATE"],
+                "HAS_REPORT": bool(row["CHTEXT"])
+            })
+
+        for row in self._rows("lab_orders", patient_id, lab_start_key, end_key, encounter_id):
+            patient_data["lab_orders"].append({
+                "CHGREQNO": row["CHGREQNO"],
+                "CHAPPDTM": row["CHAPPDTM"],
+                "CHORDNAM": row["CHORDNAM"],
+                "CHSPECI": row["CHSPECI"],
+                "CHRCPDTM": row["CHRCPDTM"]
+            })
+
+        return patient_data
+
+    def get_order_report_texts(self, greq_nos, patient_id=None):
+        """回傳格式同 db.patient_service.get_order_report_texts。"""
+        table = self._table("orders")
+        wanted = set(greq_nos)
+        if not table or not wanted:
+            return {}
+
+        reports = {}
+        for pat_id in ([patient_id] if patient_id else list(table.patients)):
+            for row in table.rows(pat_id):
+                if row["CHAD4GREQNO"] in wanted and row["CHTEXT"]:
+                    reports.setdefault(row["CHAD4GREQNO"], []).append({
+                        "CHAD4ORDNAME": row["CHAD4ORDNAME"],
+                        "CHAD4CDATE": row["CHAD4CDATE"],
+                        "CHTEXT": row["CHTEXT"]
+                    })
+        return reports
+
+    def list_patient_encounters(self, patient_id):
+        """回傳格式同 db.patient_service.list_patient_encounters。"""
+        encounters = {}
+        for stream, layout in TABLE_LAYOUTS.items():
+            for row in self._rows(stream, patient_id, None, None):
+                encounter_id = (row[layout["encounter_col"]] or "").strip()
+                if not encounter_id:
+                    continue
+                enc = encounters.setdefault(encounter_id, {
+                    "encounter_id": encounter_id, "start": None, "end": None, "counts": {}, "subject": None
+                })
+                enc["counts"][stream] = enc["counts"].get(stream, 0) + 1
+                ts = parse_his_datetime(row[layout["time_col"]])
+                if ts and (enc["start"] is None or ts < enc["start"]):
+                    enc["start"] = ts
+                if ts and (enc["end"] is None or ts > enc["end"]):
+                    enc["end"] = ts
+                # 列依時間排序，第一筆護理紀錄的主訴即為該次就診的主訴
+                if stream == "nursing" and enc["subject"] is None:
+                    enc["subject"] = row["SUBJECT"]
+        return sorted(encounters.values(), key=lambda e: e["start"] or datetime.min, reverse=True)
+
+    def get_all_patients_overview(self, limit=50):
+        """以護理紀錄索引列出病患清單 (只讀索引，不掃描 CSV 內容)。"""
+        table = self._table("nursing")
+        if not table:
+            return []
+
+        overview = []
+        for pat_id, (first, count) in table.patients.items():
+            base = table._records_offset + first * RECORD.size
+            first_key = RECORD.unpack_from(table._idx_mm, base)[0]
+            last_key = RECORD.unpack_from(table._idx_mm, base + (count - 1) * RECORD.size)[0]
+            overview.append({
+                "病歷號": pat_id,
+                "最早紀錄": str(first_key) if first_key else None,
+                "最晚紀錄": str(last_key) if last_key else None,
+                "資料筆數": count
+            })
+        overview.sort(key=lambda p: p["最早紀錄"] or "", reverse=True)
+        return overview[:limit]
+
+    def close(self):
+        for table in self._tables.values():
+            if table:
+                table.close()
+        self._tables.clear()
+
+
+# ==========================================
+# 3. 模組層級介面 (與 db.patient_service 同名)
+# ==========================================
+_default_provider = None
+
+
+def _provider():
+    global _default_provider
+    if _default_provider is None:
+        _default_provider = CsvHistoryProvider(os.getenv("HIS_CSV_DIR", DATA_DIR))
+    return _default_provider
+
+
+def get_patient_full_history(patient_id, start_time=None, end_time=None, abnormal_only=False, encounter_id=None):
+    return _provider().get_patient_full_history(patient_id, start_time, end_time, abnormal_only, encounter_id)
+
+
+def list_patient_encounters(patient_id):
+    return _provider().list_patient_encounters(patient_id)
+
+
+def get_all_patients_overview():
+    return _provider().get_all_patients_overview()
+
+
+def get_order_report_texts(greq_nos, patient_id=None):
+    return _provider().get_order_report_texts(greq_nos, patient_id)
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        build_all_indexes(force="--force" in sys.argv)
+    elif command == "show" and len(sys.argv) > 2:
+        import time
+        t0 = time.perf_counter()
+        data = get_patient_full_history(sys.argv[2])
+        elapsed = (time.perf_counter() - t0) * 1000
+        print(json.dumps(data, indent=2, ensure_ascii=False))
+        print(f"護理 {len(data['nursing'])} 筆, 生理 {len(data['vitals'])} 筆, 檢驗 {len(data['labs'])} 筆 ({elapsed:.1f} ms)")
+    else:
+        print("用法: python -m data.csv_index build [--force] | show <病歷號>")
@@ -3,17 +3,21 @@ import os
 import random
 import psycopg2
 from db.db_connector import get_db_connection
+from db.migrations import run_migrations
+from db.partitioning import ensure_upcoming_partitions
+from data.lab_normalizer import normalized_values
+from data.time_utils import parse_his_datetime, parse_his_date
 
 # =========================================================
 # 1. 匯入急診檢驗明細 (DB_ADM_LABDATA_ER)
 # =========================================================
 def import_lab_data_er():
-    """匯入急診檢驗明細 (22欄位)"""
+    """匯入急診檢驗明細 (22欄位 + 匯入時預先計算的正規化/異常旗標/時間欄位)"""
     csv_filename = 'DB_ADM_LABDATA_ER-急診檢驗明細.csv'
     csv_filepath = os.path.join(os.path.dirname(__file__), csv_filename)
     
     print(f"--- [1/5] 開始匯入 {csv_filename} ---")
-    conn = get_db_connection()
+    conn = get_db_connection(statement_timeout_ms=0)
     if not conn: return
 
     try:
@@ -25,7 +29,12 @@ def import_lab_data_er():
                 cleaned = [None if val.strip() in ['(null)', ''] else val for val in row]
                 # 補齊至 22 欄
                 while len(cleaned) < 22: cleaned.append(None)
-                data.append(tuple(cleaned[:22]))
+                # 12: CHVAL, 15: CHNL, 16: CHNH -> 只在匯入時解析一次
+                data.append(
+                    tuple(cleaned[:22])
+                    + normalized_values(cleaned[12], cleaned[15], cleaned[16])
+                    + (parse_his_datetime(cleaned[3]), parse_his_datetime(cleaned[4]))
+                )
 
         if data:
             with conn.cursor() as cur:
@@ -35,8 +44,12 @@ def import_lab_data_er():
                         CHLREQNO, CHORDNO, CHITEMNO, CHHEAD, CHTEAMNAM, 
                         CHSTAT, CHSPECI, CHVAL, CHUNIT, CHCOMMT, 
                         CHNL, CHNH, CHITEMSEQ, CHREPORTDATE, CHTEXT, 
-                        CHSIGNDTTM, CHLABAPCODE
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        CHSIGNDTTM, CHLABAPCODE,
+                        CHVAL_KIND, CHVAL_NUM, CHVAL_QUAL, CHVAL_CAT,
+                        CHNL_NUM, CHNH_NUM, ABN_FLAG, ABN_SEVERITY,
+                        CHAPPDTM_TS, CHRCPDTM_TS
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
+                              %s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 """
                 cur.executemany(query, data)
             conn.commit()
@@ -58,7 +71,7 @@ def import_lab_order_er():
     csv_filepath = os.path.join(os.path.dirname(__file__), csv_filename)
     
     print(f"--- [2/5] 開始匯入 {csv_filename} ---")
-    conn = get_db_connection()
+    conn = get_db_connection(statement_timeout_ms=0)
     if not conn: return
 
     try:
@@ -68,7 +81,8 @@ def import_lab_order_er():
             for row in reader:
                 cleaned = [None if val.strip() in ['(null)', ''] else val for val in row]
                 while len(cleaned) < 20: cleaned.append(None)
-                data.append(tuple(cleaned[:20]))
+                # 3: CHAPPDTM, 13: CHRCPDTM
+                data.append(tuple(cleaned[:20]) + (parse_his_datetime(cleaned[3]), parse_his_datetime(cleaned[13])))
 
         if data:
             with conn.cursor() as cur:
@@ -76,8 +90,9 @@ def import_lab_order_er():
                     INSERT INTO DB_ADM_LABORDER_ER (
                         CHCASENO, CHMRNO, CHGREQNO, CHAPPDTM, CHLREQNO, CHORDNO, CHORDNAM, 
                         CHTEAMNAM, CHSTAT, CHSPECI, SOURCETYPE, ORDSEQ, CHTAPPDT, CHRCPDTM, 
-                        CHRCONNAME, CONCODE, LABMCHNO, LABUNIFNO, LABCLASS, ORDPROCDTTM
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        CHRCONNAME, CONCODE, LABMCHNO, LABUNIFNO, LABCLASS, ORDPROCDTTM,
+                        CHAPPDTM_TS, CHRCPDTM_TS
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 """
                 cur.executemany(query, data)
             conn.commit()
@@ -99,7 +114,7 @@ def import_vital_signs():
     csv_filepath = os.path.join(os.path.dirname(__file__), csv_filename)
     
     print(f"--- [3/5] 開始匯入 {csv_filename} (模擬正常數值填補) ---")
-    conn = get_db_connection()
+    conn = get_db_connection(statement_timeout_ms=0)
     if not conn: return
 
     try:
@@ -139,7 +154,8 @@ def import_vital_signs():
                 if cleaned_row[16] in ['', '(null)']: cleaned_row[16] = '3'
                 # === 結束模擬 ===
 
-                data.append(tuple(cleaned_row[:18]))
+                # 2: VISITDT, 17: PROCDTTM
+                data.append(tuple(cleaned_row[:18]) + (parse_his_date(cleaned_row[2]), parse_his_datetime(cleaned_row[17])))
 
         if data:
             with conn.cursor() as cur:
@@ -147,8 +163,9 @@ def import_vital_signs():
                     INSERT INTO v_ai_hisensnes (
                         TRINO, PATID, VISITDT, EWEIGHT, ETEMPUTER, ETREGION, EPLUSE, 
                         EBREATHE, EPRESSURE, EDIASTOLIC, ESAO2, GCS_E, GCS_V, GCS_M, 
-                        PUPIL_L, PUPIL_R, ENESKIND, PROCDTTM
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        PUPIL_L, PUPIL_R, ENESKIND, PROCDTTM,
+                        VISITDT_DATE, PROCDTTM_TS
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 """
                 cur.executemany(query, data)
             conn.commit()
@@ -170,7 +187,7 @@ def import_nursing_records():
     csv_filepath = os.path.join(os.path.dirname(__file__), csv_filename)
     
     print(f"--- [4/5] 開始匯入 {csv_filename} ---")
-    conn = get_db_connection()
+    conn = get_db_connection(statement_timeout_ms=0)
     if not conn: return
 
     try:
@@ -180,15 +197,17 @@ def import_nursing_records():
             for row in reader:
                 cleaned = [None if val.strip() in ['(null)', ''] else val for val in row]
                 while len(cleaned) < 9: cleaned.append(None)
-                data.append(tuple(cleaned[:9]))
+                # 2: VISITDT, 5: PROCDTTM
+                data.append(tuple(cleaned[:9]) + (parse_his_date(cleaned[2]), parse_his_datetime(cleaned[5])))
 
         if data:
             with conn.cursor() as cur:
                 query = """
                     INSERT INTO ENSDATA (
                         TRINO, PATID, VISITDT, SEQ, SUBJECT, PROCDTTM, 
-                        DIAGNOSIS, CLOSE, FIINISH
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        DIAGNOSIS, CLOSE, FIINISH,
+                        VISITDT_DATE, PROCDTTM_TS
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 """
                 cur.executemany(query, data)
             conn.commit()
@@ -210,7 +229,7 @@ def import_adm_order_er():
     csv_filepath = os.path.join(os.path.dirname(__file__), csv_filename)
     
     print(f"--- [5/5] 開始匯入 {csv_filename} ---")
-    conn = get_db_connection()
+    conn = get_db_connection(statement_timeout_ms=0)
     if not conn: return
 
     try:
@@ -220,7 +239,8 @@ def import_adm_order_er():
             for row in reader:
                 cleaned = [None if val.strip() in ['(null)', ''] else val for val in row]
                 while len(cleaned) < 15: cleaned.append(None)
-                data.append(tuple(cleaned[:15]))
+                # 3: CHAD4CDATE, 11: CHRCPDTM
+                data.append(tuple(cleaned[:15]) + (parse_his_datetime(cleaned[3]), parse_his_datetime(cleaned[11])))
 
         if data:
             with conn.cursor() as cur:
@@ -228,8 +248,9 @@ def import_adm_order_er():
                     INSERT INTO DB_ADM_ORDER_ER (
                         CHAD1CASENO, CHAD1MRNO, CHAD4GREQNO, CHAD4CDATE, CHAD1ORDNO, 
                         CHAD4ORDNAME, CHTEAMNAM, CHAD4SPECT, CHAD4DCDATE, CHAD4STAT, 
-                        CHAD4REP1, CHRCPDTM, CHREPORTDATE, CHTEXT, SOURCETYPE
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        CHAD4REP1, CHRCPDTM, CHREPORTDATE, CHTEXT, SOURCETYPE,
+                        CHAD4CDATE_TS, CHRCPDTM_TS
+                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 """
                 cur.executemany(query, data)
             conn.commit()
@@ -248,6 +269,11 @@ def import_adm_order_er():
 if __name__ == '__main__':
     print("=== 開始執行資料匯入作業 ===")
     
+    # 先確保 Schema 為最新 (匯入時會寫入新增的衍生欄位)
+    run_migrations()
+    # 若已轉為月份分區表，先補齊近期分區 (未涵蓋的月份會落在 DEFAULT 分區)
+    ensure_upcoming_partitions()
+
     # 執行所有匯入函數
     import_lab_data_er()
     import_lab_order_er()
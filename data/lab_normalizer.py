@@ -0,0 +1,254 @@
+# /data/lab_normalizer.py
+
+# 檢驗結果正規化：在匯入時把 CHVAL / CHNL / CHNH 解析成數值或類別，
+# 並預先判定異常旗標與嚴重度，查詢端只需要讀欄位、不必再重新解析字串。
+
+import re
+
+# ==========================================
+# 旗標與嚴重度定義
+# ==========================================
+# CHVAL_KIND: 'N' 數值 / 'C' 類別 (陰性、陽性…) / 'T' 其他文字 / 'E' 空值
+# ABN_FLAG:   'H' 偏高 / 'L' 偏低 / 'A' 類別異常 / 'N' 正常 / None 無法判定
+# ABN_SEVERITY: 0 正常、1 輕度、2 中度、3 重度
+ABNORMAL_FLAGS = ('H', 'L', 'A')
+
+FLAG_LABELS = {
+    'H': '↑偏高',
+    'L': '↓偏低',
+    'A': '異常',
+    'N': '正常',
+}
+
+NULL_TOKENS = {'', '(null)', 'null', 'none'}
+
+_NUMBER_RE = re.compile(r'^([<>]=?|≦|≧)?\s*(-?\d+(?:\.\d+)?)$')
+_RANGE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*-\s*(\d+(?:\.\d+)?)$')
+_GRADE_RE = re.compile(r'^([1-4])\+$')
+
+# 類別結果：原始寫法 (小寫) -> 正規化類別
+_CATEGORY_ALIASES = {
+    'negative': 'NEGATIVE', 'neg': 'NEGATIVE', '-': 'NEGATIVE', '陰性': 'NEGATIVE',
+    'non-reactive': 'NEGATIVE', 'nonreactive': 'NEGATIVE',
+    'not found': 'NOT_FOUND', 'no growth': 'NO_GROWTH', 'normal': 'NORMAL', 'nil': 'NEGATIVE',
+    'positive': 'POSITIVE', 'pos': 'POSITIVE', '+': 'POSITIVE', '陽性': 'POSITIVE',
+    'reactive': 'POSITIVE', 'trace': 'TRACE', '±': 'TRACE', '+-': 'TRACE',
+}
+_NORMAL_CATEGORIES = {'NEGATIVE', 'NOT_FOUND', 'NO_GROWTH', 'NORMAL'}
+_QUALIFIER_ALIASES = {'≦': '<=', '≧': '>='}
+
+
+def _clean(raw):
+    if raw is None:
+        return None
+    text = str(raw).strip()
+    return None if text.lower() in NULL_TOKENS else text
+
+
+def parse_lab_value(raw):
+    """
+    解析 CHVAL 結果值。
+
+    Returns:
+        dict: kind ('N'/'C'/'T'/'E')、num (數值)、qualifier ('<'、'>='…)、category (類別名稱)、
+              range_low (區間型結果的下限)
+    """
+    text = _clean(raw)
+    result = {"kind": 'E', "num": None, "qualifier": None, "category": None, "range_low": None}
+    if text is None:
+        return result
+
+    m = _NUMBER_RE.match(text)
+    if m:
+        result.update(kind='N', num=float(m.group(2)),
+                      qualifier=_QUALIFIER_ALIASES.get(m.group(1), m.group(1)))
+        return result
+
+    # 尿沉渣常見的 "0-5"、"10-19" 以上限作為判定值
+    m = _RANGE_RE.match(text)
+    if m:
+        result.update(kind='N', num=float(m.group(2)), qualifier='<=', range_low=float(m.group(1)))
+        return result
+
+    # "1+"、"2+" 等分級陽性
+    m = _GRADE_RE.match(text)
+    if m:
+        result.update(kind='C', category=f"POSITIVE_{m.group(1)}")
+        return result
+
+    lowered = text.lower()
+    for alias, category in _CATEGORY_ALIASES.items():
+        if lowered == alias or (len(alias) > 3 and lowered.startswith(alias)):
+            result.update(kind='C', category=category)
+            return result
+
+    result["kind"] = 'T'
+    return result
+
+
+def parse_reference_limit(raw):
+    """解析 CHNL / CHNH 參考值，只接受數值，其餘回傳 None。"""
+    text = _clean(raw)
+    if text is None:
+        return None
+    m = _NUMBER_RE.match(text)
+    return float(m.group(2)) if m else None
+
+
+def _numeric_severity(value, limit, low, high):
+    """依超出參考範圍的幅度分級：以範圍寬度 (或參考值本身) 為基準。"""
+    if low is not None and high is not None and high > low:
+        scale = high - low
+    else:
+        scale = abs(limit) or 1.0
+    ratio = abs(value - limit) / scale
+    if ratio < 0.25:
+        return 1
+    if ratio < 1.0:
+        return 2
+    return 3
+
+
+def evaluate_lab(chval, chnl, chnh):
+    """
+    正規化一筆檢驗結果並判定是否異常。
+
+    Returns:
+        dict: CHVAL_KIND, CHVAL_NUM, CHVAL_QUAL, CHVAL_CAT, CHNL_NUM, CHNH_NUM, ABN_FLAG, ABN_SEVERITY
+    """
+    parsed = parse_lab_value(chval)
+    low = parse_reference_limit(chnl)
+    high = parse_reference_limit(chnh)
+
+    flag, severity = None, None
+
+    if parsed["kind"] == 'N' and parsed["range_low"] is not None:
+        # 區間型結果 (如 "10-19")：整段都高於上限 / 低於下限才算異常
+        range_low, range_high = parsed["range_low"], parsed["num"]
+        if high is not None and range_low > high:
+            flag, severity = 'H', _numeric_severity(range_low, high, low, high)
+        elif low is not None and range_high < low:
+            flag, severity = 'L', _numeric_severity(range_high, low, low, high)
+        elif low is not None or high is not None:
+            flag, severity = 'N', 0
+
+    elif parsed["kind"] == 'N':
+        value, qual = parsed["num"], parsed["qualifier"]
+        # 帶 < / > 的結果只有在「整個可能區間」都落在範圍外時才判定異常
+        can_be_higher = qual in (None, '>', '>=')
+        can_be_lower = qual in (None, '<', '<=')
+
+        if high is not None and can_be_higher and (value > high or (qual == '>' and value >= high)):
+            flag, severity = 'H', _numeric_severity(value, high, low, high)
+        elif low is not None and can_be_lower and (value < low or (qual == '<' and value <= low)):
+            flag, severity = 'L', _numeric_severity(value, low, low, high)
+        elif low is not None or high is not None:
+            in_range = True
+            if qual in ('<', '<=') and low is not None and value > low:
+                in_range = False      # 例："<0.5" 但下限 0.3，無法確定
+            if qual in ('>', '>=') and high is not None and value < high:
+                in_range = False
+            if in_range:
+                flag, severity = 'N', 0
+
+    elif parsed["kind"] == 'C':
+        category = parsed["category"]
+        ref_category = parse_lab_value(chnl)["category"] if _clean(chnl) else None
+        if ref_category:
+            is_normal = category == ref_category
+        else:
+            is_normal = category in _NORMAL_CATEGORIES
+        if is_normal:
+            flag, severity = 'N', 0
+        elif category == 'TRACE':
+            flag, severity = 'A', 1
+        elif category.startswith('POSITIVE_'):
+            flag, severity = 'A', min(int(category[-1]), 3)
+        else:
+            flag, severity = 'A', 2
+
+    return {
+        "CHVAL_KIND": parsed["kind"],
+        "CHVAL_NUM": parsed["num"],
+        "CHVAL_QUAL": parsed["qualifier"],
+        "CHVAL_CAT": parsed["category"],
+        "CHNL_NUM": low,
+        "CHNH_NUM": high,
+        "ABN_FLAG": flag,
+        "ABN_SEVERITY": severity,
+    }
+
+
+# 匯入 / 回填時，新增欄位的固定順序
+NORMALIZED_COLUMNS = [
+    "CHVAL_KIND", "CHVAL_NUM", "CHVAL_QUAL", "CHVAL_CAT",
+    "CHNL_NUM", "CHNH_NUM", "ABN_FLAG", "ABN_SEVERITY",
+]
+
+
+def normalized_values(chval, chnl, chnh):
+    """回傳依 NORMALIZED_COLUMNS 排序的 tuple，方便直接接在 INSERT 參數後面。"""
+    result = evaluate_lab(chval, chnl, chnh)
+    return tuple(result[col] for col in NORMALIZED_COLUMNS)
+
+
+# ==========================================
+# 回填：為匯入過但尚未正規化的舊資料補上旗標
+# ==========================================
+def backfill_lab_flags(batch_size=5000):
+    """
+    掃描 CHVAL_KIND 為 NULL 的檢驗明細並補上正規化欄位。
+    只需在 Schema 更新後執行一次，之後由匯入流程直接寫入。
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+    from db.db_connector import get_db_connection
+
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return 0
+
+    total = 0
+    try:
+        with conn.cursor() as cur:
+            while True:
+                # ctid 只在單一分區內唯一 (資料表分區後，見 db/partitioning.py)，需搭配 tableoid 定位資料列
+                cur.execute("""
+                    SELECT tableoid::bigint, ctid::text, CHVAL, CHNL, CHNH
+                    FROM DB_ADM_LABDATA_ER
+                    WHERE CHVAL_KIND IS NULL
+                    LIMIT %s
+                """, (batch_size,))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+
+                updates = [(row[0], row[1], *normalized_values(row[2], row[3], row[4])) for row in rows]
+                execute_values(cur, """
+                    UPDATE DB_ADM_LABDATA_ER AS t SET
+                        CHVAL_KIND = v.kind, CHVAL_NUM = v.num::numeric, CHVAL_QUAL = v.qual,
+                        CHVAL_CAT = v.cat, CHNL_NUM = v.low::numeric, CHNH_NUM = v.high::numeric,
+                        ABN_FLAG = v.flag, ABN_SEVERITY = v.severity::smallint
+                    FROM (VALUES %s) AS v(part_oid, row_id, kind, num, qual, cat, low, high, flag, severity)
+                    WHERE t.tableoid = v.part_oid::oid AND t.ctid = v.row_id::tid
+                """, updates)
+                conn.commit()
+                total += len(rows)
+                print(f"已回填 {total} 筆檢驗旗標...")
+        return total
+
+    except psycopg2.Error as e:
+        print(f"回填檢驗旗標失敗: {e}")
+        conn.rollback()
+        return total
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if '--backfill' in sys.argv:
+        print(f"完成，共回填 {backfill_lab_flags()} 筆。")
+    else:
+        for sample in [("19.3", "11.5", "14.5"), ("Negative", " ", " "), ("<0.5", "", "1.0"),
+                       ("2+", "", ""), ("0-5", "0", "5"), ("10-19", "0", "5"), (">=100", "", "10"), ("3.1", "3.5", "5.1")]:
+            print(sample, "->", evaluate_lab(*sample))
@@ -58,6 +58,15 @@ COLUMN_MAPPING = {
     "CHITEMSEQ": "項目序號",
     "CHSIGNDTTM": "簽核時間",
     "CHLABAPCODE": "簽核人員代碼",
+    # 匯入時計算的正規化欄位
+    "CHVAL_KIND": "結果型態",
+    "CHVAL_NUM": "結果數值",
+    "CHVAL_QUAL": "結果比較符號",
+    "CHVAL_CAT": "結果類別",
+    "CHNL_NUM": "參考下限數值",
+    "CHNH_NUM": "參考上限數值",
+    "ABN_FLAG": "異常旗標",
+    "ABN_SEVERITY": "異常嚴重度",
 
     # ==========================================
     # 4. ENSDATA (急診護理紀錄) & v_ai_hisensnes (生理監測)
@@ -0,0 +1,375 @@
+# /data/parquet_snapshot.py
+
+# 急診資料的欄位式快照 (Parquet)：
+#   - 五張表各自輸出為 Hive 分區的 Parquet 資料集，分區鍵為 VISIT_DATE
+#   - 病歷號 / 檢驗項目名稱以 dictionary 編碼，生理數值轉為 float32，時間轉為 timestamp
+#   - 讀取端以 pyarrow.dataset 做分區裁剪與病歷號 / 時間範圍的 predicate pushdown
+#
+# 用途：批次摘要、離線分析與效能測試，不必對正式資料庫發出大量查詢。
+#
+# 用法 (在專案根目錄，需要 pyarrow)：
+#   python -m data.parquet_snapshot export [--source csv|db] [--out snapshot/]
+#   python -m data.parquet_snapshot show <病歷號> [--encounter 急診號] [--out snapshot/]
+
+import os
+import csv
+import sys
+import shutil
+import argparse
+
+from data.csv_index import TABLE_LAYOUTS, DATA_DIR
+from data.check_patients import detect_encoding
+from data.lab_normalizer import evaluate_lab, NORMALIZED_COLUMNS, ABNORMAL_FLAGS
+from data.time_utils import parse_his_datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+DEFAULT_SNAPSHOT_DIR = os.path.join(os.path.dirname(DATA_DIR), "snapshot")
+
+# 資料表名稱 (與資料庫相同) -> csv_index 的資料流名稱
+SNAPSHOT_TABLES = {
+    "ENSDATA": "nursing",
+    "v_ai_hisensnes": "vitals",
+    "DB_ADM_LABDATA_ER": "labs",
+    "DB_ADM_LABORDER_ER": "lab_orders",
+    "DB_ADM_ORDER_ER": "orders",
+}
+
+# 分區日期來源：護理 / 生理用急診日期，檢驗相關表沒有急診日期，改用時間欄位的日期
+VISIT_DATE_SOURCE = {
+    "ENSDATA": "VISITDT",
+    "v_ai_hisensnes": "VISITDT",
+    "DB_ADM_LABDATA_ER": "CHRCPDTM",
+    "DB_ADM_LABORDER_ER": "CHAPPDTM",
+    "DB_ADM_ORDER_ER": "CHAD4CDATE",
+}
+
+DICTIONARY_COLUMNS = {"PATID", "CHMRNO", "CHAD1MRNO", "CHHEAD", "CHAD4ORDNAME", "CHORDNAM",
+                      "CHUNIT", "CHSPECI", "CHTEAMNAM"}
+NUMERIC_COLUMNS = {"EWEIGHT", "ETEMPUTER", "EPLUSE", "EBREATHE", "EPRESSURE", "EDIASTOLIC",
+                   "ESAO2", "GCS_E", "GCS_V", "GCS_M", "PUPIL_L", "PUPIL_R"}
+TIME_COLUMNS = {"PROCDTTM", "CHRCPDTM", "CHAPPDTM", "CHAD4CDATE"}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Parquet 快照需要安裝 pyarrow (pip install pyarrow)")
+
+
+def _partitioning():
+    # 讀寫兩端使用同一個分區 schema；讓 pyarrow 自行推斷時 VISIT_DATE 會被當成字串，無法與日期比較
+    return ds.partitioning(pa.schema([("VISIT_DATE", pa.date32())]), flavor="hive")
+
+
+def _clean(val):
+    if val is None:
+        return None
+    text = str(val)
+    return None if text.strip() in ['(null)', ''] else text
+
+
+def _to_float(val):
+    try:
+        return float(val) if val is not None else None
+    except ValueError:
+        return None
+
+
+# ==========================================
+# 1. 型別轉換
+# ==========================================
+
+def _table_schema(table_name):
+    """依欄位名稱決定型別；時間欄位另外保留一份 _TS timestamp 欄位。"""
+    layout = TABLE_LAYOUTS[SNAPSHOT_TABLES[table_name]]
+    fields = []
+    for col in layout["columns"]:
+        if col in DICTIONARY_COLUMNS:
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+        elif col in NUMERIC_COLUMNS:
+            fields.append(pa.field(col, pa.float32()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+        if col in TIME_COLUMNS:
+            fields.append(pa.field(f"{col}_TS", pa.timestamp("s")))
+    if table_name == "DB_ADM_LABDATA_ER":
+        fields += [
+            pa.field("CHVAL_KIND", pa.string()), pa.field("CHVAL_NUM", pa.float64()),
+            pa.field("CHVAL_QUAL", pa.string()), pa.field("CHVAL_CAT", pa.string()),
+            pa.field("CHNL_NUM", pa.float64()), pa.field("CHNH_NUM", pa.float64()),
+            pa.field("ABN_FLAG", pa.string()), pa.field("ABN_SEVERITY", pa.int8()),
+        ]
+    fields.append(pa.field("VISIT_DATE", pa.date32()))
+    return pa.schema(fields)
+
+
+def _rows_to_arrow(table_name, rows):
+    """原始字串列 (欄位順序同 TABLE_LAYOUTS) -> 具型別的 Arrow Table。"""
+    layout = TABLE_LAYOUTS[SNAPSHOT_TABLES[table_name]]
+    columns = layout["columns"]
+    schema = _table_schema(table_name)
+    data = {field.name: [] for field in schema}
+    date_source = columns.index(VISIT_DATE_SOURCE[table_name])
+
+    for raw in rows:
+        row = [_clean(v) for v in raw] + [None] * (len(columns) - len(raw))
+        for col, val in zip(columns, row):
+            data[col].append(_to_float(val) if col in NUMERIC_COLUMNS else val)
+            if col in TIME_COLUMNS:
+                data[f"{col}_TS"].append(parse_his_datetime(val))
+        if table_name == "DB_ADM_LABDATA_ER":
+            flags = evaluate_lab(row[columns.index("CHVAL")], row[columns.index("CHNL")],
+                                 row[columns.index("CHNH")])
+            for col in NORMALIZED_COLUMNS:
+                data[col].append(flags[col])
+        visit = parse_his_datetime(row[date_source])
+        data["VISIT_DATE"].append(visit.date() if visit else None)
+
+    # dictionary 欄位先以一般字串建表：Arrow 不支援以 dictionary 欄位排序
+    plain = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_dictionary(f.type) else f for f in schema])
+    table = pa.Table.from_arrays([pa.array(data[f.name], type=f.type) for f in plain], schema=plain)
+    # 依 (病歷號, 時間) 排序，讓 row group 統計值能有效過濾單一病患
+    table = table.sort_by([(layout["id_col"], "ascending"), (f"{layout['time_col']}_TS", "ascending")])
+    return table.cast(schema)
+
+
+# ==========================================
+# 2. 匯出
+# ==========================================
+
+def _iter_csv_rows(table_name, data_dir):
+    layout = TABLE_LAYOUTS[SNAPSHOT_TABLES[table_name]]
+    csv_path = os.path.join(data_dir, layout["filename"])
+    if not os.path.exists(csv_path):
+        print(f"找不到檔案: {layout['filename']}")
+        return
+    with open(csv_path, "r", encoding=detect_encoding(csv_path), newline="") as f:
+        yield from csv.reader(f)
+
+
+def _iter_db_rows(table_name, batch_size=10000):
+    import psycopg2
+    from db.db_connector import get_db_connection
+
+    layout = TABLE_LAYOUTS[SNAPSHOT_TABLES[table_name]]
+    conn = get_db_connection(readonly=True, statement_timeout_ms=0)
+    if not conn:
+        return
+    try:
+        # 具名游標 (server-side cursor) 分批讀取，避免一次載入整張表
+        with conn.cursor(name=f"snapshot_{table_name.lower()}") as cur:
+            cur.itersize = batch_size
+            cur.execute(f"SELECT {', '.join(layout['columns'])} FROM {table_name}")
+            for row in cur:
+                yield [None if v is None else str(v) for v in row]
+    except psycopg2.Error as e:
+        print(f"讀取 {table_name} 失敗: {e}")
+    finally:
+        conn.close()
+
+
+def export_snapshot(out_dir=DEFAULT_SNAPSHOT_DIR, source="csv", data_dir=DATA_DIR, batch_rows=200000):
+    """
+    將五張表輸出為分區 Parquet。
+
+    Args:
+        out_dir: 快照根目錄，每張表一個子目錄
+        source: 'csv' (HIS 匯出檔) 或 'db' (PostgreSQL)
+        batch_rows: 每批轉換的列數，控制記憶體用量
+    """
+    _require_pyarrow()
+    partitioning = _partitioning()
+
+    for table_name in SNAPSHOT_TABLES:
+        rows = _iter_csv_rows(table_name, data_dir) if source == "csv" else _iter_db_rows(table_name)
+        target = os.path.join(out_dir, table_name)
+        # 先寫到暫存目錄，完成後再整個換掉舊的資料集；
+        # 直接覆寫時，舊快照中本次沒有資料的日期分區會殘留下來
+        staging = f"{target}.tmp-{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+
+        total, part, batch = 0, 0, []
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_rows:
+                    _write_batch(table_name, batch, staging, partitioning, part)
+                    total, part, batch = total + len(batch), part + 1, []
+            if batch:
+                _write_batch(table_name, batch, staging, partitioning, part)
+                total += len(batch)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if not total:
+            # 來源讀不到資料 (檔案不存在 / 資料庫連線失敗) 時保留舊快照
+            shutil.rmtree(staging, ignore_errors=True)
+            print(f"⚠️ {table_name} 沒有資料，保留原有快照")
+            continue
+        _swap_directory(staging, target)
+        print(f"已輸出 {table_name}: {total} 筆 -> {target}")
+
+
+def _swap_directory(staging, target):
+    """以 rename 換上新的資料集；舊目錄先改名再刪除，讀取端不會看到寫到一半的內容。"""
+    old = f"{target}.old-{os.getpid()}"
+    if os.path.exists(target):
+        os.rename(target, old)
+    os.rename(staging, target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _write_batch(table_name, batch, target, partitioning, part):
+    table = _rows_to_arrow(table_name, batch)
+    # 目標是全新的暫存目錄，各批以不同的檔名前綴寫入同一個分區
+    ds.write_dataset(
+        table, target, format="parquet", partitioning=partitioning,
+        basename_template=f"part-{part}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+# ==========================================
+# 3. 讀取 (predicate pushdown)
+# ==========================================
+
+def read_table(table_name, patient_id=None, start_time=None, end_time=None,
+               snapshot_dir=DEFAULT_SNAPSHOT_DIR, columns=None, encounter_id=None):
+    """
+    讀取快照中的單一資料表，病歷號、就診號與時間範圍條件交由 pyarrow 下推至分區與 row group。
+
+    Returns:
+        pyarrow.Table
+    """
+    _require_pyarrow()
+    layout = TABLE_LAYOUTS[SNAPSHOT_TABLES[table_name]]
+    dataset = ds.dataset(os.path.join(snapshot_dir, table_name), format="parquet", partitioning=_partitioning())
+
+    start_dt = parse_his_datetime(start_time)
+    end_dt = parse_his_datetime(end_time)
+    ts_field = ds.field(f"{layout['time_col']}_TS")
+
+    predicate = None
+
+    def _and(expr):
+        return expr if predicate is None else predicate & expr
+
+    if patient_id:
+        predicate = _and(ds.field(layout["id_col"]) == patient_id)
+    if encounter_id:
+        predicate = _and(ds.field(layout["encounter_col"]) == str(encounter_id))
+    if start_dt:
+        predicate = _and(ts_field >= pa.scalar(start_dt, type=pa.timestamp("s")))
+        # 分區日期取自時間欄位的表，可再以日期裁剪分區；急診日期早於紀錄時間，不能用下限裁剪
+        if VISIT_DATE_SOURCE[table_name] == layout["time_col"]:
+            predicate = _and(ds.field("VISIT_DATE") >= pa.scalar(start_dt.date(), type=pa.date32()))
+    if end_dt:
+        predicate = _and(ts_field <= pa.scalar(end_dt, type=pa.timestamp("s")))
+        predicate = _and(ds.field("VISIT_DATE") <= pa.scalar(end_dt.date(), type=pa.date32()))
+
+    table = dataset.to_table(columns=columns, filter=predicate)
+    return table.sort_by([(f"{layout['time_col']}_TS", "ascending")])
+
+
+def get_patient_full_history(patient_id, start_time=None, end_time=None, abnormal_only=False,
+                             encounter_id=None, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """從 Parquet 快照讀取病患資料，回傳格式同 db.patient_service.get_patient_full_history。"""
+    start_dt = parse_his_datetime(start_time)
+    end_dt = parse_his_datetime(end_time)
+    if (start_time and not start_dt) or (end_time and not end_dt):
+        print(f"時間格式錯誤: {start_time} ~ {end_time}")
+        return None
+    # 檢驗相關時間只到「分」，起始時間截到分鐘 (與資料庫版本相同的範圍語意)
+    lab_start = start_dt.replace(second=0) if start_dt else None
+
+    def _read(table_name, start, columns):
+        return read_table(table_name, patient_id, start, end_dt, snapshot_dir,
+                          columns=columns, encounter_id=encounter_id).to_pylist()
+
+    def _num(v):
+        # 還原成與資料庫字串欄位相近的表示 (整數值不帶小數點)
+        if v is None:
+            return None
+        return str(int(v)) if float(v).is_integer() else str(v)
+
+    patient_data = {"nursing": [], "vitals": [], "labs": [], "orders": [], "lab_orders": []}
+    for row in _read("ENSDATA", start_dt, ["PROCDTTM", "SUBJECT", "DIAGNOSIS", "PROCDTTM_TS"]):
+        patient_data["nursing"].append({
+            "PROCDTTM": row["PROCDTTM"], "SUBJECT": row["SUBJECT"], "DIAGNOSIS": row["DIAGNOSIS"]
+        })
+    for row in _read("v_ai_hisensnes", start_dt,
+                     ["PROCDTTM", "ETEMPUTER", "EPLUSE", "EBREATHE", "EPRESSURE",
+                      "EDIASTOLIC", "ESAO2", "GCS_E", "GCS_V", "GCS_M", "PROCDTTM_TS"]):
+        patient_data["vitals"].append({
+            "PROCDTTM": row["PROCDTTM"],
+            "ETEMPUTER": _num(row["ETEMPUTER"]),
+            "EPLUSE": _num(row["EPLUSE"]),
+            "EBREATHE": _num(row["EBREATHE"]),
+            "EPRESSURE": _num(row["EPRESSURE"]),
+            "EDIASTOLIC": _num(row["EDIASTOLIC"]),
+            "ESAO2": _num(row["ESAO2"]),
+            "GCS": f"E{_num(row['GCS_E'])}V{_num(row['GCS_V'])}M{_num(row['GCS_M'])}"
+        })
+    for row in _read("DB_ADM_LABDATA_ER", lab_start,
+                     ["CHRCPDTM", "CHHEAD", "CHVAL", "CHUNIT", "CHNL", "CHNH",
+                      "ABN_FLAG", "ABN_SEVERITY", "CHRCPDTM_TS"]):
+        if abnormal_only and row["ABN_FLAG"] not in ABNORMAL_FLAGS:
+            continue
+        patient_data["labs"].append({
+            "CHRCPDTM": row["CHRCPDTM"],
+            "CHHEAD": row["CHHEAD"],
+            "CHVAL": row["CHVAL"],
+            "CHUNIT": row["CHUNIT"],
+            "REF_RANGE": f"{row['CHNL']}~{row['CHNH']}",
+            "ABN_FLAG": row["ABN_FLAG"],
+            "ABN_SEVERITY": row["ABN_SEVERITY"]
+        })
+    # 檢查主檔只回傳表頭；報告全文仍需由 db.patient_service.get_order_report_texts 讀取
+    for row in _read("DB_ADM_ORDER_ER", lab_start,
+                     ["CHAD4GREQNO", "CHAD4CDATE", "CHAD4ORDNAME", "CHTEAMNAM", "CHAD4STAT",
+                      "CHRCPDTM", "CHREPORTDATE", "CHTEXT", "CHAD4CDATE_TS"]):
+        patient_data["orders"].append({
+            "CHAD4GREQNO": row["CHAD4GREQNO"],
+            "CHAD4CDATE": row["CHAD4CDATE"],
+            "CHAD4ORDNAME": row["CHAD4ORDNAME"],
+            "CHTEAMNAM": row["CHTEAMNAM"],
+            "CHAD4STAT": row["CHAD4STAT"],
+            "CHRCPDTM": row["CHRCPDTM"],
+            "CHREPORTDATE": row["CHREPORTDATE"],
+            "HAS_REPORT": bool(row["CHTEXT"])
+        })
+    for row in _read("DB_ADM_LABORDER_ER", lab_start,
+                     ["CHGREQNO", "CHAPPDTM", "CHORDNAM", "CHSPECI", "CHRCPDTM", "CHAPPDTM_TS"]):
+        patient_data["lab_orders"].append({
+            "CHGREQNO": row["CHGREQNO"],
+            "CHAPPDTM": row["CHAPPDTM"],
+            "CHORDNAM": row["CHORDNAM"],
+            "CHSPECI": row["CHSPECI"],
+            "CHRCPDTM": row["CHRCPDTM"]
+        })
+    return patient_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="急診資料 Parquet 快照")
+    parser.add_argument("command", choices=["export", "show"])
+    parser.add_argument("patient_id", nargs="?")
+    parser.add_argument("--encounter", help="只顯示該次就診 (急診號)")
+    parser.add_argument("--source", choices=["csv", "db"], default="csv")
+    parser.add_argument("--out", default=DEFAULT_SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.out, source=args.source)
+    elif not args.patient_id:
+        print("請指定病歷號")
+        sys.exit(1)
+    else:
+        data = get_patient_full_history(args.patient_id, encounter_id=args.encounter, snapshot_dir=args.out)
+        print(f"護理 {len(data['nursing'])} 筆, 生理 {len(data['vitals'])} 筆, 檢驗 {len(data['labs'])} 筆, "
+              f"檢查 {len(data['orders'])} 筆, 檢驗申請 {len(data['lab_orders'])} 筆")
@@ -0,0 +1,55 @@
+# /data/time_utils.py
+
+# HIS 匯出的時間欄位都是字串，且長度不一：
+#   PROCDTTM 14 碼 (YYYYMMDDHHMMSS)、CHRCPDTM / CHAPPDTM 12 碼 (YYYYMMDDHHMM)、VISITDT 8 碼 (YYYYMMDD)
+# 直接比較字串會把不同精度混在一起，統一經由這裡轉成 datetime。
+
+from datetime import datetime
+
+_FORMATS = {
+    14: "%Y%m%d%H%M%S",
+    12: "%Y%m%d%H%M",
+    8: "%Y%m%d",
+}
+
+
+def parse_his_datetime(raw):
+    """
+    將 HIS 時間字串 (8 / 12 / 14 碼) 轉為 datetime。
+    已是 datetime 則原樣回傳；空值或格式不符回傳 None。
+    """
+    if raw is None:
+        return None
+    if isinstance(raw, datetime):
+        return raw
+
+    text = str(raw).strip()
+    fmt = _FORMATS.get(len(text))
+    if not fmt or not text.isdigit():
+        return None
+    try:
+        return datetime.strptime(text, fmt)
+    except ValueError:
+        return None
+
+
+def parse_his_date(raw):
+    """VISITDT 等 8 碼日期 -> date；無法解析回傳 None。"""
+    dt = parse_his_datetime(raw)
+    return dt.date() if dt else None
+
+
+def format_his_datetime(value, digits=14):
+    """datetime (或 HIS 字串) -> 指定長度的 HIS 時間字串。"""
+    dt = parse_his_datetime(value)
+    if not dt:
+        return None
+    return dt.strftime(_FORMATS[digits])
+
+
+def format_display_time(raw):
+    """轉成畫面顯示用的 'YYYY-MM-DD HH:MM'；無法解析時原樣回傳。"""
+    dt = parse_his_datetime(raw)
+    if not dt:
+        return raw
+    return dt.strftime("%Y-%m-%d %H:%M")
@@ -0,0 +1,209 @@
+# /db/async_patient_service.py
+
+# 非同步資料存取 (asyncio + asyncpg)：
+#   - 提供 get_patient_full_history / list_patient_encounters / get_all_patients_overview / 模板函式的 async 版本，
+#     供非同步伺服器或批次引擎直接 await，不必把每個查詢丟到執行緒。
+#   - 病患歷史的各項查詢各自從連線池取得連線、同時執行 (asyncio.gather)。
+#   - SQL 組裝與資料列轉換與同步版 (db/patient_service.py) 共用，回傳格式完全相同；
+#     命令列與 Streamlit 仍使用同步版。
+#
+# asyncpg 為選用套件 (pip install asyncpg)，未安裝時匯入本模組不會失敗，呼叫時才會報錯。
+#
+# 用法：
+#   from db.async_patient_service import get_patient_full_history, close_pool
+#   data = await get_patient_full_history("0002452972")
+#   await close_pool()
+
+import os
+import asyncio
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from dotenv import load_dotenv
+
+from db.db_connector import STATEMENT_TIMEOUT_MS, LOCK_TIMEOUT_MS
+from db.patient_service import (
+    parse_history_range, build_history_queries, HISTORY_ROW_BUILDERS, OVERVIEW_SQL, overview_row,
+    ENCOUNTERS_SQL, encounters_from_rows
+)
+from db.template_service import TEMPLATES_SQL, CREATE_TEMPLATE_SQL, UPDATE_TEMPLATE_SQL
+from db.prepared_statements import numbered_placeholders
+
+load_dotenv()
+
+ASYNC_POOL_MIN_SIZE = int(os.getenv("ASYNC_DB_POOL_MIN", "2"))
+# 單一病患歷史會同時佔用 5 條連線，上限至少要容納一位病患的查詢
+ASYNC_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX", "10"))
+
+_pool = None
+_pool_lock = None
+
+_DB_ERRORS = (asyncpg.PostgresError, OSError) if asyncpg else (OSError,)
+
+
+def _require_asyncpg():
+    if asyncpg is None:
+        raise RuntimeError("非同步資料存取需要 asyncpg，請先執行 pip install asyncpg")
+
+
+# ==========================================
+# 1. 連線池
+# ==========================================
+
+def _connect_kwargs():
+    # 與 db_connector 相同的環境變數與逾時設定
+    kwargs = {
+        "server_settings": {
+            "statement_timeout": str(STATEMENT_TIMEOUT_MS),
+            "lock_timeout": str(LOCK_TIMEOUT_MS),
+        }
+    }
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        kwargs["dsn"] = dsn
+    else:
+        kwargs.update(
+            host=os.getenv("DB_HOST"),
+            port=os.getenv("DB_PORT"),
+            database=os.getenv("DB_NAME"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"),
+        )
+    return kwargs
+
+
+async def get_pool():
+    """取得 (必要時建立) 連線池；同一個 event loop 內共用。"""
+    global _pool, _pool_lock
+    _require_asyncpg()
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                min_size=ASYNC_POOL_MIN_SIZE, max_size=ASYNC_POOL_MAX_SIZE, **_connect_kwargs()
+            )
+    return _pool
+
+
+async def close_pool():
+    """關閉連線池 (程式結束或切換 event loop 前呼叫)。"""
+    global _pool, _pool_lock
+    if _pool is not None:
+        await _pool.close()
+    _pool, _pool_lock = None, None
+
+
+# asyncpg 本身會在每條連線上快取 prepared statement (statement_cache_size)，
+# 相同 SQL 重複執行時不會重新解析，不需另外 PREPARE
+async def _fetch(pool, sql, params):
+    async with pool.acquire() as conn:
+        return await conn.fetch(numbered_placeholders(sql), *params)
+
+
+# ==========================================
+# 2. 病患資料
+# ==========================================
+
+async def get_patient_full_history(patient_id, start_time=None, end_time=None, abnormal_only=False,
+                                   encounter_id=None):
+    """
+    get_patient_full_history 的非同步版本，參數與回傳格式同 db.patient_service。
+    各項查詢分別使用連線池中的連線同時執行。
+    """
+    time_range = parse_history_range(start_time, end_time)
+    if time_range is None:
+        return None
+
+    try:
+        pool = await get_pool()
+        queries = build_history_queries(
+            patient_id, *time_range, abnormal_only=abnormal_only, encounter_id=encounter_id
+        )
+        results = await asyncio.gather(*(_fetch(pool, sql, params) for _, sql, params in queries))
+    except _DB_ERRORS as e:
+        print(f"資料庫查詢失敗: {e}")
+        return None
+
+    return {
+        key: [HISTORY_ROW_BUILDERS[key](row) for row in rows]
+        for (key, _, _), rows in zip(queries, results)
+    }
+
+
+async def list_patient_encounters(patient_id):
+    """list_patient_encounters 的非同步版本。"""
+    try:
+        pool = await get_pool()
+        rows = await _fetch(pool, ENCOUNTERS_SQL, [patient_id] * 5)
+    except _DB_ERRORS as e:
+        print(f"查詢就診紀錄失敗: {e}")
+        return []
+    return encounters_from_rows(rows)
+
+
+async def get_all_patients_overview():
+    """get_all_patients_overview 的非同步版本。"""
+    try:
+        pool = await get_pool()
+        rows = await _fetch(pool, OVERVIEW_SQL, [])
+    except _DB_ERRORS as e:
+        print(f"查詢病患清單失敗: {e}")
+        return []
+    return [overview_row(row) for row in rows]
+
+
+# ==========================================
+# 3. 模板
+# ==========================================
+
+async def get_all_templates():
+    """取得所有模板 {name: content}。"""
+    try:
+        pool = await get_pool()
+        rows = await _fetch(pool, TEMPLATES_SQL, [])
+    except _DB_ERRORS as e:
+        print(f"查詢模板失敗: {e}")
+        return {}
+    return {row[0]: row[1] for row in rows}
+
+
+async def _execute(sql, params, error_label):
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(numbered_placeholders(sql), *params)
+        return True
+    except _DB_ERRORS as e:
+        print(f"{error_label}: {e}")
+        return False
+
+
+async def create_template(name, content, description=""):
+    """新增一個模板"""
+    return await _execute(CREATE_TEMPLATE_SQL, (name, content, description), "新增模板失敗")
+
+
+async def update_template(old_name, new_content):
+    """更新現有模板的內容"""
+    return await _execute(UPDATE_TEMPLATE_SQL, (new_content, old_name), "更新模板失敗")
+
+
+if __name__ == "__main__":
+    import sys
+
+    async def _main(patient_id):
+        try:
+            data = await get_patient_full_history(patient_id)
+            if data:
+                for key, rows in data.items():
+                    print(f"{key}: {len(rows)} 筆")
+        finally:
+            await close_pool()
+
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "0002452972"))
@@ -50,34 +50,288 @@
 #         print("請檢查您的 Streamlit Secrets 設定")
 
 import os
+import time
+import threading
+import itertools
+import contextlib
+import collections
 import psycopg2
 from dotenv import load_dotenv
 
 # 讀取 .env 檔案中的環境變數
 load_dotenv()
 
-def get_db_connection():
+# ==========================================
+# 連線設定
+# ==========================================
+# 主要資料庫：DATABASE_URL (DSN) 優先，否則使用 DB_HOST / DB_PORT ... 個別設定
+# 唯讀副本：DATABASE_REPLICA_URLS，以逗號分隔多個 DSN；未設定時讀取也走主要資料庫
+REPLICA_DSNS = [d.strip() for d in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if d.strip()]
+
+# 每個查詢的預設逾時 (毫秒)，0 代表不限制；匯入 / Schema 變更等長時間作業請明確傳入 0
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+LOCK_TIMEOUT_MS = int(os.getenv("DB_LOCK_TIMEOUT_MS", "5000"))
+
+# 副本落後超過此秒數即改讀主要資料庫
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "30"))
+# 副本落後程度的檢查結果快取秒數，避免每次連線都多一次查詢
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "10"))
+# 副本連續不可用時，暫停嘗試的秒數依失敗次數加倍，最多到此上限
+REPLICA_MAX_BACKOFF_SECONDS = float(os.getenv("DB_REPLICA_MAX_BACKOFF_SECONDS", "300"))
+
+_replica_cycle = itertools.cycle(range(len(REPLICA_DSNS))) if REPLICA_DSNS else None
+_replica_lock = threading.Lock()
+_replica_status = {}   # dsn -> (檢查時間, 是否可用, 連續失敗次數)，讀寫都要持有 _replica_lock
+
+# 連線池：每種連線 (讀 / 寫) 最多保留的閒置連線數，以及連線最長使用秒數
+# (到期後重新連線，副本延遲檢查與副本輪替才會重新生效)
+POOL_MAX_IDLE = int(os.getenv("DB_POOL_MAX_IDLE", "8"))
+POOL_MAX_AGE_SECONDS = float(os.getenv("DB_POOL_MAX_AGE_SECONDS", "300"))
+
+
+# 程序內的連線計數 (get_pool_stats 使用)
+_stats_lock = threading.Lock()
+_connection_stats = collections.Counter()
+
+
+def _count(name, delta=1):
+    with _stats_lock:
+        _connection_stats[name] += delta
+        if name == "pool_in_use":
+            _connection_stats["pool_peak_in_use"] = max(
+                _connection_stats["pool_peak_in_use"], _connection_stats["pool_in_use"]
+            )
+
+
+def _session_options(statement_timeout_ms, lock_timeout_ms, readonly):
+    statement_timeout_ms = STATEMENT_TIMEOUT_MS if statement_timeout_ms is None else statement_timeout_ms
+    lock_timeout_ms = LOCK_TIMEOUT_MS if lock_timeout_ms is None else lock_timeout_ms
+    options = f"-c statement_timeout={int(statement_timeout_ms)} -c lock_timeout={int(lock_timeout_ms)}"
+    if readonly:
+        # 讀取用連線即使退回主要資料庫，也不允許寫入
+        options += " -c default_transaction_read_only=on"
+    return options
+
+
+def _connect_primary(options):
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        return psycopg2.connect(dsn, options=options)
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        database=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        options=options
+    )
+
+
+def _replica_lag_seconds(conn):
+    """副本落後秒數；WAL 已全部套用 (主庫閒置) 時視為 0。"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END
+        """)
+        lag = float(cur.fetchone()[0])
+    conn.rollback()
+    return lag
+
+
+def _replica_check_due(dsn):
+    """
+    回傳 (是否跳過此副本, 是否需要重新檢查延遲)。
+    不可用的副本依連續失敗次數加倍暫停 (REPLICA_LAG_CHECK_INTERVAL × 2^(n-1)，上限 REPLICA_MAX_BACKOFF_SECONDS)。
+    """
+    with _replica_lock:
+        checked_at, healthy, failures = _replica_status.get(dsn, (0, True, 0))
+    elapsed = time.monotonic() - checked_at
+    if not healthy:
+        backoff = min(REPLICA_LAG_CHECK_INTERVAL * 2 ** max(failures - 1, 0), REPLICA_MAX_BACKOFF_SECONDS)
+        return elapsed < backoff, True
+    return False, elapsed >= REPLICA_LAG_CHECK_INTERVAL
+
+
+def _mark_replica(dsn, healthy):
+    with _replica_lock:
+        failures = 0 if healthy else _replica_status.get(dsn, (0, True, 0))[2] + 1
+        _replica_status[dsn] = (time.monotonic(), healthy, failures)
+
+
+def _connect_replica(options):
+    """依序嘗試副本 (round-robin)；全部不可用或落後過多時回傳 None。"""
+    with _replica_lock:
+        first = next(_replica_cycle)
+    order = [REPLICA_DSNS[(first + i) % len(REPLICA_DSNS)] for i in range(len(REPLICA_DSNS))]
+
+    for dsn in order:
+        skip, check_lag = _replica_check_due(dsn)
+        if skip:
+            continue
+        try:
+            conn = psycopg2.connect(dsn, options=options)
+        except psycopg2.Error as e:
+            print(f"⚠️ 副本連線失敗，改試下一個: {e}")
+            _mark_replica(dsn, False)
+            continue
+
+        if check_lag:
+            try:
+                lag = _replica_lag_seconds(conn)
+            except psycopg2.Error as e:
+                print(f"⚠️ 無法檢查副本延遲: {e}")
+                lag = float("inf")
+            healthy = lag <= REPLICA_MAX_LAG_SECONDS
+            _mark_replica(dsn, healthy)
+            if not healthy:
+                print(f"⚠️ 副本落後 {lag:.0f} 秒，超過上限 {REPLICA_MAX_LAG_SECONDS:.0f} 秒，改用其他來源。")
+                conn.close()
+                continue
+        return conn
+    return None
+
+
+def get_db_connection(readonly=False, statement_timeout_ms=None, lock_timeout_ms=None):
     """
     嘗試建立 PostgreSQL 資料庫連線。
     使用環境變數讀取設定，不依賴 streamlit。
+
+    Args:
+        readonly (bool): 只讀查詢 (病歷、總覽、模板清單...) 傳 True，會優先連到唯讀副本；
+                         副本不可用或落後過多時退回主要資料庫 (仍為唯讀交易)
+        statement_timeout_ms (int, optional): 單一查詢逾時，預設 DB_STATEMENT_TIMEOUT_MS，0 為不限制
+        lock_timeout_ms (int, optional): 等待鎖的逾時，預設 DB_LOCK_TIMEOUT_MS，0 為不限制
+
+    Returns:
+        連線物件；失敗回傳 None 並印出錯誤
     """
+    options = _session_options(statement_timeout_ms, lock_timeout_ms, readonly)
     try:
-        # 從環境變數讀取設定
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
+        conn = _connect_replica(options) if readonly and REPLICA_DSNS else None
+        if not conn:
+            conn = _connect_primary(options)
+        _count("opened")
         return conn
     except psycopg2.Error as e:
+        _count("failed")
         print(f"❌ 資料庫連線失敗: {e}")
         return None
     except Exception as e:
+        _count("failed")
         print(f"❌ 發生未預期的錯誤: {e}")
         return None
 
+
+# ==========================================
+# 連線池
+# ==========================================
+# 頻繁且短暫的讀取 (病患歷史) 改用連線池，省去每次建立連線的成本，
+# 也讓伺服器端的 prepared statement 可以跨請求重複使用 (見 db/prepared_statements.py)。
+
+_pool_lock = threading.Lock()
+_idle_pool = collections.defaultdict(list)   # readonly -> [(建立時間, conn)]
+_pool_created = {}                           # id(conn) -> 建立時間
+
+
+def _acquire_pooled(readonly):
+    with _pool_lock:
+        while _idle_pool[readonly]:
+            created_at, conn = _idle_pool[readonly].pop()
+            if not conn.closed and time.monotonic() - created_at < POOL_MAX_AGE_SECONDS:
+                _count("pool_reused")
+                _count("pool_in_use")
+                return conn
+            _pool_created.pop(id(conn), None)
+            conn.close()
+    conn = get_db_connection(readonly=readonly)
+    if conn:
+        _pool_created[id(conn)] = time.monotonic()
+        _count("pool_in_use")
+    return conn
+
+
+def _release_pooled(conn, readonly):
+    _count("pool_in_use", -1)
+    created_at = _pool_created.get(id(conn), 0)
+    try:
+        # 結束交易，連線才能安全地交給下一位使用者
+        if not conn.closed:
+            conn.rollback()
+    except psycopg2.Error:
+        conn.close()
+    with _pool_lock:
+        if (conn.closed or len(_idle_pool[readonly]) >= POOL_MAX_IDLE
+                or time.monotonic() - created_at >= POOL_MAX_AGE_SECONDS):
+            _pool_created.pop(id(conn), None)
+            conn.close()
+            return
+        _idle_pool[readonly].append((created_at, conn))
+
+
+@contextlib.contextmanager
+def pooled_connection(readonly=False):
+    """
+    從連線池借用連線 (with 區塊結束時自動 rollback 並歸還)。
+    無法建立連線時 yield None，呼叫端沿用 get_db_connection 的判斷方式。
+
+    用法：
+        with pooled_connection(readonly=True) as conn:
+            if not conn: return None
+            ...
+    """
+    conn = _acquire_pooled(readonly)
+    try:
+        yield conn
+    finally:
+        if conn:
+            _release_pooled(conn, readonly)
+
+
+@contextlib.contextmanager
+def idle_pooled_connections(readonly=True):
+    """暫時借出所有閒置連線 (供統計用)，with 區塊結束後歸還。"""
+    with _pool_lock:
+        entries, _idle_pool[readonly] = _idle_pool[readonly], []
+    conns = [conn for _, conn in entries if not conn.closed]
+    _count("pool_in_use", len(conns))
+    try:
+        yield conns
+    finally:
+        for conn in conns:
+            _release_pooled(conn, readonly)
+
+
+def get_pool_stats():
+    """
+    本程序的連線統計 (壓力測試 / 容量規劃用)。
+
+    Returns:
+        dict: opened / failed (get_db_connection 建立與失敗的連線數)、
+              pool_in_use / pool_peak_in_use (連線池目前與最多同時借出的連線)、
+              pool_reused (重複使用閒置連線的次數)、pool_idle_read / pool_idle_write
+    """
+    with _pool_lock:
+        idle_read, idle_write = len(_idle_pool[True]), len(_idle_pool[False])
+    with _stats_lock:
+        stats = {name: _connection_stats[name] for name in
+                 ("opened", "failed", "pool_in_use", "pool_peak_in_use", "pool_reused")}
+    stats.update(pool_idle_read=idle_read, pool_idle_write=idle_write)
+    return stats
+
+
+def close_pool():
+    """關閉所有閒置連線。"""
+    with _pool_lock:
+        for entries in _idle_pool.values():
+            for _, conn in entries:
+                conn.close()
+        _idle_pool.clear()
+        _pool_created.clear()
+
 if __name__ == '__main__':
     print("--- 正在測試 Railway 資料庫連線 (Local Test) ---")
     
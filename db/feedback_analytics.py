@@ -0,0 +1,183 @@
+# /db/feedback_analytics.py
+
+from collections import defaultdict
+from datetime import datetime, date, timedelta
+
+import psycopg2
+from psycopg2.extras import execute_values
+from db.db_connector import get_db_connection
+
+# ==========================================
+# 1. 增量更新 (由回饋寫入流程在同一個交易內呼叫)
+# ==========================================
+
+def aggregate_feedback_records(records):
+    """
+    將一批原始回饋彙總成 (模板, 日期) 為單位的增量統計。
+
+    Args:
+        records: list of dict，欄位同 ai_feedback_log (created_at 為 ISO 字串或 datetime)
+
+    Returns:
+        list of tuple，順序對應 ai_feedback_daily_stats 的統計欄位
+    """
+    buckets = defaultdict(lambda: [0] * 9)
+    for r in records:
+        created_at = r.get("created_at") or datetime.now()
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        key = (r.get("template_type") or "", created_at.date())
+
+        stat = buckets[key]
+        rating = r.get("rating") or 0
+        stat[0] += 1                          # feedback_count
+        if 1 <= rating <= 5:
+            stat[1] += 1                      # rated_count
+            stat[2] += rating                 # rating_sum
+            stat[2 + rating] += 1             # rating_1 ~ rating_5
+        if (r.get("comment") or "").strip():
+            stat[8] += 1                      # comment_count
+
+    return [(template, day, *stat) for (template, day), stat in buckets.items()]
+
+
+def apply_feedback_stats(cur, records):
+    """
+    以 UPSERT 把一批回饋累加到每日統計表。
+    cur 由呼叫端提供，與原始紀錄的 INSERT 在同一個交易中提交。
+    """
+    rows = aggregate_feedback_records(records)
+    if not rows:
+        return
+
+    upsert_sql = """
+    INSERT INTO ai_feedback_daily_stats (
+        template_type, stat_date, feedback_count, rated_count, rating_sum,
+        rating_1, rating_2, rating_3, rating_4, rating_5, comment_count
+    ) VALUES %s
+    ON CONFLICT (template_type, stat_date) DO UPDATE SET
+        feedback_count = ai_feedback_daily_stats.feedback_count + EXCLUDED.feedback_count,
+        rated_count    = ai_feedback_daily_stats.rated_count + EXCLUDED.rated_count,
+        rating_sum     = ai_feedback_daily_stats.rating_sum + EXCLUDED.rating_sum,
+        rating_1       = ai_feedback_daily_stats.rating_1 + EXCLUDED.rating_1,
+        rating_2       = ai_feedback_daily_stats.rating_2 + EXCLUDED.rating_2,
+        rating_3       = ai_feedback_daily_stats.rating_3 + EXCLUDED.rating_3,
+        rating_4       = ai_feedback_daily_stats.rating_4 + EXCLUDED.rating_4,
+        rating_5       = ai_feedback_daily_stats.rating_5 + EXCLUDED.rating_5,
+        comment_count  = ai_feedback_daily_stats.comment_count + EXCLUDED.comment_count,
+        updated_at     = NOW()
+    """
+    execute_values(cur, upsert_sql, rows)
+
+
+# ==========================================
+# 2. 查詢 (只讀統計表，不掃描原始回饋)
+# ==========================================
+
+def get_template_quality_summary(days=30):
+    """
+    彙總最近 N 天每個模板的回饋品質，用於「模板設計師」的品質分析頁。
+
+    Returns:
+        list of dict，依平均分數由低到高排序 (最需要改善的排最前面)
+    """
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    since = date.today() - timedelta(days=days - 1)
+    summary = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT template_type,
+                       SUM(feedback_count), SUM(rated_count), SUM(rating_sum),
+                       SUM(rating_1), SUM(rating_2), SUM(rating_3), SUM(rating_4), SUM(rating_5),
+                       SUM(comment_count), MAX(stat_date)
+                FROM ai_feedback_daily_stats
+                WHERE stat_date >= %s
+                GROUP BY template_type
+            """, (since,))
+            for row in cur.fetchall():
+                rated = row[2] or 0
+                summary.append({
+                    "模板名稱": row[0],
+                    "回饋筆數": row[1],
+                    "評分筆數": rated,
+                    "平均分數": round(row[3] / rated, 2) if rated else None,
+                    "評分分布": {star: row[3 + star] for star in range(1, 6)},
+                    "留言筆數": row[9],
+                    "最近回饋日": row[10],
+                })
+
+        summary.sort(key=lambda s: (s["平均分數"] is None, s["平均分數"] or 0))
+        return summary
+
+    except psycopg2.Error as e:
+        print(f"查詢模板品質統計失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+def get_template_daily_trend(template_name, days=30):
+    """
+    取得單一模板最近 N 天的每日回饋趨勢。
+
+    Returns:
+        list of dict: 日期、回饋筆數、平均分數、留言筆數
+    """
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    since = date.today() - timedelta(days=days - 1)
+    trend = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT stat_date, feedback_count, rated_count, rating_sum, comment_count
+                FROM ai_feedback_daily_stats
+                WHERE template_type = %s AND stat_date >= %s
+                ORDER BY stat_date ASC
+            """, (template_name, since))
+            for row in cur.fetchall():
+                trend.append({
+                    "日期": row[0],
+                    "回饋筆數": row[1],
+                    "平均分數": round(row[3] / row[2], 2) if row[2] else None,
+                    "留言筆數": row[4],
+                })
+        return trend
+
+    except psycopg2.Error as e:
+        print(f"查詢模板趨勢失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+def get_recent_template_comments(template_name, limit=20):
+    """
+    取得單一模板最近的文字回饋 (只讀需要的欄位，不帶出摘要全文)。
+    """
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    comments = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT created_at, rating, comment
+                FROM ai_feedback_log
+                WHERE template_type = %s AND COALESCE(TRIM(comment), '') <> ''
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (template_name, limit))
+            for row in cur.fetchall():
+                comments.append({"時間": row[0], "評分": row[1], "意見": row[2]})
+        return comments
+
+    except psycopg2.Error as e:
+        print(f"查詢模板留言失敗: {e}")
+        return []
+    finally:
+        conn.close()
@@ -0,0 +1,265 @@
+# /db/feedback_queue.py
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+from db.db_connector import get_db_connection
+from db.feedback_analytics import apply_feedback_stats
+
+# ==========================================
+# 設定 (可用環境變數覆寫)
+# ==========================================
+BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", "50"))
+FLUSH_INTERVAL = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", "2.0"))
+
+# 資料庫無法寫入時，回饋會先暫存到本地檔案，下次寫入成功時一併補寫
+SPILL_PATH = os.getenv(
+    "FEEDBACK_SPILL_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "feedback_spill.jsonl")
+)
+# 資料本身有問題 (例如欄位過長) 的回饋無論重試幾次都寫不進去，移到這裡留待人工處理，
+# 避免卡住後續所有回饋
+DEAD_LETTER_PATH = os.getenv(
+    "FEEDBACK_DEAD_LETTER_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "feedback_dead_letter.jsonl")
+)
+
+# _write_records 的結果
+WRITE_OK = "ok"
+WRITE_RETRY = "retry"        # 連線層級的錯誤，稍後整批重試
+WRITE_REJECTED = "rejected"  # 資料錯誤，需要逐筆找出問題資料
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+_spill_lock = threading.Lock()
+
+
+# ==========================================
+# 1. 對外介面
+# ==========================================
+
+def enqueue_feedback(patient_id, template_type, rating, comment, summary_content):
+    """
+    將一筆回饋放入佇列後立即返回，不等待資料庫寫入。
+    實際寫入由背景執行緒批次處理。
+    """
+    record = {
+        "patient_id": patient_id,
+        "template_type": template_type,
+        "rating": rating,
+        "comment": comment,
+        "generated_summary": summary_content,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    _ensure_worker()
+    _queue.put(record)
+    return True
+
+
+def flush_feedback():
+    """
+    同步寫出佇列中所有待處理的回饋 (程式結束或批次腳本收尾時使用)。
+
+    Returns:
+        int: 本次處理的筆數
+    """
+    batch = _drain()
+    if batch or os.path.exists(SPILL_PATH):
+        _flush_batch(batch)
+    return len(batch)
+
+
+# ==========================================
+# 2. 背景寫入
+# ==========================================
+
+def _ensure_worker():
+    global _worker
+    if _worker and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_worker_loop, name="feedback-writer", daemon=True)
+        _worker.start()
+
+
+def _worker_loop():
+    while True:
+        # 等到第一筆進來，再於 FLUSH_INTERVAL 內盡量湊滿一批
+        batch = [_queue.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_batch(batch)
+
+
+def _drain():
+    batch = []
+    while True:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _flush_batch(batch):
+    """
+    寫入一批回饋；先前暫存在本地的資料會一併補寫。
+    - 連線層級的錯誤：將本批資料追加到暫存檔，下次再整批重試，不會遺失
+    - 資料錯誤：改為逐筆寫入，寫不進去的紀錄移到 DEAD_LETTER_PATH，其餘照常寫入
+    """
+    with _spill_lock:
+        spilled = _read_spill()
+        records = spilled + batch
+        if not records:
+            return
+
+        status = _write_records(records)
+        if status == WRITE_REJECTED:
+            status = _write_one_by_one(records)
+
+        if status == WRITE_OK:
+            if spilled:
+                os.remove(SPILL_PATH)
+                print(f"已補寫 {len(spilled)} 筆暫存回饋。")
+        elif len(records) < len(spilled) + len(batch):
+            # 逐筆寫入途中中斷時，已寫入的紀錄不能再留在暫存檔，以剩下的紀錄覆寫
+            _rewrite_spill(records)
+            print(f"⚠️ 回饋寫入失敗，{len(records)} 筆已暫存於 {SPILL_PATH}")
+        else:
+            _append_spill(batch)
+            print(f"⚠️ 回饋寫入失敗，{len(batch)} 筆已暫存於 {SPILL_PATH}")
+
+
+def _is_connection_error(e):
+    """連線中斷、資料庫無法連線等暫時性錯誤才值得重試；其餘 (DataError、IntegrityError...) 視為資料問題。"""
+    return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def _insert_records(cur, records):
+    insert_sql = """
+    INSERT INTO ai_feedback_log (patient_id, template_type, rating, comment, generated_summary, created_at)
+    VALUES %s
+    """
+    rows = [
+        (r["patient_id"], r["template_type"], r["rating"], r["comment"],
+         r["generated_summary"], r["created_at"])
+        for r in records
+    ]
+    execute_values(cur, insert_sql, rows)
+    # 原始紀錄與每日統計在同一個交易內更新，避免統計重複或漏算
+    apply_feedback_stats(cur, records)
+
+
+def _write_records(records):
+    conn = get_db_connection()
+    if not conn:
+        return WRITE_RETRY
+
+    try:
+        with conn.cursor() as cur:
+            _insert_records(cur, records)
+        conn.commit()
+        return WRITE_OK
+    except psycopg2.Error as e:
+        print(f"批次寫入回饋失敗: {e}")
+        conn.rollback()
+        return WRITE_RETRY if _is_connection_error(e) else WRITE_REJECTED
+    finally:
+        conn.close()
+
+
+def _write_one_by_one(records):
+    """
+    整批寫入因資料錯誤失敗時，逐筆各自一個交易寫入，找出有問題的紀錄移到 dead letter 檔。
+    途中遇到連線錯誤時回傳 WRITE_RETRY；已寫入的紀錄不會重複寫入 (會從 records 中移除)。
+    """
+    rejected = []
+    while records:
+        conn = get_db_connection()
+        if not conn:
+            break
+        try:
+            while records:
+                record = records[0]
+                try:
+                    with conn.cursor() as cur:
+                        _insert_records(cur, [record])
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    if _is_connection_error(e):
+                        raise
+                    rejected.append(dict(record, error=str(e).strip()[:500]))
+                records.pop(0)
+        except psycopg2.Error as e:
+            print(f"逐筆寫入回饋時連線中斷: {e}")
+            break
+        finally:
+            conn.close()
+
+    if rejected:
+        _append_lines(DEAD_LETTER_PATH, rejected)
+        print(f"⚠️ {len(rejected)} 筆回饋資料有誤無法寫入，已移至 {DEAD_LETTER_PATH}")
+    return WRITE_RETRY if records else WRITE_OK
+
+
+# ==========================================
+# 3. 本地暫存檔 (JSON Lines)
+# ==========================================
+
+def _read_spill():
+    if not os.path.exists(SPILL_PATH):
+        return []
+    records = []
+    with open(SPILL_PATH, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 寫到一半被中斷的最後一行，略過
+                continue
+    return records
+
+
+def _append_spill(batch):
+    _append_lines(SPILL_PATH, batch)
+
+
+def _rewrite_spill(records):
+    tmp_path = SPILL_PATH + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    _append_lines(tmp_path, records)
+    os.replace(tmp_path, SPILL_PATH)
+
+
+def _append_lines(path, batch):
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in batch:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# 程序結束前把佇列裡剩下的回饋寫出 (或暫存)
+atexit.register(flush_feedback)
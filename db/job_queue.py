@@ -0,0 +1,330 @@
+# /db/job_queue.py
+
+# 背景摘要工作佇列 (PostgreSQL)：
+#   - summary_jobs：待執行 / 執行中 / 完成 / 失敗的工作 (migrations 版本 10)
+#   - summary_results：完成的摘要，UI 與排程預產生共用
+#   - 取件使用 FOR UPDATE SKIP LOCKED，多個 worker 同時取件不會互相阻塞
+#   - 新工作 / 完成時發出 NOTIFY，worker 與 UI 不必頻繁輪詢
+#
+# worker 程序見根目錄 worker.py。
+
+import select
+from datetime import datetime, timedelta
+
+import psycopg2
+from db.db_connector import get_db_connection
+from db.single_flight import make_key
+from data.time_utils import parse_his_datetime, format_his_datetime
+
+CHANNEL_NEW_JOB = "summary_jobs_new"
+CHANNEL_JOB_DONE = "summary_jobs_done"
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+MAX_ATTEMPTS = 3
+# 失敗重試的等待時間 (秒)，依嘗試次數遞增
+RETRY_BACKOFF_SECONDS = [30, 120, 600]
+
+_JOB_COLUMNS = ("id", "patient_id", "template_name", "start_time", "end_time", "abnormal_only",
+                "custom_system_prompt", "focus_areas", "source", "status", "attempts", "error",
+                "created_at", "started_at", "finished_at", "encounter_id")
+
+
+def _job_from_row(row):
+    return dict(zip(_JOB_COLUMNS, row))
+
+
+def summary_params_key(start_time=None, end_time=None, abnormal_only=False, custom_system_prompt=None,
+                       focus_areas=None, encounter_id=None):
+    """
+    摘要產生參數的雜湊，寫入 summary_results.params_key。
+    UI 只提供參數完全相同的預產生摘要，避免把不同就診 / 時間範圍 / 關注項目 / Prompt 的結果當成目前的摘要。
+    """
+    prompt = "\n".join(line.rstrip() for line in (custom_system_prompt or "").splitlines()).strip()
+    return make_key(
+        format_his_datetime(start_time),
+        format_his_datetime(end_time),
+        bool(abnormal_only),
+        prompt or None,
+        sorted({area.strip() for area in (focus_areas or []) if area and area.strip()}),
+        str(encounter_id) if encounter_id else None,
+    )
+
+
+def _job_params_key(job):
+    return summary_params_key(job["start_time"], job["end_time"], job["abnormal_only"],
+                              job["custom_system_prompt"], job["focus_areas"], job["encounter_id"])
+
+
+# ==========================================
+# 1. 建立工作
+# ==========================================
+
+def enqueue_summary_job(patient_id, template_name, start_time=None, end_time=None, abnormal_only=False,
+                        custom_system_prompt=None, focus_areas=None, priority=0, run_after=None, source="ui",
+                        encounter_id=None):
+    """
+    建立一筆摘要工作並通知 worker。
+
+    Args:
+        encounter_id: (選用) 只摘要該次就診 (急診號)
+        priority: 數字越大越先執行 (使用者手動要求 > 排程預產生)
+        run_after: (選用) 最早可執行時間，排程用來分散 API 呼叫
+        source: 'ui' / 'schedule'
+
+    Returns:
+        int: 工作編號；失敗回傳 None
+    """
+    conn = get_db_connection()
+    if not conn: return None
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO summary_jobs (
+                    patient_id, template_name, start_time, end_time, abnormal_only,
+                    custom_system_prompt, focus_areas, priority, run_after, source, encounter_id
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, NOW()), %s, %s)
+                RETURNING id
+            """, (patient_id, template_name, parse_his_datetime(start_time), parse_his_datetime(end_time),
+                  abnormal_only, custom_system_prompt, list(focus_areas or []), priority, run_after, source,
+                  str(encounter_id) if encounter_id else None))
+            job_id = cur.fetchone()[0]
+            cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL_NEW_JOB, str(job_id)))
+        conn.commit()
+        return job_id
+
+    except psycopg2.Error as e:
+        print(f"建立摘要工作失敗: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+
+# ==========================================
+# 2. Worker 端
+# ==========================================
+
+def claim_next_job(conn, worker_name):
+    """
+    取出一筆可執行的工作並標記為執行中 (單一陳述式，搭配 SKIP LOCKED)。
+    沒有工作時回傳 None。
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE summary_jobs SET
+                status = %s, worker = %s, started_at = NOW(), attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM summary_jobs
+                WHERE status = %s AND run_after <= NOW()
+                ORDER BY priority DESC, run_after, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING {", ".join(_JOB_COLUMNS)}
+        """, (STATUS_RUNNING, worker_name, STATUS_QUEUED))
+        row = cur.fetchone()
+    conn.commit()
+    return _job_from_row(row) if row else None
+
+
+def complete_job(conn, job, summary, data_until=None):
+    """寫入摘要結果並將工作標記為完成 (同一交易)。"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO summary_results (
+                job_id, patient_id, template_name, summary, data_until, params_key, encounter_id
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (job["id"], job["patient_id"], job["template_name"], summary, data_until,
+              _job_params_key(job), job["encounter_id"]))
+        cur.execute(
+            "UPDATE summary_jobs SET status = %s, finished_at = NOW(), error = NULL WHERE id = %s",
+            (STATUS_DONE, job["id"])
+        )
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL_JOB_DONE, str(job["id"])))
+    conn.commit()
+
+
+def fail_job(conn, job, error):
+    """記錄失敗；未達重試上限則延後重新排入佇列。"""
+    attempts = job["attempts"]
+    with conn.cursor() as cur:
+        if attempts < MAX_ATTEMPTS:
+            delay = RETRY_BACKOFF_SECONDS[min(attempts, len(RETRY_BACKOFF_SECONDS)) - 1]
+            cur.execute("""
+                UPDATE summary_jobs SET status = %s, error = %s, worker = NULL,
+                       run_after = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (STATUS_QUEUED, error, delay, job["id"]))
+        else:
+            cur.execute(
+                "UPDATE summary_jobs SET status = %s, error = %s, finished_at = NOW() WHERE id = %s",
+                (STATUS_FAILED, error, job["id"])
+            )
+            cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL_JOB_DONE, str(job["id"])))
+    conn.commit()
+
+
+def requeue_stale_jobs(conn, timeout_minutes=15):
+    """
+    worker 異常結束時，執行中的工作會卡住；超過時限者重新排入佇列。
+    已嘗試 MAX_ATTEMPTS 次的工作 (可能每次都讓 worker 當掉或卡住) 不再重試，直接標記為失敗。
+
+    Returns:
+        (重新排入筆數, 標記失敗筆數)
+    """
+    stale = "status = %s AND started_at < NOW() - make_interval(mins => %s)"
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE summary_jobs SET status = %s, worker = NULL
+            WHERE {stale} AND attempts < %s
+        """, (STATUS_QUEUED, STATUS_RUNNING, timeout_minutes, MAX_ATTEMPTS))
+        requeued = cur.rowcount
+        cur.execute(f"""
+            UPDATE summary_jobs SET status = %s, finished_at = NOW(),
+                   error = 'worker 執行逾時 ' || %s || ' 分鐘，已達重試上限 (' || attempts || ' 次)'
+            WHERE {stale}
+            RETURNING id
+        """, (STATUS_FAILED, timeout_minutes, STATUS_RUNNING, timeout_minutes))
+        failed_ids = [row[0] for row in cur.fetchall()]
+        for job_id in failed_ids:
+            cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL_JOB_DONE, str(job_id)))
+    conn.commit()
+    return requeued, len(failed_ids)
+
+
+def listen(conn, *channels):
+    """讓連線開始 LISTEN 指定頻道 (需為 autocommit 連線)。"""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for channel in channels:
+            cur.execute(f"LISTEN {channel}")
+
+
+def wait_for_notify(conn, timeout):
+    """等待 NOTIFY 或逾時；回傳收到的 payload 列表。"""
+    if select.select([conn], [], [], timeout) == ([], [], []):
+        return []
+    conn.poll()
+    payloads = [n.payload for n in conn.notifies]
+    conn.notifies.clear()
+    return payloads
+
+
+# ==========================================
+# 3. UI 端查詢
+# ==========================================
+
+def get_job(job_id):
+    """查詢工作狀態；完成時一併回傳摘要。"""
+    conn = get_db_connection()
+    if not conn: return None
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {", ".join("j." + c for c in _JOB_COLUMNS)}, r.summary, r.data_until
+                FROM summary_jobs j
+                LEFT JOIN summary_results r ON r.job_id = j.id
+                WHERE j.id = %s
+            """, (job_id,))
+            row = cur.fetchone()
+        if not row:
+            return None
+        job = _job_from_row(row[:len(_JOB_COLUMNS)])
+        job["summary"], job["data_until"] = row[len(_JOB_COLUMNS):]
+        return job
+
+    except psycopg2.Error as e:
+        print(f"查詢摘要工作失敗: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def wait_for_job(job_id, timeout=60):
+    """
+    阻塞等待工作完成 (LISTEN summary_jobs_done)，供命令列或測試腳本使用。
+    UI 請用 get_job 輪詢，避免佔住 Streamlit 執行緒。
+    """
+    conn = get_db_connection()
+    if not conn: return None
+
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    try:
+        listen(conn, CHANNEL_JOB_DONE)
+        while datetime.now() < deadline:
+            job = get_job(job_id)
+            if not job or job["status"] in (STATUS_DONE, STATUS_FAILED):
+                return job
+            wait_for_notify(conn, min(5, (deadline - datetime.now()).total_seconds()))
+        return get_job(job_id)
+    except psycopg2.Error as e:
+        print(f"等待摘要工作失敗: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def get_scheduled_patient_ids(template_name, since, source="schedule"):
+    """回傳 since 之後已排入 (未失敗) 的工作所屬病患，排程用來避免重複建立。"""
+    conn = get_db_connection()
+    if not conn: return set()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT patient_id FROM summary_jobs
+                WHERE template_name = %s AND source = %s AND created_at >= %s AND status <> %s
+            """, (template_name, source, since, STATUS_FAILED))
+            return {row[0] for row in cur.fetchall()}
+
+    except psycopg2.Error as e:
+        print(f"查詢已排程工作失敗: {e}")
+        return set()
+    finally:
+        conn.close()
+
+
+def get_latest_summary(patient_id, template_name, params_key, encounter_id=None, max_age_minutes=None):
+    """
+    取得某病患 + 模板最近一次完成的摘要 (背景產生或排程預產生)。
+    只回傳同一次就診 (encounter_id，未指定時為不限就診的摘要) 且產生參數相同
+    (params_key，見 summary_params_key) 的結果，增量更新時才不會混入其他就診的內容。
+
+    Returns:
+        dict (job_id, summary, data_until, created_at, source) 或 None
+    """
+    conn = get_db_connection()
+    if not conn: return None
+
+    try:
+        with conn.cursor() as cur:
+            sql = """
+                SELECT r.job_id, r.summary, r.data_until, r.created_at, j.source
+                FROM summary_results r
+                JOIN summary_jobs j ON j.id = r.job_id
+                WHERE r.patient_id = %s AND r.template_name = %s AND r.params_key = %s
+                  AND r.encounter_id IS NOT DISTINCT FROM %s
+            """
+            params = [patient_id, template_name, params_key, str(encounter_id) if encounter_id else None]
+            if max_age_minutes:
+                sql += " AND r.created_at >= NOW() - make_interval(mins => %s)"
+                params.append(max_age_minutes)
+            sql += " ORDER BY r.created_at DESC LIMIT 1"
+
+            cur.execute(sql, tuple(params))
+            row = cur.fetchone()
+        if not row:
+            return None
+        return dict(zip(("job_id", "summary", "data_until", "created_at", "source"), row))
+
+    except psycopg2.Error as e:
+        print(f"查詢摘要結果失敗: {e}")
+        return None
+    finally:
+        conn.close()
@@ -0,0 +1,381 @@
+# /db/migrations.py
+
+import psycopg2
+from db.db_connector import get_db_connection, LOCK_TIMEOUT_MS
+
+# ==========================================
+# Schema 變更清單 (依版本號依序套用)
+# ==========================================
+# 注意：已上線的版本內容不可再修改，要調整請往後新增一個版本。
+MIGRATIONS = [
+    (1, "建立 AI 回饋資料表 ai_feedback_log", """
+        CREATE TABLE IF NOT EXISTS ai_feedback_log (
+            id SERIAL PRIMARY KEY,
+            patient_id VARCHAR(50),
+            template_type VARCHAR(50),
+            rating INTEGER,
+            comment TEXT,
+            generated_summary TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    (2, "建立每日模板回饋統計 ai_feedback_daily_stats", """
+        CREATE TABLE IF NOT EXISTS ai_feedback_daily_stats (
+            template_type VARCHAR(50) NOT NULL,
+            stat_date DATE NOT NULL,
+            feedback_count INTEGER NOT NULL DEFAULT 0,
+            rated_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_1 INTEGER NOT NULL DEFAULT 0,
+            rating_2 INTEGER NOT NULL DEFAULT 0,
+            rating_3 INTEGER NOT NULL DEFAULT 0,
+            rating_4 INTEGER NOT NULL DEFAULT 0,
+            rating_5 INTEGER NOT NULL DEFAULT 0,
+            comment_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (template_type, stat_date)
+        );
+        CREATE INDEX IF NOT EXISTS idx_feedback_daily_stats_date
+            ON ai_feedback_daily_stats (stat_date);
+        CREATE INDEX IF NOT EXISTS idx_feedback_log_template_time
+            ON ai_feedback_log (template_type, created_at DESC);
+
+        -- 既有的回饋紀錄一次性彙總進統計表
+        INSERT INTO ai_feedback_daily_stats (
+            template_type, stat_date, feedback_count, rated_count, rating_sum,
+            rating_1, rating_2, rating_3, rating_4, rating_5, comment_count
+        )
+        SELECT COALESCE(template_type, ''),
+               created_at::date,
+               COUNT(*),
+               COUNT(*) FILTER (WHERE rating BETWEEN 1 AND 5),
+               COALESCE(SUM(rating) FILTER (WHERE rating BETWEEN 1 AND 5), 0),
+               COUNT(*) FILTER (WHERE rating = 1),
+               COUNT(*) FILTER (WHERE rating = 2),
+               COUNT(*) FILTER (WHERE rating = 3),
+               COUNT(*) FILTER (WHERE rating = 4),
+               COUNT(*) FILTER (WHERE rating = 5),
+               COUNT(*) FILTER (WHERE COALESCE(TRIM(comment), '') <> '')
+        FROM ai_feedback_log
+        GROUP BY 1, 2
+        ON CONFLICT (template_type, stat_date) DO NOTHING;
+    """),
+    # 版本 3 原為字串時間欄位的 (病歷號, 時間) 索引，已由版本 5 的 timestamp 索引取代，不再建立
+    (4, "檢驗明細加入正規化數值與異常旗標欄位", """
+        ALTER TABLE DB_ADM_LABDATA_ER
+            ADD COLUMN IF NOT EXISTS CHVAL_KIND   CHAR(1),
+            ADD COLUMN IF NOT EXISTS CHVAL_NUM    NUMERIC,
+            ADD COLUMN IF NOT EXISTS CHVAL_QUAL   VARCHAR(2),
+            ADD COLUMN IF NOT EXISTS CHVAL_CAT    VARCHAR(20),
+            ADD COLUMN IF NOT EXISTS CHNL_NUM     NUMERIC,
+            ADD COLUMN IF NOT EXISTS CHNH_NUM     NUMERIC,
+            ADD COLUMN IF NOT EXISTS ABN_FLAG     CHAR(1),
+            ADD COLUMN IF NOT EXISTS ABN_SEVERITY SMALLINT;
+
+        -- 異常結果的部分索引建在 timestamp 欄位上 (版本 5)
+    """),
+    (5, "時間欄位加入正規化的 timestamp / date 欄位", """
+        ALTER TABLE ENSDATA
+            ADD COLUMN IF NOT EXISTS VISITDT_DATE DATE,
+            ADD COLUMN IF NOT EXISTS PROCDTTM_TS  TIMESTAMP;
+        ALTER TABLE v_ai_hisensnes
+            ADD COLUMN IF NOT EXISTS VISITDT_DATE DATE,
+            ADD COLUMN IF NOT EXISTS PROCDTTM_TS  TIMESTAMP;
+        ALTER TABLE DB_ADM_LABDATA_ER
+            ADD COLUMN IF NOT EXISTS CHAPPDTM_TS  TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS CHRCPDTM_TS  TIMESTAMP;
+        ALTER TABLE DB_ADM_LABORDER_ER
+            ADD COLUMN IF NOT EXISTS CHAPPDTM_TS  TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS CHRCPDTM_TS  TIMESTAMP;
+        ALTER TABLE DB_ADM_ORDER_ER
+            ADD COLUMN IF NOT EXISTS CHAD4CDATE_TS TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS CHRCPDTM_TS   TIMESTAMP;
+
+        -- 既有資料不在這裡回填：整表 UPDATE 會在啟動時長時間鎖住資料列，
+        -- 改以 python -m db.migrations --backfill 分批執行 (見 backfill_time_columns)；
+        -- 之後由 data_processor 匯入時直接寫入
+
+        -- 早期版本的字串時間索引 (若存在) 改由 timestamp 欄位索引取代
+        DROP INDEX IF EXISTS idx_ensdata_patid_time;
+        DROP INDEX IF EXISTS idx_hisensnes_patid_time;
+        DROP INDEX IF EXISTS idx_labdata_mrno_time;
+        DROP INDEX IF EXISTS idx_labdata_abnormal;
+        CREATE INDEX IF NOT EXISTS idx_ensdata_patid_ts
+            ON ENSDATA (PATID, PROCDTTM_TS DESC NULLS LAST);
+        CREATE INDEX IF NOT EXISTS idx_hisensnes_patid_ts
+            ON v_ai_hisensnes (PATID, PROCDTTM_TS DESC NULLS LAST);
+        CREATE INDEX IF NOT EXISTS idx_labdata_mrno_ts
+            ON DB_ADM_LABDATA_ER (CHMRNO, CHRCPDTM_TS);
+        -- 只索引異常結果，「只看異常」的查詢不需掃過大量正常值
+        CREATE INDEX IF NOT EXISTS idx_labdata_abnormal_ts
+            ON DB_ADM_LABDATA_ER (CHMRNO, CHRCPDTM_TS)
+            WHERE ABN_FLAG IN ('H', 'L', 'A');
+    """),
+    (6, "護理紀錄 / 檢查報告全文搜尋用的 trigram 索引", """
+        -- 中文沒有空白斷詞，tsvector 的預設 parser 無法切詞；
+        -- trigram 以「連續三個字元」為單位，ILIKE '%關鍵字%' 可直接走 GIN 索引
+        -- 注意：pg_trgm 只擷取 LC_CTYPE 判定為文字的字元，資料庫 LC_CTYPE 為 C / POSIX 時
+        -- 中文不會產生 trigram，中文關鍵字無法使用索引 (結果仍正確，但會掃整張表)；
+        -- 可用 SELECT show_trgm('心導管') 檢查，回傳空陣列即表示不支援
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS idx_ensdata_subject_trgm
+            ON ENSDATA USING GIN (SUBJECT gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_ensdata_diagnosis_trgm
+            ON ENSDATA USING GIN (DIAGNOSIS gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_order_chtext_trgm
+            ON DB_ADM_ORDER_ER USING GIN (CHTEXT gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_order_mrno_rcp_ts
+            ON DB_ADM_ORDER_ER (CHAD1MRNO, CHRCPDTM_TS);
+    """),
+    (7, "護理紀錄向量快取 ai_note_embeddings", """
+        -- 以「紀錄內容雜湊 + 模型名稱」為鍵，同一段文字只需計算一次向量
+        CREATE TABLE IF NOT EXISTS ai_note_embeddings (
+            note_hash CHAR(40) NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BYTEA NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (note_hash, model)
+        );
+    """),
+    (8, "檢查主檔 / 檢驗頭檔的病患時間索引與申請號索引", """
+        CREATE INDEX IF NOT EXISTS idx_order_mrno_cdate_ts
+            ON DB_ADM_ORDER_ER (CHAD1MRNO, CHAD4CDATE_TS);
+        CREATE INDEX IF NOT EXISTS idx_order_greqno
+            ON DB_ADM_ORDER_ER (CHAD4GREQNO);
+        CREATE INDEX IF NOT EXISTS idx_laborder_mrno_app_ts
+            ON DB_ADM_LABORDER_ER (CHMRNO, CHAPPDTM_TS);
+    """),
+    (9, "跨程序請求合併的暫存結果 single_flight_results", """
+        CREATE UNLOGGED TABLE IF NOT EXISTS single_flight_results (
+            key_hash CHAR(40) PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    (10, "背景摘要工作佇列 summary_jobs 與結果 summary_results", """
+        CREATE TABLE IF NOT EXISTS summary_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            patient_id VARCHAR(50) NOT NULL,
+            template_name VARCHAR(100) NOT NULL,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            abnormal_only BOOLEAN NOT NULL DEFAULT FALSE,
+            custom_system_prompt TEXT,
+            focus_areas TEXT[],
+            source VARCHAR(20) NOT NULL DEFAULT 'ui',
+            status VARCHAR(10) NOT NULL DEFAULT 'queued',
+            priority SMALLINT NOT NULL DEFAULT 0,
+            run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker VARCHAR(100),
+            error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        -- 只索引待執行的工作，取件查詢 (FOR UPDATE SKIP LOCKED) 不需掃過已完成的歷史
+        CREATE INDEX IF NOT EXISTS idx_summary_jobs_queued
+            ON summary_jobs (priority DESC, run_after, id)
+            WHERE status = 'queued';
+        CREATE INDEX IF NOT EXISTS idx_summary_jobs_running
+            ON summary_jobs (started_at)
+            WHERE status = 'running';
+
+        CREATE TABLE IF NOT EXISTS summary_results (
+            job_id BIGINT PRIMARY KEY REFERENCES summary_jobs (id) ON DELETE CASCADE,
+            patient_id VARCHAR(50) NOT NULL,
+            template_name VARCHAR(100) NOT NULL,
+            summary TEXT NOT NULL,
+            data_until TIMESTAMP,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_summary_results_patient
+            ON summary_results (patient_id, template_name, created_at DESC);
+    """),
+    (11, "去識別化字典 phi_terms (人員 / 病患姓名)", """
+        CREATE TABLE IF NOT EXISTS phi_terms (
+            term VARCHAR(50) PRIMARY KEY,
+            category VARCHAR(20) NOT NULL DEFAULT 'staff',
+            source VARCHAR(20) NOT NULL DEFAULT 'manual',
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+    (12, "單次就診查詢用的 (就診號, 時間) 索引", """
+        CREATE INDEX IF NOT EXISTS idx_ensdata_trino_ts
+            ON ENSDATA (TRINO, PROCDTTM_TS);
+        CREATE INDEX IF NOT EXISTS idx_hisensnes_trino_ts
+            ON v_ai_hisensnes (TRINO, PROCDTTM_TS);
+        CREATE INDEX IF NOT EXISTS idx_labdata_caseno_ts
+            ON DB_ADM_LABDATA_ER (CHAD1CASENO, CHRCPDTM_TS);
+        CREATE INDEX IF NOT EXISTS idx_order_caseno_cdate_ts
+            ON DB_ADM_ORDER_ER (CHAD1CASENO, CHAD4CDATE_TS);
+        CREATE INDEX IF NOT EXISTS idx_laborder_caseno_app_ts
+            ON DB_ADM_LABORDER_ER (CHCASENO, CHAPPDTM_TS);
+    """),
+    (13, "病房總覽篩選進行中病患用的護理紀錄時間索引", """
+        CREATE INDEX IF NOT EXISTS idx_ensdata_ts
+            ON ENSDATA (PROCDTTM_TS);
+    """),
+    (14, "摘要結果記錄產生參數 (params_key)，只提供參數相同的預產生摘要", """
+        ALTER TABLE summary_results
+            ADD COLUMN IF NOT EXISTS params_key VARCHAR(40);
+        DROP INDEX IF EXISTS idx_summary_results_patient;
+        CREATE INDEX IF NOT EXISTS idx_summary_results_params
+            ON summary_results (patient_id, template_name, params_key, created_at DESC);
+    """),
+    (15, "摘要工作與結果記錄就診號 (encounter_id)", """
+        ALTER TABLE summary_jobs
+            ADD COLUMN IF NOT EXISTS encounter_id VARCHAR(50);
+        ALTER TABLE summary_results
+            ADD COLUMN IF NOT EXISTS encounter_id VARCHAR(50);
+    """),
+]
+
+# 避免多個行程 (多個 Streamlit worker / 匯入腳本) 同時套用同一版本
+MIGRATION_LOCK_ID = 2024112601
+
+# 需要回填既有資料的版本 -> 回填指令 (分批執行，不在啟動時自動跑)
+BACKFILL_COMMANDS = {
+    4: "python -m data.lab_normalizer --backfill",
+    5: "python -m db.migrations --backfill",
+}
+
+# 版本 5 的時間欄位回填：(資料表, 目標欄位, 來源欄位, 來源格式 regex, 轉換運算式)
+_TS14 = "to_timestamp({src}, 'YYYYMMDDHH24MISS')::timestamp"
+_TS12 = "to_timestamp({src}, 'YYYYMMDDHH24MI')::timestamp"
+_DATE8 = "to_date({src}, 'YYYYMMDD')"
+TIME_BACKFILLS = [
+    ("ENSDATA", "VISITDT_DATE", "VISITDT", "^[0-9]{8}$", _DATE8),
+    ("ENSDATA", "PROCDTTM_TS", "PROCDTTM", "^[0-9]{14}$", _TS14),
+    ("v_ai_hisensnes", "VISITDT_DATE", "VISITDT", "^[0-9]{8}$", _DATE8),
+    ("v_ai_hisensnes", "PROCDTTM_TS", "PROCDTTM", "^[0-9]{14}$", _TS14),
+    ("DB_ADM_LABDATA_ER", "CHAPPDTM_TS", "CHAPPDTM", "^[0-9]{12}$", _TS12),
+    ("DB_ADM_LABDATA_ER", "CHRCPDTM_TS", "CHRCPDTM", "^[0-9]{12}$", _TS12),
+    ("DB_ADM_LABORDER_ER", "CHAPPDTM_TS", "CHAPPDTM", "^[0-9]{12}$", _TS12),
+    ("DB_ADM_LABORDER_ER", "CHRCPDTM_TS", "CHRCPDTM", "^[0-9]{12}$", _TS12),
+    ("DB_ADM_ORDER_ER", "CHAD4CDATE_TS", "CHAD4CDATE", "^[0-9]{12}$", _TS12),
+    ("DB_ADM_ORDER_ER", "CHRCPDTM_TS", "CHRCPDTM", "^[0-9]{12}$", _TS12),
+]
+
+
+def run_migrations():
+    """
+    套用所有尚未執行過的 Schema 變更。
+    每個程序啟動時呼叫一次即可，已套用的版本會記錄在 schema_migrations，
+    因此重複呼叫只會花一次查詢。
+
+    這裡只放 DDL；既有資料的回填另以 BACKFILL_COMMANDS 的指令分批執行。
+    取得 advisory lock 後改用 DB_LOCK_TIMEOUT_MS 等待資料表鎖，
+    ALTER TABLE 等不到鎖時直接失敗 (下次啟動再套用)，不會讓後面排隊的查詢跟著卡住。
+
+    Returns:
+        list[int]: 本次新套用的版本號
+    """
+    conn = get_db_connection(statement_timeout_ms=0, lock_timeout_ms=0)
+    if not conn:
+        print("無法建立連線，略過 Schema 更新。")
+        return []
+
+    applied_now = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT set_config('lock_timeout', %s, false)", (str(LOCK_TIMEOUT_MS),))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+
+            for version, description, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                print(f"套用 Schema 版本 {version}: {description}")
+                cur.execute(sql)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                conn.commit()
+                applied_now.append(version)
+                if version in BACKFILL_COMMANDS:
+                    print(f"ℹ️  版本 {version} 的既有資料需另外回填: {BACKFILL_COMMANDS[version]}")
+
+        return applied_now
+
+    except psycopg2.Error as e:
+        print(f"❌ Schema 更新失敗: {e}")
+        conn.rollback()
+        return applied_now
+    finally:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+        except psycopg2.Error:
+            pass
+        conn.close()
+
+
+def backfill_time_columns(batch_size=5000):
+    """
+    為版本 5 之前匯入的資料補上 timestamp / date 欄位。
+    每批只更新 batch_size 筆並立即 commit，不會長時間鎖住整張表；可中斷後重跑。
+    需在 db.partitioning convert 之前完成 (分區鍵即為這些欄位)。
+
+    Returns:
+        int: 回填的資料列數
+    """
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return 0
+
+    total = 0
+    try:
+        with conn.cursor() as cur:
+            for table, column, source, pattern, expr in TIME_BACKFILLS:
+                # 以 (tableoid, ctid) 定位資料列：資料表分區後 ctid 只在單一分區內唯一
+                sql = f"""
+                    UPDATE {table} SET {column} = {expr.format(src=source)}
+                    WHERE (tableoid, ctid) IN (
+                        SELECT tableoid, ctid FROM {table}
+                        WHERE {column} IS NULL AND {source} ~ %s
+                        LIMIT %s
+                    )
+                """
+                while True:
+                    cur.execute(sql, (pattern, batch_size))
+                    updated = cur.rowcount
+                    conn.commit()
+                    total += updated
+                    if updated:
+                        print(f"已回填 {table}.{column} {updated} 筆 (累計 {total} 筆)...")
+                    if updated < batch_size:
+                        break
+        return total
+
+    except psycopg2.Error as e:
+        print(f"回填時間欄位失敗: {e}")
+        conn.rollback()
+        return total
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if '--backfill' in sys.argv:
+        print(f"完成，共回填 {backfill_time_columns()} 筆時間欄位。")
+    else:
+        print("--- 執行資料庫 Schema 更新 ---")
+        versions = run_migrations()
+        if versions:
+            print(f"✅ 已套用版本: {versions}")
+        else:
+            print("ℹ️  Schema 已是最新版本。")
@@ -0,0 +1,281 @@
+# /db/partitioning.py
+
+# 大型資料表改為依月份 Range Partition：
+#   - 以 timestamp 欄位 (PROCDTTM_TS / CHRCPDTM_TS) 查詢時，PostgreSQL 只會掃描相關月份
+#   - 舊資料可整個月 DETACH，不需要大量 DELETE
+#
+# 使用方式 (在專案根目錄)：
+#   python -m db.partitioning convert              # 一次性將既有資料表轉為分區表
+#   python -m db.partitioning ensure [月數]         # 預先建立未來 N 個月的分區
+#   python -m db.partitioning detach YYYYMM [--drop] # 卸下 (或刪除) 指定月份之前的分區
+
+import re
+import sys
+from datetime import date, datetime
+
+import psycopg2
+from db.db_connector import get_db_connection
+
+# 資料表 -> 分區鍵 (需先執行 migrations 版本 5 建立 timestamp 欄位，並以 python -m db.migrations --backfill 回填)
+PARTITIONED_TABLES = {
+    "ensdata": "procdttm_ts",
+    "v_ai_hisensnes": "procdttm_ts",
+    "db_adm_labdata_er": "chrcpdtm_ts",
+}
+
+
+# ==========================================
+# 內部工具
+# ==========================================
+
+def _month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def _next_month(d):
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+
+def _partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def _is_partitioned(cur, table):
+    cur.execute("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = %s
+    """, (table,))
+    return cur.fetchone() is not None
+
+
+def _table_indexes(cur, table, column):
+    """
+    列出資料表的索引。
+
+    Returns:
+        list of (索引名稱, CREATE INDEX 定義, 是否唯一, 是否包含分區鍵, 限制名稱, 限制定義)；
+        非限制 (PRIMARY KEY / UNIQUE) 建立的索引，限制名稱與定義為 None
+    """
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(ix.indexrelid), ix.indisunique,
+               EXISTS (
+                   SELECT 1 FROM pg_attribute a
+                   WHERE a.attrelid = ix.indrelid AND a.attname = %s AND a.attnum = ANY(ix.indkey::int2[])
+               ),
+               con.conname, pg_get_constraintdef(con.oid)
+        FROM pg_index ix
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        LEFT JOIN pg_constraint con ON con.conindid = ix.indexrelid AND con.conrelid = ix.indrelid
+        WHERE ix.indrelid = %s::regclass
+        ORDER BY i.relname
+    """, (column, table))
+    return cur.fetchall()
+
+
+def _create_month_partition(cur, table, column, month):
+    """
+    建立單一月份分區。若 DEFAULT 分區裡已有該月資料，先搬出再建立，
+    否則 PostgreSQL 會拒絕建立重疊的分區。
+    """
+    name = _partition_name(table, month)
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    if cur.fetchone()[0]:
+        return False
+
+    lower, upper = month, _next_month(month)
+    default_name = f"{table}_default"
+
+    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {default_name}")
+    cur.execute(
+        f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+        (lower, upper)
+    )
+    cur.execute(
+        f"INSERT INTO {table} SELECT * FROM {default_name} WHERE {column} >= %s AND {column} < %s",
+        (lower, upper)
+    )
+    cur.execute(
+        f"DELETE FROM {default_name} WHERE {column} >= %s AND {column} < %s",
+        (lower, upper)
+    )
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {default_name} DEFAULT")
+    return True
+
+
+# ==========================================
+# 1. 一次性轉換
+# ==========================================
+
+def convert_to_partitioned(table, keep_legacy=False):
+    """
+    將既有的一般資料表轉為依月份分區的資料表 (單一交易內完成)。
+    原有索引會在新的分區表上重建；時間欄位為 NULL 的資料落在 DEFAULT 分區。
+    分區表上的唯一性限制必須包含分區鍵，不含分區鍵的 PRIMARY KEY / UNIQUE 索引無法保留，
+    會印出警告後略過 (keep_legacy=True 時舊表上仍保有原限制)。
+    """
+    table = table.lower()
+    column = PARTITIONED_TABLES[table]
+    legacy = f"{table}_legacy"
+
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return False
+
+    try:
+        with conn.cursor() as cur:
+            if _is_partitioned(cur, table):
+                print(f"ℹ️  {table} 已是分區表，略過。")
+                return True
+
+            print(f"--- 轉換 {table} 為月份分區表 (分區鍵: {column}) ---")
+            indexes = []
+            for name, index_def, unique, has_key, con_name, con_def in _table_indexes(cur, table, column):
+                if unique and not has_key:
+                    print(f"⚠️ {name} 為不含分區鍵 {column} 的唯一性索引，分區表無法保留，略過。")
+                    continue
+                indexes.append((name, index_def, con_name, con_def))
+
+            cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+            cur.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})")
+            cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+            cur.execute(f"SELECT MIN({column}), MAX({column}) FROM {legacy}")
+            min_ts, max_ts = cur.fetchone()
+            if min_ts:
+                month = _month_start(min_ts)
+                while month <= _month_start(max_ts):
+                    cur.execute(
+                        f"CREATE TABLE {_partition_name(table, month)} PARTITION OF {table} "
+                        f"FOR VALUES FROM (%s) TO (%s)",
+                        (month, _next_month(month))
+                    )
+                    month = _next_month(month)
+
+            cur.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+            print(f"已搬移 {cur.rowcount} 筆資料。")
+
+            if keep_legacy:
+                # 保留舊表時，索引名稱改掛到新表前需先移除舊表上的同名索引；
+                # 由限制建立的索引不能直接 DROP INDEX，要移除限制
+                for name, _, con_name, _ in indexes:
+                    if con_name:
+                        cur.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {con_name}")
+                    else:
+                        cur.execute(f"DROP INDEX IF EXISTS {name}")
+            else:
+                cur.execute(f"DROP TABLE {legacy}")
+
+            for name, index_def, con_name, con_def in indexes:
+                if con_name:
+                    cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {con_name} {con_def}")
+                else:
+                    cur.execute(index_def)
+
+        conn.commit()
+        print(f"✅ {table} 轉換完成。")
+        return True
+
+    except psycopg2.Error as e:
+        print(f"❌ 轉換 {table} 失敗: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+
+# ==========================================
+# 2. 例行維護
+# ==========================================
+
+def ensure_upcoming_partitions(months_ahead=2):
+    """為所有分區表建立「本月起未來 N 個月」的分區，建議由排程或匯入流程呼叫。"""
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return []
+
+    created = []
+    try:
+        with conn.cursor() as cur:
+            for table, column in PARTITIONED_TABLES.items():
+                if not _is_partitioned(cur, table):
+                    continue
+                month = _month_start(date.today())
+                for _ in range(months_ahead + 1):
+                    if _create_month_partition(cur, table, column, month):
+                        created.append(_partition_name(table, month))
+                    month = _next_month(month)
+        conn.commit()
+        return created
+
+    except psycopg2.Error as e:
+        print(f"建立分區失敗: {e}")
+        conn.rollback()
+        return created
+    finally:
+        conn.close()
+
+
+def detach_partitions_before(cutoff_month, drop=False):
+    """
+    卸下 cutoff_month (YYYYMM) 之前的所有月份分區。
+    DETACH 後的資料表仍保留，可另行封存；drop=True 則直接刪除。
+    """
+    # 分區名稱以字串比較月份，格式不符 (例如 "2025-1") 會誤判成更早或更晚的月份
+    cutoff_month = str(cutoff_month).strip()
+    try:
+        if not re.fullmatch(r"[0-9]{6}", cutoff_month):
+            raise ValueError
+        datetime.strptime(cutoff_month, "%Y%m")
+    except ValueError:
+        print(f"月份格式錯誤 (需為 YYYYMM): {cutoff_month}")
+        return []
+
+    conn = get_db_connection(statement_timeout_ms=0)
+    if not conn: return []
+
+    detached = []
+    try:
+        with conn.cursor() as cur:
+            for table in PARTITIONED_TABLES:
+                cur.execute("""
+                    SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    WHERE p.relname = %s AND c.relname ~ %s
+                    ORDER BY c.relname
+                """, (table, f"^{table}_p[0-9]{{6}}$"))
+                for (name,) in cur.fetchall():
+                    if name[-6:] >= cutoff_month:
+                        continue
+                    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                    if drop:
+                        cur.execute(f"DROP TABLE {name}")
+                    detached.append(name)
+        conn.commit()
+        return detached
+
+    except psycopg2.Error as e:
+        print(f"卸下分區失敗: {e}")
+        conn.rollback()
+        return detached
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else "ensure"
+
+    if command == "convert":
+        for table_name in PARTITIONED_TABLES:
+            convert_to_partitioned(table_name)
+    elif command == "ensure":
+        months = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        print(f"新建分區: {ensure_upcoming_partitions(months)}")
+    elif command == "detach":
+        if len(sys.argv) < 3:
+            print("用法: python -m db.partitioning detach YYYYMM [--drop]")
+            sys.exit(1)
+        print(f"已卸下: {detach_partitions_before(sys.argv[2], drop='--drop' in sys.argv)}")
+    else:
+        print(f"未知的指令: {command}")
+        sys.exit(1)
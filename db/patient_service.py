@@ -1,140 +1,312 @@
 # /db/patient_service.py
 
-import sys
-import os
 import psycopg2
+from datetime import datetime, timedelta
 
-# 路徑修正區塊
-current_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(current_dir)
-sys.path.append(parent_dir)
-
-from db.db_connector import get_db_connection
+from db.db_connector import get_db_connection, pooled_connection
 from data.metadata import get_chinese_name
+from data.lab_normalizer import ABNORMAL_FLAGS
+from data.time_utils import parse_his_datetime, format_his_datetime
+from db.single_flight import single_flight
+from db.prepared_statements import execute_prepared
+
+def _history_key(patient_id, start_time=None, end_time=None, abnormal_only=False, encounter_id=None):
+    # 字串與 datetime 形式的同一時間點視為相同請求
+    return (patient_id, format_his_datetime(start_time) or start_time,
+            format_his_datetime(end_time) or end_time, bool(abnormal_only), encounter_id or None)
+
+# ==========================================
+# 病患歷史查詢：SQL 組裝與資料列轉換
+# ==========================================
+# 同步 (psycopg2) 與非同步 (db/async_patient_service.py) 共用，兩邊回傳格式保持一致。
+# SQL 使用 %s 佔位符，非同步端再轉成 $1, $2 ...
+
+# 異常旗標直接寫成常數，才與部分索引的條件 (ABN_FLAG IN ('H', 'L', 'A')) 相符；
+# 以參數傳入時，非同步驅動的 generic plan 無法判斷可使用部分索引
+_ABNORMAL_FLAGS_SQL = "(" + ", ".join(f"'{flag}'" for flag in ABNORMAL_FLAGS) + ")"
+
+# 資料類別 -> 查詢時顯示的名稱
+HISTORY_STREAM_LABELS = {
+    "nursing": "護理紀錄",
+    "vitals": "生理監測數據",
+    "labs": "檢驗報告",
+    "orders": "檢查醫囑",
+    "lab_orders": "檢驗申請",
+}
+
+# 資料類別 -> 就診號 (急診號) 欄位；五張表的就診號是同一組編號
+ENCOUNTER_COLUMNS = {
+    "nursing": "TRINO",
+    "vitals": "TRINO",
+    "labs": "CHAD1CASENO",
+    "orders": "CHAD1CASENO",
+    "lab_orders": "CHCASENO",
+}
+
+
+def parse_history_range(start_time=None, end_time=None):
+    """
+    將查詢時間範圍轉成 datetime。
+
+    Returns:
+        (start_dt, end_dt, lab_start_dt)；格式錯誤時回傳 None
+    """
+    # 各表時間精度不同 (護理/生理 14 碼、檢驗 12 碼)，一律轉成 datetime 後比對 timestamp 欄位
+    start_dt = parse_his_datetime(start_time)
+    end_dt = parse_his_datetime(end_time)
+    if (start_time and not start_dt) or (end_time and not end_dt):
+        print(f"時間格式錯誤: {start_time} ~ {end_time}")
+        return None
+    # 檢驗時間只到「分」，起始時間也截到分鐘，同一分鐘內收件的報告才不會被排除
+    lab_start_dt = start_dt.replace(second=0, microsecond=0) if start_dt else None
+    return start_dt, end_dt, lab_start_dt
+
+
+def _with_encounter(sql, params, key, encounter_id):
+    """限定單次就診；搭配 (就診號, 時間) 索引 (migrations 版本 12)。"""
+    if encounter_id:
+        sql += f" AND {ENCOUNTER_COLUMNS[key]} = %s"
+        params.append(str(encounter_id))
+    return sql, params
+
+
+def _with_time_range(sql, params, ts_column, start_dt, end_dt):
+    """動態加入時間篩選並依時間排序。"""
+    if start_dt:
+        sql += f" AND {ts_column} >= %s"
+        params.append(start_dt)
+    if end_dt:
+        sql += f" AND {ts_column} <= %s"
+        params.append(end_dt)
+    return sql + f" ORDER BY {ts_column} ASC", params
+
+
+def build_history_queries(patient_id, start_dt=None, end_dt=None, lab_start_dt=None, abnormal_only=False,
+                          encounter_id=None):
+    """
+    組出病患歷史的各項查詢。encounter_id 指定時只查該次就診 (仍同時比對病歷號)。
+
+    Returns:
+        list of (資料類別, sql, params)，資料類別對應 HISTORY_ROW_BUILDERS 的 key
+    """
+    queries = []
+
+    # 1. 護理紀錄 (時間欄位: PROCDTTM_TS)
+    queries.append(("nursing",) + _with_time_range(*_with_encounter(
+        "SELECT PROCDTTM, SUBJECT, DIAGNOSIS FROM ENSDATA WHERE PATID = %s",
+        [patient_id], "nursing", encounter_id
+    ), "PROCDTTM_TS", start_dt, end_dt))
+
+    # 2. 生理監測 (時間欄位: PROCDTTM_TS)
+    queries.append(("vitals",) + _with_time_range(*_with_encounter("""
+        SELECT PROCDTTM, ETEMPUTER, EPLUSE, EBREATHE, EPRESSURE, EDIASTOLIC, ESAO2,
+               GCS_E, GCS_V, GCS_M
+        FROM v_ai_hisensnes WHERE PATID = %s
+    """, [patient_id], "vitals", encounter_id), "PROCDTTM_TS", start_dt, end_dt))
 
-def get_patient_full_history(patient_id, start_time=None, end_time=None):
+    # 3. 檢驗結果 (時間欄位: CHRCPDTM_TS)
+    sql_labs = """
+        SELECT CHRCPDTM, CHHEAD, CHVAL, CHUNIT, CHNL, CHNH, ABN_FLAG, ABN_SEVERITY
+        FROM DB_ADM_LABDATA_ER WHERE CHMRNO = %s
+    """
+    # 異常旗標在匯入時已算好，這裡直接走部分索引
+    if abnormal_only:
+        sql_labs += f" AND ABN_FLAG IN {_ABNORMAL_FLAGS_SQL}"
+    queries.append(("labs",) + _with_time_range(
+        *_with_encounter(sql_labs, [patient_id], "labs", encounter_id), "CHRCPDTM_TS", lab_start_dt, end_dt
+    ))
+
+    # 4. 檢查 / 檢驗主檔 (只取表頭，時間欄位: CHAD4CDATE_TS)
+    # 報告全文 (CHTEXT) 可能很長，這裡只回傳「是否有報告」；
+    # 需要放進 Prompt 時再以 get_order_report_texts 批次讀取。
+    # 申請號以文字回傳，結果才能 JSON 化 (跨程序請求合併時需要)
+    # octet_length 不需要解壓 TOAST 內容即可判斷是否有報告
+    queries.append(("orders",) + _with_time_range(*_with_encounter("""
+        SELECT CHAD4GREQNO::text, CHAD4CDATE, CHAD4ORDNAME, CHTEAMNAM, CHAD4STAT,
+               CHRCPDTM, CHREPORTDATE, COALESCE(octet_length(CHTEXT), 0) > 0
+        FROM DB_ADM_ORDER_ER WHERE CHAD1MRNO = %s
+    """, [patient_id], "orders", encounter_id), "CHAD4CDATE_TS", lab_start_dt, end_dt))
+
+    # 5. 檢驗頭檔 (時間欄位: CHAPPDTM_TS)
+    queries.append(("lab_orders",) + _with_time_range(*_with_encounter("""
+        SELECT CHGREQNO::text, CHAPPDTM, CHORDNAM, CHSPECI, CHRCPDTM
+        FROM DB_ADM_LABORDER_ER WHERE CHMRNO = %s
+    """, [patient_id], "lab_orders", encounter_id), "CHAPPDTM_TS", lab_start_dt, end_dt))
+
+    return queries
+
+
+def _nursing_row(row):
+    return {
+        "PROCDTTM": row[0],
+        "SUBJECT": row[1],
+        "DIAGNOSIS": row[2]
+    }
+
+
+def _vitals_row(row):
+    return {
+        "PROCDTTM": row[0],
+        "ETEMPUTER": row[1],
+        "EPLUSE": row[2],
+        "EBREATHE": row[3],
+        "EPRESSURE": row[4],
+        "EDIASTOLIC": row[5],
+        "ESAO2": row[6],
+        "GCS": f"E{row[7]}V{row[8]}M{row[9]}"
+    }
+
+
+def _labs_row(row):
+    return {
+        "CHRCPDTM": row[0],
+        "CHHEAD": row[1],
+        "CHVAL": row[2],
+        "CHUNIT": row[3],
+        "REF_RANGE": f"{row[4]}~{row[5]}",
+        "ABN_FLAG": row[6],
+        "ABN_SEVERITY": row[7]
+    }
+
+
+def _orders_row(row):
+    return {
+        "CHAD4GREQNO": row[0],
+        "CHAD4CDATE": row[1],
+        "CHAD4ORDNAME": row[2],
+        "CHTEAMNAM": row[3],
+        "CHAD4STAT": row[4],
+        "CHRCPDTM": row[5],
+        "CHREPORTDATE": row[6],
+        "HAS_REPORT": row[7]
+    }
+
+
+def _lab_orders_row(row):
+    return {
+        "CHGREQNO": row[0],
+        "CHAPPDTM": row[1],
+        "CHORDNAM": row[2],
+        "CHSPECI": row[3],
+        "CHRCPDTM": row[4]
+    }
+
+
+def history_statement_name(key, start_dt=None, end_dt=None, abnormal_only=False, encounter_id=None):
+    """
+    build_history_queries 每種組合對應的 prepared statement 名稱，
+    例如 hist_nursing_both、hist_labs_abn_start、hist_vitals_enc_none。
+    """
+    variant = {(False, False): "none", (True, False): "start",
+               (False, True): "end", (True, True): "both"}[(start_dt is not None, end_dt is not None)]
+    if key == "labs" and abnormal_only:
+        key = "labs_abn"
+    if encounter_id:
+        key += "_enc"
+    return f"hist_{key}_{variant}"
+
+
+# 資料類別 -> 資料列轉換函式 (psycopg2 tuple 與 asyncpg Record 皆可用索引存取)
+HISTORY_ROW_BUILDERS = {
+    "nursing": _nursing_row,
+    "vitals": _vitals_row,
+    "labs": _labs_row,
+    "orders": _orders_row,
+    "lab_orders": _lab_orders_row,
+}
+
+
+@single_flight(_history_key)
+def get_patient_full_history(patient_id, start_time=None, end_time=None, abnormal_only=False, encounter_id=None):
     """
     根據病歷號及時間範圍，從資料庫撈取病患的所有急診相關數據。
     回傳的字典 Key 統一使用英文欄位名稱，以配合 ai_summarizer 使用。
+    非同步版本見 db.async_patient_service.get_patient_full_history。
 
     Args:
         patient_id (str): 病歷號
-        start_time (str, optional): 篩選起始時間 (YYYYMMDDHHMMSS)
-        end_time (str, optional): 篩選結束時間
+        start_time (str | datetime, optional): 篩選起始時間 (YYYYMMDDHHMMSS 或 datetime)
+        end_time (str | datetime, optional): 篩選結束時間
+        abnormal_only (bool): 檢驗報告只回傳匯入時已標記為異常的項目
+        encounter_id (str, optional): 只查詢該次就診 (急診號，見 list_patient_encounters)
     """
-    conn = get_db_connection()
-    if not conn:
-        print("無法建立連線，無法查詢病患資料。")
+    time_range = parse_history_range(start_time, end_time)
+    if time_range is None:
         return None
 
-    patient_data = {
-        "nursing": [],
-        "vitals": [],
-        "labs": []
-    }
+    start_dt, end_dt, _ = time_range
+    patient_data = {key: [] for key in HISTORY_ROW_BUILDERS}
+
+    # 使用連線池 + prepared statement：同一條連線上的相同查詢只需解析、規劃一次
+    with pooled_connection(readonly=True) as conn:
+        if not conn:
+            print("無法建立連線，無法查詢病患資料。")
+            return None
+
+        try:
+            with conn.cursor() as cur:
+                queries = build_history_queries(
+                    patient_id, *time_range, abnormal_only=abnormal_only, encounter_id=encounter_id
+                )
+                for key, sql, params in queries:
+                    print(f"正在查詢病患 {patient_id} 的{HISTORY_STREAM_LABELS[key]}...")
+                    name = history_statement_name(key, start_dt, end_dt, abnormal_only, encounter_id)
+                    execute_prepared(cur, name, sql, params)
+                    patient_data[key] = [HISTORY_ROW_BUILDERS[key](row) for row in cur.fetchall()]
 
+            print(f"查詢完成 (就診: {encounter_id or '全部'}，時間範圍: "
+                  f"{start_time if start_time else '不限'} ~ {end_time if end_time else '不限'})")
+            return patient_data
+
+        except psycopg2.Error as e:
+            print(f"資料庫查詢失敗: {e}")
+            return None
+
+def get_order_report_texts(greq_nos, patient_id=None):
+    """
+    以單一查詢批次讀取檢查報告全文 (延遲載入用)。
+
+    Args:
+        greq_nos (list): 檢驗申請號 (CHAD4GREQNO，文字形式)，來自 get_patient_full_history 的 orders
+        patient_id (str, optional): 限定病患，避免不同病患的申請號重複時混入
+
+    Returns:
+        dict: {申請號: [{"CHAD4ORDNAME", "CHAD4CDATE", "CHTEXT"}, ...]}
+              同一申請號可能對應多個檢查項目，只回傳有報告內容的列
+    """
+    greq_nos = [g for g in dict.fromkeys(greq_nos) if g is not None]
+    if not greq_nos:
+        return {}
+
+    conn = get_db_connection(readonly=True)
+    if not conn: return {}
+
+    reports = {}
     try:
         with conn.cursor() as cur:
-            # ==========================================
-            # 1. 護理紀錄 (時間欄位: PROCDTTM)
-            # ==========================================
-            print(f"正在查詢病患 {patient_id} 的護理紀錄...")
-            
-            # 基礎 SQL
-            sql_nursing = "SELECT PROCDTTM, SUBJECT, DIAGNOSIS FROM ENSDATA WHERE PATID = %s"
-            params_nursing = [patient_id]
-
-            # 動態加入時間篩選
-            if start_time:
-                sql_nursing += " AND PROCDTTM >= %s"
-                params_nursing.append(start_time)
-            if end_time:
-                sql_nursing += " AND PROCDTTM <= %s"
-                params_nursing.append(end_time)
-            
-            sql_nursing += " ORDER BY PROCDTTM ASC"
-
-            cur.execute(sql_nursing, tuple(params_nursing))
-            rows = cur.fetchall()
-            for row in rows:
-                patient_data["nursing"].append({
-                    "PROCDTTM": row[0],
-                    "SUBJECT": row[1],
-                    "DIAGNOSIS": row[2]
-                })
-
-            # ==========================================
-            # 2. 生理監測 (時間欄位: PROCDTTM)
-            # ==========================================
-            print(f"正在查詢病患 {patient_id} 的生理監測數據...")
-            
-            sql_vitals = """
-                SELECT PROCDTTM, ETEMPUTER, EPLUSE, EBREATHE, EPRESSURE, EDIASTOLIC, ESAO2, 
-                       GCS_E, GCS_V, GCS_M
-                FROM v_ai_hisensnes WHERE PATID = %s
+            sql = """
+                SELECT CHAD4GREQNO::text, CHAD4ORDNAME, CHAD4CDATE, CHTEXT
+                FROM DB_ADM_ORDER_ER
+                WHERE CHAD4GREQNO = ANY(%s::numeric[]) AND octet_length(CHTEXT) > 0
             """
-            params_vitals = [patient_id]
-
-            if start_time:
-                sql_vitals += " AND PROCDTTM >= %s"
-                params_vitals.append(start_time)
-            if end_time:
-                sql_vitals += " AND PROCDTTM <= %s"
-                params_vitals.append(end_time)
-            
-            sql_vitals += " ORDER BY PROCDTTM ASC"
-
-            cur.execute(sql_vitals, tuple(params_vitals))
-            rows = cur.fetchall()
-            for row in rows:
-                patient_data["vitals"].append({
-                    "PROCDTTM": row[0],
-                    "ETEMPUTER": row[1],
-                    "EPLUSE": row[2],
-                    "EBREATHE": row[3],
-                    "EPRESSURE": row[4],
-                    "EDIASTOLIC": row[5],
-                    "ESAO2": row[6],
-                    "GCS": f"E{row[7]}V{row[8]}M{row[9]}"
-                })
+            params = [greq_nos]
+            if patient_id:
+                sql += " AND CHAD1MRNO = %s"
+                params.append(patient_id)
+            sql += " ORDER BY CHAD4CDATE_TS ASC"
 
-            # ==========================================
-            # 3. 檢驗結果 (時間欄位: CHRCPDTM)
-            # ==========================================
-            print(f"正在查詢病患 {patient_id} 的檢驗報告...")
-            
-            sql_labs = """
-                SELECT CHRCPDTM, CHHEAD, CHVAL, CHUNIT, CHNL, CHNH
-                FROM DB_ADM_LABDATA_ER WHERE CHMRNO = %s
-            """
-            params_labs = [patient_id]
-
-            if start_time:
-                sql_labs += " AND CHRCPDTM >= %s"
-                params_labs.append(start_time)
-            if end_time:
-                sql_labs += " AND CHRCPDTM <= %s"
-                params_labs.append(end_time)
-            
-            sql_labs += " ORDER BY CHRCPDTM ASC"
-
-            cur.execute(sql_labs, tuple(params_labs))
-            rows = cur.fetchall()
-            for row in rows:
-                patient_data["labs"].append({
-                    "CHRCPDTM": row[0],
-                    "CHHEAD": row[1],
-                    "CHVAL": row[2],
-                    "CHUNIT": row[3],
-                    "REF_RANGE": f"{row[4]}~{row[5]}"
+            cur.execute(sql, tuple(params))
+            for greq_no, order_name, cdate, text in cur.fetchall():
+                reports.setdefault(greq_no, []).append({
+                    "CHAD4ORDNAME": order_name,
+                    "CHAD4CDATE": cdate,
+                    "CHTEXT": text
                 })
-
-        print(f"查詢完成 (時間範圍: {start_time if start_time else '不限'} ~ {end_time if end_time else '不限'})")
-        return patient_data
+        return reports
 
     except psycopg2.Error as e:
-        print(f"資料庫查詢失敗: {e}")
-        return None
+        print(f"讀取檢查報告失敗: {e}")
+        return {}
     finally:
         conn.close()
 
@@ -157,43 +329,374 @@ def translate_to_chinese_view(data_list):
         view_list.append(new_item)
     return view_list
 
+# 我們從護理紀錄 (ENSDATA) 撈取，因為它通常代表一次完整的就診
+# 統計每個病人的：最早紀錄時間、最晚紀錄時間、紀錄總筆數
+OVERVIEW_SQL = """
+    SELECT PATID,
+           MIN(PROCDTTM) as start_time,
+           MAX(PROCDTTM) as end_time,
+           COUNT(*) as record_count
+    FROM ENSDATA
+    GROUP BY PATID
+    ORDER BY start_time DESC
+    LIMIT 50 -- 限制顯示最近的 50 位病人，避免資料太多跑不動
+"""
+
+
+def overview_row(row):
+    return {
+        "病歷號": row[0],
+        "最早紀錄": row[1],
+        "最晚紀錄": row[2],
+        "資料筆數": row[3]
+    }
+
+
 def get_all_patients_overview():
     """
     掃描資料庫 (以 ENSDATA 為主)，列出所有病患清單及其就診時間範圍。
     用於前端顯示「病患儀表板」。
     """
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn: return []
 
-    overview_list = []
     try:
         with conn.cursor() as cur:
-            # 我們從護理紀錄 (ENSDATA) 撈取，因為它通常代表一次完整的就診
-            # 統計每個病人的：最早紀錄時間、最晚紀錄時間、紀錄總筆數
+            cur.execute(OVERVIEW_SQL)
+            return [overview_row(row) for row in cur.fetchall()]
+
+    except psycopg2.Error as e:
+        print(f"查詢病患清單失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+# 病患的各次就診 (急診號) 與時間範圍：五張表依就診號彙總
+ENCOUNTERS_SQL = """
+    SELECT encounter_id, stream, MIN(ts), MAX(ts), COUNT(*),
+           (array_agg(subject ORDER BY ts) FILTER (WHERE subject IS NOT NULL))[1]
+    FROM (
+        SELECT TRINO AS encounter_id, 'nursing' AS stream, PROCDTTM_TS AS ts, SUBJECT AS subject
+        FROM ENSDATA WHERE PATID = %s
+        UNION ALL
+        SELECT TRINO, 'vitals', PROCDTTM_TS, NULL FROM v_ai_hisensnes WHERE PATID = %s
+        UNION ALL
+        SELECT CHAD1CASENO, 'labs', CHRCPDTM_TS, NULL FROM DB_ADM_LABDATA_ER WHERE CHMRNO = %s
+        UNION ALL
+        SELECT CHAD1CASENO, 'orders', CHAD4CDATE_TS, NULL FROM DB_ADM_ORDER_ER WHERE CHAD1MRNO = %s
+        UNION ALL
+        SELECT CHCASENO, 'lab_orders', CHAPPDTM_TS, NULL FROM DB_ADM_LABORDER_ER WHERE CHMRNO = %s
+    ) t
+    WHERE encounter_id IS NOT NULL
+    GROUP BY encounter_id, stream
+"""
+
+
+def encounters_from_rows(rows):
+    """
+    (就診號, 資料類別, 最早時間, 最晚時間, 筆數, 主訴) -> 每次就診一筆，最近的就診在前。
+
+    Returns:
+        list of dict: encounter_id, start, end (datetime)、counts {資料類別: 筆數}、subject (首筆主訴)
+    """
+    encounters = {}
+    for encounter_id, stream, start, end, count, subject in rows:
+        encounter_id = str(encounter_id).strip()
+        if not encounter_id:
+            continue
+        enc = encounters.setdefault(encounter_id, {
+            "encounter_id": encounter_id, "start": None, "end": None, "counts": {}, "subject": None
+        })
+        enc["counts"][stream] = enc["counts"].get(stream, 0) + count
+        if start and (enc["start"] is None or start < enc["start"]):
+            enc["start"] = start
+        if end and (enc["end"] is None or end > enc["end"]):
+            enc["end"] = end
+        if subject and stream == "nursing":
+            enc["subject"] = subject
+    return sorted(encounters.values(), key=lambda e: e["start"] or datetime.min, reverse=True)
+
+
+def list_patient_encounters(patient_id):
+    """
+    列出病患的每次急診就診 (急診號：ENSDATA / v_ai_hisensnes 的 TRINO，
+    檢驗 / 檢查的 CHAD1CASENO / CHCASENO) 與時間範圍。第一筆即為目前 (最近) 的就診。
+    """
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(ENCOUNTERS_SQL, (patient_id,) * 5)
+            return encounters_from_rows(cur.fetchall())
+
+    except psycopg2.Error as e:
+        print(f"查詢就診紀錄失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+def get_ward_board(active_hours=24, as_of=None):
+    """
+    病房總覽 (Ward Board)：以單一 SQL 一次算出所有「進行中」病患的最新狀態。
+    使用 DISTINCT ON 取每位病患最新一筆生理數值 / GCS，避免逐一呼叫
+    get_patient_full_history。
+
+    Args:
+        active_hours (int): 最後一筆護理紀錄在多少小時內，視為進行中的病患
+        as_of (datetime, optional): 參考時間點，預設為現在
+
+    Returns:
+        list of dict，依異常檢驗數、最後紀錄時間排序
+    """
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    as_of = as_of or datetime.now()
+    cutoff = as_of - timedelta(hours=active_hours)
+
+    board = []
+    try:
+        with conn.cursor() as cur:
             query = """
-                SELECT PATID, 
-                       MIN(PROCDTTM) as start_time, 
-                       MAX(PROCDTTM) as end_time, 
-                       COUNT(*) as record_count
-                FROM ENSDATA
-                GROUP BY PATID
-                ORDER BY start_time DESC
-                LIMIT 50; -- 限制顯示最近的 50 位病人，避免資料太多跑不動
+                WITH candidates AS (
+                    -- 先以時間索引找出時間窗內有紀錄的病患，不掃描整張 ENSDATA
+                    SELECT DISTINCT PATID
+                    FROM ENSDATA
+                    WHERE PROCDTTM_TS >= %(cutoff)s
+                ),
+                active AS (
+                    -- 總筆數與最後紀錄時間只針對候選病患計算 (走 (PATID, PROCDTTM_TS) 索引)
+                    SELECT e.PATID,
+                           MAX(e.PROCDTTM) AS last_note_time,
+                           MAX(e.PROCDTTM_TS) AS last_note_ts,
+                           COUNT(*) AS note_count
+                    FROM ENSDATA e
+                    JOIN candidates c ON c.PATID = e.PATID
+                    GROUP BY e.PATID
+                ),
+                latest_note AS (
+                    SELECT DISTINCT ON (e.PATID) e.PATID, e.SUBJECT
+                    FROM ENSDATA e
+                    JOIN active a ON a.PATID = e.PATID
+                    ORDER BY e.PATID, e.PROCDTTM_TS DESC NULLS LAST
+                ),
+                latest_vitals AS (
+                    SELECT DISTINCT ON (v.PATID)
+                           v.PATID, v.PROCDTTM, v.ETEMPUTER, v.EPLUSE, v.EBREATHE,
+                           v.EPRESSURE, v.EDIASTOLIC, v.ESAO2
+                    FROM v_ai_hisensnes v
+                    JOIN active a ON a.PATID = v.PATID
+                    ORDER BY v.PATID, v.PROCDTTM_TS DESC NULLS LAST
+                ),
+                latest_gcs AS (
+                    SELECT DISTINCT ON (v.PATID)
+                           v.PATID, v.PROCDTTM, v.GCS_E, v.GCS_V, v.GCS_M
+                    FROM v_ai_hisensnes v
+                    JOIN active a ON a.PATID = v.PATID
+                    WHERE TRIM(v.GCS_E) <> ''
+                    ORDER BY v.PATID, v.PROCDTTM_TS DESC NULLS LAST
+                ),
+                abnormal_labs AS (
+                    -- 異常旗標已於匯入時計算，直接利用部分索引計數
+                    SELECT l.CHMRNO AS PATID, COUNT(*) AS abnormal_count
+                    FROM DB_ADM_LABDATA_ER l
+                    JOIN active a ON a.PATID = l.CHMRNO
+                    WHERE l.CHRCPDTM_TS >= %(lab_cutoff)s
+                      AND l.ABN_FLAG IN %(abnormal_flags)s
+                    GROUP BY l.CHMRNO
+                )
+                SELECT a.PATID, a.last_note_time, a.last_note_ts, n.SUBJECT,
+                       lv.PROCDTTM, lv.ETEMPUTER, lv.EPLUSE, lv.EBREATHE,
+                       lv.EPRESSURE, lv.EDIASTOLIC, lv.ESAO2,
+                       lg.PROCDTTM, lg.GCS_E, lg.GCS_V, lg.GCS_M,
+                       COALESCE(al.abnormal_count, 0), a.note_count
+                FROM active a
+                LEFT JOIN latest_note n ON n.PATID = a.PATID
+                LEFT JOIN latest_vitals lv ON lv.PATID = a.PATID
+                LEFT JOIN latest_gcs lg ON lg.PATID = a.PATID
+                LEFT JOIN abnormal_labs al ON al.PATID = a.PATID
+                ORDER BY COALESCE(al.abnormal_count, 0) DESC, a.last_note_ts DESC;
             """
-            cur.execute(query)
+            # 檢驗時間只到「分」，截到分鐘後再比較才不會漏掉同一分鐘的報告
+            cur.execute(query, {
+                "cutoff": cutoff,
+                "lab_cutoff": cutoff.replace(second=0, microsecond=0),
+                "abnormal_flags": ABNORMAL_FLAGS
+            })
             rows = cur.fetchall()
-            
+
             for row in rows:
-                overview_list.append({
+                board.append({
                     "病歷號": row[0],
-                    "最早紀錄": row[1],
-                    "最晚紀錄": row[2],
-                    "資料筆數": row[3]
+                    "最後護理紀錄": row[1],
+                    "距上次紀錄(分)": int((as_of - row[2]).total_seconds() // 60),
+                    "護理紀錄筆數": row[16],
+                    "主訴": row[3],
+                    "生理測量時間": row[4],
+                    "體溫": row[5],
+                    "脈搏": row[6],
+                    "呼吸": row[7],
+                    "血壓": f"{row[8]}/{row[9]}" if (row[8] or "").strip() else None,
+                    "血氧": row[10],
+                    "GCS時間": row[11],
+                    "GCS": f"E{row[12]}V{row[13]}M{row[14]}" if (row[12] or "").strip() else None,
+                    "異常檢驗數": row[15],
                 })
-        return overview_list
+        return board
 
     except psycopg2.Error as e:
-        print(f"查詢病患清單失敗: {e}")
+        print(f"查詢病房總覽失敗: {e}")
+        return []
+    finally:
+        conn.close()
+
+# ==========================================
+# 全文搜尋 (護理紀錄 / 檢查報告)
+# ==========================================
+SEARCH_SNIPPET_CHARS = 40
+
+
+def _like_pattern(term):
+    """ILIKE 用的 pattern，跳脫使用者輸入中的 % _ \\。"""
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _hit_count_sql(text_expr, terms):
+    """
+    各關鍵字在 text_expr 中出現次數總和的 SQL 運算式 (不分大小寫)，供資料庫端排序。
+
+    Returns:
+        (sql, params)
+    """
+    parts, params = [], []
+    for term in terms:
+        parts.append(
+            f"(char_length(lower({text_expr})) - char_length(replace(lower({text_expr}), lower(%s), '')))"
+            f" / char_length(lower(%s))"
+        )
+        params += [term, term]
+    return "(" + " + ".join(parts) + ")", params
+
+
+def _make_snippet(text, terms, width=SEARCH_SNIPPET_CHARS):
+    """擷取第一個命中關鍵字前後各 width 字，並以【】標示關鍵字。"""
+    if not text:
+        return ""
+    lowered = text.lower()
+    positions = [lowered.find(t.lower()) for t in terms if lowered.find(t.lower()) >= 0]
+    pos = min(positions) if positions else 0
+
+    start = max(0, pos - width)
+    end = min(len(text), pos + width * 2)
+    snippet = text[start:end].replace("\n", " ")
+    for t in terms:
+        idx = snippet.lower().find(t.lower())
+        while idx >= 0:
+            snippet = snippet[:idx] + "【" + snippet[idx:idx + len(t)] + "】" + snippet[idx + len(t):]
+            idx = snippet.lower().find(t.lower(), idx + len(t) + 2)
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+def search_clinical_text(query, since=None, patient_id=None, limit=50, include_reports=True):
+    """
+    跨病患搜尋護理紀錄 (SUBJECT / DIAGNOSIS) 與檢查報告 (CHTEXT)。
+    以空白分隔多個關鍵字，需全部命中 (AND)；比對不分大小寫。
+    命中次數在資料庫端計算並排序，較舊但命中較多的紀錄不會被較新的候選擠掉。
+    由 migrations 版本 6 的 pg_trgm GIN 索引支援，3 字以上的關鍵字效果最好
+    (中文需資料庫 LC_CTYPE 不是 C，見版本 6 的說明)。
+
+    Args:
+        query (str): 搜尋字串，例如 "心導管" 或 "GCS：E1"
+        since (str | datetime, optional): 只搜尋此時間之後的紀錄
+        patient_id (str, optional): 限定單一病患
+        limit (int): 最多回傳筆數
+        include_reports (bool): 是否一併搜尋檢查報告
+
+    Returns:
+        list of dict，依命中次數、時間新到舊排序
+    """
+    terms = [t for t in (query or "").split() if t]
+    if not terms:
+        return []
+    since_dt = parse_his_datetime(since)
+
+    conn = get_db_connection(readonly=True)
+    if not conn: return []
+
+    hits = []
+    try:
+        with conn.cursor() as cur:
+            # 1. 護理紀錄：每個關鍵字需出現在 SUBJECT 或 DIAGNOSIS 其中之一
+            score_sql, params_notes = _hit_count_sql("COALESCE(SUBJECT, '') || '｜' || COALESCE(DIAGNOSIS, '')", terms)
+            sql_notes = f"""
+                SELECT PATID, PROCDTTM, PROCDTTM_TS, SUBJECT, DIAGNOSIS, {score_sql} AS score
+                FROM ENSDATA WHERE TRUE
+            """
+            for term in terms:
+                sql_notes += " AND (SUBJECT ILIKE %s OR DIAGNOSIS ILIKE %s)"
+                params_notes += [_like_pattern(term), _like_pattern(term)]
+            if since_dt:
+                sql_notes += " AND PROCDTTM_TS >= %s"
+                params_notes.append(since_dt)
+            if patient_id:
+                sql_notes += " AND PATID = %s"
+                params_notes.append(patient_id)
+            # 兩個來源各取排名前 limit 筆，合併後的前 limit 筆必定在其中
+            sql_notes += " ORDER BY score DESC, PROCDTTM_TS DESC NULLS LAST LIMIT %s"
+            params_notes.append(limit)
+
+            cur.execute(sql_notes, tuple(params_notes))
+            for patid, raw_time, ts, subject, diagnosis, score in cur.fetchall():
+                text = f"{subject or ''}｜{diagnosis or ''}"
+                hits.append({
+                    "來源": "護理紀錄",
+                    "病歷號": patid,
+                    "時間": raw_time,
+                    "_ts": ts,
+                    "命中次數": score,
+                    "片段": _make_snippet(text, terms),
+                })
+
+            # 2. 檢查報告
+            if include_reports:
+                score_sql, params_reports = _hit_count_sql("CHTEXT", terms)
+                sql_reports = f"""
+                    SELECT CHAD1MRNO, CHRCPDTM, CHRCPDTM_TS, CHAD4ORDNAME, CHTEXT, {score_sql} AS score
+                    FROM DB_ADM_ORDER_ER WHERE TRUE
+                """
+                for term in terms:
+                    sql_reports += " AND CHTEXT ILIKE %s"
+                    params_reports.append(_like_pattern(term))
+                if since_dt:
+                    sql_reports += " AND CHRCPDTM_TS >= %s"
+                    params_reports.append(since_dt)
+                if patient_id:
+                    sql_reports += " AND CHAD1MRNO = %s"
+                    params_reports.append(patient_id)
+                sql_reports += " ORDER BY score DESC, CHRCPDTM_TS DESC NULLS LAST LIMIT %s"
+                params_reports.append(limit)
+
+                cur.execute(sql_reports, tuple(params_reports))
+                for mrno, raw_time, ts, order_name, chtext, score in cur.fetchall():
+                    hits.append({
+                        "來源": f"檢查報告 ({order_name})" if order_name else "檢查報告",
+                        "病歷號": mrno,
+                        "時間": raw_time,
+                        "_ts": ts,
+                        "命中次數": score,
+                        "片段": _make_snippet(chtext, terms),
+                    })
+
+        hits.sort(key=lambda h: (h["命中次數"], h["_ts"] or datetime.min), reverse=True)
+        for h in hits:
+            del h["_ts"]
+        return hits[:limit]
+
+    except psycopg2.Error as e:
+        print(f"全文搜尋失敗: {e}")
         return []
     finally:
         conn.close()
@@ -201,6 +704,8 @@ def get_all_patients_overview():
 # ==========================================
 # 測試區塊
 # ==========================================
+# 手動測試：需在專案根目錄以模組方式執行 (python -m db.patient_service)，
+# 直接執行 python db/patient_service.py 時找不到 db / data 套件
 if __name__ == "__main__":
     TEST_ID = '0002452972'
     
@@ -0,0 +1,167 @@
+# /db/prepared_statements.py
+
+# 伺服器端 prepared statement：
+#   熱門查詢 (病患歷史的各資料類別 × 時間篩選組合) 在每條連線上只 PREPARE 一次，
+#   之後以 EXECUTE 名稱 執行，省去每次解析 / 規劃 SQL 的時間。
+#   搭配 db_connector.pooled_connection 使用，連線重複利用時準備好的語句才會被沿用。
+#
+#   - 連線被重設 (DISCARD ALL、經過交易模式的連線池代理) 導致語句不存在時，自動重新準備
+#   - DB_PREPARED_STATEMENTS=0 可停用，改回一般查詢
+#   - get_prepared_statement_stats() 讀取 pg_prepared_statements，確認計畫是否被重複使用
+#
+# 用法 (量測與查看統計)：
+#   python -m db.prepared_statements 0002452972 20
+
+import os
+import re
+import threading
+import weakref
+import collections
+
+import psycopg2
+from psycopg2 import errorcodes
+
+from db.db_connector import idle_pooled_connections
+
+PREPARED_ENABLED = os.getenv("DB_PREPARED_STATEMENTS", "1").lower() in ("1", "true", "yes")
+
+_PLACEHOLDER_RE = re.compile(r"%s")
+
+# 連線 -> 已準備的語句名稱；連線關閉回收後自動移除
+_prepared = weakref.WeakKeyDictionary()
+_stats_lock = threading.Lock()
+_execute_counts = collections.Counter()
+_prepare_counts = collections.Counter()
+
+
+def numbered_placeholders(sql):
+    """把 psycopg2 的 %s 佔位符依序轉成 $1, $2 ... (PREPARE 與 asyncpg 使用)。"""
+    counter = iter(range(1, sql.count("%s") + 1))
+    return _PLACEHOLDER_RE.sub(lambda _: f"${next(counter)}", sql)
+
+
+def _prepare(cur, name, sql):
+    try:
+        cur.execute(f"PREPARE {name} AS {numbered_placeholders(sql)}")
+    except psycopg2.Error as e:
+        # 其他程式碼已在同一個後端準備過 (例如連線池代理共用後端)，直接沿用
+        if e.pgcode != errorcodes.DUPLICATE_PREPARED_STATEMENT:
+            raise
+        cur.connection.rollback()
+    with _stats_lock:
+        _prepare_counts[name] += 1
+
+
+def execute_prepared(cur, name, sql, params):
+    """
+    以 prepared statement 執行查詢；此連線尚未準備過該語句時先 PREPARE。
+    執行後可照常使用 cur.fetchall()。
+
+    Args:
+        cur: psycopg2 cursor
+        name (str): 語句名稱，同一個名稱必須永遠對應同一段 SQL
+        sql (str): 使用 %s 佔位符的 SQL
+        params (list | tuple): 參數
+    """
+    params = tuple(params)
+    if not PREPARED_ENABLED:
+        cur.execute(sql, params)
+        return
+
+    names = _prepared.setdefault(cur.connection, set())
+    if name not in names:
+        _prepare(cur, name, sql)
+        names.add(name)
+
+    execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}"
+    try:
+        cur.execute(execute_sql, params)
+    except psycopg2.Error as e:
+        if e.pgcode != errorcodes.INVALID_SQL_STATEMENT_NAME:
+            raise
+        # 連線被重設過，已準備的語句都不在了：清除記錄後重新準備一次
+        cur.connection.rollback()
+        names.clear()
+        _prepare(cur, name, sql)
+        names.add(name)
+        cur.execute(execute_sql, params)
+
+    with _stats_lock:
+        _execute_counts[name] += 1
+
+
+def get_prepared_statement_stats():
+    """
+    彙總連線池中閒置連線的 pg_prepared_statements。
+    generic_plans / custom_plans 需 PostgreSQL 14 以上，較舊版本為 None。
+    generic_plans 持續增加代表計畫已被重複使用 (不再每次重新規劃)。
+
+    Returns:
+        list of dict (name, connections, generic_plans, custom_plans, executions, prepares)，依名稱排序
+    """
+    totals = {}
+    with idle_pooled_connections(readonly=True) as conns:
+        for conn in conns:
+            try:
+                with conn.cursor() as cur:
+                    try:
+                        cur.execute("SELECT name, generic_plans, custom_plans FROM pg_prepared_statements")
+                    except psycopg2.Error as e:
+                        if e.pgcode != errorcodes.UNDEFINED_COLUMN:
+                            raise
+                        conn.rollback()
+                        cur.execute("SELECT name, NULL, NULL FROM pg_prepared_statements")
+                    rows = cur.fetchall()
+            except psycopg2.Error as e:
+                print(f"讀取 prepared statement 統計失敗: {e}")
+                continue
+
+            for name, generic_plans, custom_plans in rows:
+                entry = totals.setdefault(name, {
+                    "name": name, "connections": 0, "generic_plans": None, "custom_plans": None
+                })
+                entry["connections"] += 1
+                if generic_plans is not None:
+                    entry["generic_plans"] = (entry["generic_plans"] or 0) + generic_plans
+                    entry["custom_plans"] = (entry["custom_plans"] or 0) + custom_plans
+
+    with _stats_lock:
+        for name in set(_execute_counts) | set(totals):
+            entry = totals.setdefault(name, {
+                "name": name, "connections": 0, "generic_plans": None, "custom_plans": None
+            })
+            entry["executions"] = _execute_counts.get(name, 0)
+            entry["prepares"] = _prepare_counts.get(name, 0)
+    return [totals[name] for name in sorted(totals)]
+
+
+def print_prepared_statement_stats():
+    stats = get_prepared_statement_stats()
+    if not stats:
+        print("目前沒有 prepared statement。")
+        return
+    print(f"{'語句':<28}{'連線':>6}{'執行':>8}{'準備':>6}{'generic':>9}{'custom':>8}")
+    for s in stats:
+        generic = "-" if s["generic_plans"] is None else s["generic_plans"]
+        custom = "-" if s["custom_plans"] is None else s["custom_plans"]
+        print(f"{s['name']:<28}{s['connections']:>6}{s['executions']:>8}{s['prepares']:>6}{generic:>9}{custom:>8}")
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from db.patient_service import get_patient_full_history
+
+    patient_id = sys.argv[1] if len(sys.argv) > 1 else "0002452972"
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        # 略過請求合併，確保每次都實際查詢
+        get_patient_full_history.uncoalesced(patient_id)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    print(f"\n{repeat} 次查詢：首次 {timings[0]:.1f} ms，其後平均 "
+          f"{sum(timings[1:]) / max(1, len(timings) - 1):.1f} ms")
+    print_prepared_statement_stats()
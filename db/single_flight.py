@@ -0,0 +1,220 @@
+# /db/single_flight.py
+
+# 請求合併 (Single-flight)：多位使用者同時打開同一位病患時，
+# 相同參數的查詢 / 摘要只實際執行一次，其餘呼叫者等待並共用同一份結果。
+#
+#   - 同一程序內 (Streamlit 的多個 session 執行緒)：以 threading.Event 合併
+#   - 跨程序 (多個 Streamlit worker / 背景程序)：設定 SINGLE_FLIGHT_SHARED=1 後，
+#     以 PostgreSQL advisory lock 決定由誰執行，結果暫存在 single_flight_results
+#     (migrations 版本 9)，等待者取得鎖後直接讀取暫存結果
+#     注意：暫存內容是病患歷史與摘要全文 (含個資)，以明文存放 SINGLE_FLIGHT_TTL 秒；
+#     single_flight_results 的存取權限應與病歷資料表相同
+#
+# 用法：
+#   @single_flight(_history_key)     # _history_key 與被包裝的函式參數相同，回傳合併用的鍵
+#   def get_patient_full_history(...): ...
+
+import os
+import json
+import hashlib
+import threading
+import copy
+import functools
+import collections
+
+import psycopg2
+from db.db_connector import get_db_connection
+
+# advisory lock 使用 (class, key) 兩段式鍵值，不會與 migrations 的單一鍵值鎖衝突
+SINGLE_FLIGHT_LOCK_CLASS = 2024112602
+# 跨程序暫存結果的有效秒數 (只需涵蓋「同時」到達的請求)
+SHARED_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_TTL", "60"))
+
+
+# 各函式的合併統計 (get_single_flight_stats 使用)
+_stats_lock = threading.Lock()
+_stats = collections.defaultdict(collections.Counter)
+
+
+def _count(fn, name):
+    with _stats_lock:
+        _stats[fn.__qualname__][name] += 1
+
+
+def get_single_flight_stats():
+    """
+    本程序各 single-flight 函式的呼叫統計 (壓力測試用)。
+
+    Returns:
+        dict: {函式名稱: {calls, shared (等待同程序其他呼叫的結果), cached (讀取跨程序暫存結果)}}
+    """
+    with _stats_lock:
+        return {name: {field: counter[field] for field in ("calls", "shared", "cached")}
+                for name, counter in _stats.items()}
+
+
+def _shared_enabled():
+    return os.getenv("SINGLE_FLIGHT_SHARED", "0").lower() in ("1", "true", "yes")
+
+
+def make_key(*parts):
+    """將任意參數組合成穩定的 40 碼雜湊鍵。"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同一程序內的請求合併：相同 key 同時只有一個執行中的計算。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        執行 fn(*args, **kwargs)；若相同 key 已在執行中，則等待並回傳其結果。
+
+        Returns:
+            (result, shared): shared 為 True 表示結果來自其他呼叫者的計算
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+# ==========================================
+# 跨程序：advisory lock + 暫存結果
+# ==========================================
+
+def _lock_key(key):
+    return int.from_bytes(bytes.fromhex(key[:8]), "big", signed=True)
+
+
+def _read_shared(cur, key):
+    cur.execute("""
+        SELECT result FROM single_flight_results
+        WHERE key_hash = %s AND created_at >= NOW() - make_interval(secs => %s)
+    """, (key, SHARED_RESULT_TTL))
+    row = cur.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def run_shared(key, fn, *args, cache_if=None, **kwargs):
+    """
+    跨程序合併：同一時間只有取得 advisory lock 的程序會執行 fn，
+    其他程序等鎖釋放後讀取暫存結果。資料庫無法使用時直接執行 fn。
+    結果無法轉為 JSON (例如含 datetime / Decimal) 時只回傳、不暫存，
+    以免等待者讀到型別與原結果不同的資料。
+    """
+    # 等鎖的時間就是等待其他程序完成 fn 的時間，不套用預設的查詢 / 鎖逾時
+    conn = get_db_connection(statement_timeout_ms=0, lock_timeout_ms=0)
+    if not conn:
+        return fn(*args, **kwargs)
+
+    conn.autocommit = True
+    computed, result = False, None
+    try:
+        with conn.cursor() as cur:
+            cached = _read_shared(cur, key)
+            if cached is not None:
+                _count(fn, "cached")
+                return cached
+
+            # 取得鎖的期間若有其他程序完成計算，進來後再檢查一次即可
+            cur.execute("SELECT pg_advisory_lock(%s, %s)", (SINGLE_FLIGHT_LOCK_CLASS, _lock_key(key)))
+            try:
+                cached = _read_shared(cur, key)
+                if cached is not None:
+                    _count(fn, "cached")
+                    return cached
+
+                result, computed = fn(*args, **kwargs), True
+                payload = None
+                if result is not None and (cache_if is None or cache_if(result)):
+                    try:
+                        payload = json.dumps(result, ensure_ascii=False)
+                    except (TypeError, ValueError) as e:
+                        print(f"結果無法轉為 JSON，不暫存: {e}")
+                if payload is not None:
+                    cur.execute("""
+                        INSERT INTO single_flight_results (key_hash, result, created_at)
+                        VALUES (%s, %s, NOW())
+                        ON CONFLICT (key_hash) DO UPDATE
+                            SET result = EXCLUDED.result, created_at = EXCLUDED.created_at
+                    """, (key, payload))
+                    cur.execute(
+                        "DELETE FROM single_flight_results WHERE created_at < NOW() - make_interval(secs => %s)",
+                        (SHARED_RESULT_TTL,)
+                    )
+                return result
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s, %s)", (SINGLE_FLIGHT_LOCK_CLASS, _lock_key(key)))
+
+    except psycopg2.Error as e:
+        # 計算已完成 (只是暫存失敗) 就不要再執行一次
+        if computed:
+            return result
+        print(f"跨程序請求合併失敗，改為直接執行: {e}")
+        return fn(*args, **kwargs)
+    finally:
+        conn.close()
+
+
+# ==========================================
+# 裝飾器
+# ==========================================
+_default_flight = SingleFlight()
+
+
+def single_flight(key_func, cache_if=None):
+    """
+    將函式包成 single-flight 版本。
+
+    Args:
+        key_func: 以相同參數呼叫，回傳可 JSON 化的 tuple，作為合併的鍵
+        cache_if: (選用) 判斷結果是否可分享給其他程序 (例如錯誤訊息不要暫存)
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = make_key(fn.__module__, fn.__qualname__, *key_func(*args, **kwargs))
+            if _shared_enabled():
+                call, call_args = run_shared, (key, fn) + args
+                call_kwargs = dict(kwargs, cache_if=cache_if)
+            else:
+                call, call_args, call_kwargs = fn, args, kwargs
+            _count(fn, "calls")
+            result, shared = _default_flight.do(key, call, *call_args, **call_kwargs)
+            if shared:
+                _count(fn, "shared")
+            # 共用的結果各自複製一份，避免呼叫者互相修改同一個物件
+            return copy.deepcopy(result) if shared else result
+        wrapper.uncoalesced = fn
+        return wrapper
+    return decorator
@@ -1,15 +1,27 @@
 import psycopg2
 from db.db_connector import get_db_connection
 
+# 同步與非同步 (db/async_patient_service.py) 共用的 SQL
+TEMPLATES_SQL = "SELECT template_name, template_content FROM prompt_templates ORDER BY id ASC"
+CREATE_TEMPLATE_SQL = """
+    INSERT INTO prompt_templates (template_name, template_content, description)
+    VALUES (%s, %s, %s)
+"""
+UPDATE_TEMPLATE_SQL = """
+    UPDATE prompt_templates
+    SET template_content = %s, updated_at = NOW()
+    WHERE template_name = %s
+"""
+
 def get_all_templates():
     """取得所有模板的名稱與內容，回傳為字典格式 {name: content}"""
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     if not conn: return {}
 
     templates = {}
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT template_name, template_content FROM prompt_templates ORDER BY id ASC")
+            cur.execute(TEMPLATES_SQL)
             rows = cur.fetchall()
             for row in rows:
                 templates[row[0]] = row[1]
@@ -27,10 +39,7 @@ def create_template(name, content, description=""):
 
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO prompt_templates (template_name, template_content, description)
-                VALUES (%s, %s, %s)
-            """, (name, content, description))
+            cur.execute(CREATE_TEMPLATE_SQL, (name, content, description))
         conn.commit()
         return True
     except Exception as e:
@@ -47,11 +56,7 @@ def update_template(old_name, new_content):
 
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE prompt_templates 
-                SET template_content = %s, updated_at = NOW()
-                WHERE template_name = %s
-            """, (new_content, old_name))
+            cur.execute(UPDATE_TEMPLATE_SQL, (new_content, old_name))
         conn.commit()
         return True
     except Exception as e:
@@ -1,65 +1,20 @@
 # feedback_component.py
 
 import streamlit as st
-import psycopg2
-from db.db_connector import get_db_connection
+from db.feedback_queue import enqueue_feedback
 
 # ==========================================
 # 1. 資料庫操作函數
 # ==========================================
-
-def init_feedback_table():
-    """
-    檢查並建立回饋資料表 (如果不存在的話)。
-    這讓程式碼更強健，不用手動去 DB 建表。
-    """
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    create_table_sql = """
-    CREATE TABLE IF NOT EXISTS ai_feedback_log (
-        id SERIAL PRIMARY KEY,
-        patient_id VARCHAR(50),
-        template_type VARCHAR(50),
-        rating INTEGER,
-        comment TEXT,
-        generated_summary TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(create_table_sql)
-            conn.commit()
-    except Exception as e:
-        print(f"建立回饋資料表失敗: {e}")
-    finally:
-        conn.close()
+# 註：ai_feedback_log 改由 db/migrations.py 在程序啟動時建立一次，
+#     這裡不再於每次顯示表單時檢查資料表。
 
 def save_feedback_to_db(patient_id, template_type, rating, comment, summary_content):
     """
-    將使用者的回饋寫入 PostgreSQL。
-    """
-    conn = get_db_connection()
-    if not conn:
-        st.error("資料庫連線失敗，無法儲存回饋。")
-        return False
-
-    insert_sql = """
-    INSERT INTO ai_feedback_log (patient_id, template_type, rating, comment, generated_summary)
-    VALUES (%s, %s, %s, %s, %s)
+    將使用者的回饋交給背景佇列寫入 PostgreSQL，不阻塞畫面。
+    資料庫暫時無法連線時會先暫存在本地，稍後自動補寫。
     """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(insert_sql, (patient_id, template_type, rating, comment, summary_content))
-            conn.commit()
-        return True
-    except Exception as e:
-        st.error(f"儲存失敗: {e}")
-        return False
-    finally:
-        conn.close()
+    return enqueue_feedback(patient_id, template_type, rating, comment, summary_content)
 
 # ==========================================
 # 2. UI 顯示元件
@@ -70,9 +25,6 @@ def show_feedback_ui(patient_id, template_type):
     顯示回饋表單的 UI 元件。
     此函數會被 app.py 呼叫。
     """
-    
-    # 確保資料表存在 (第一次執行時會建立)
-    init_feedback_table()
 
     st.subheader("📝 協助優化 AI")
     st.info("您的回饋將直接用於改善此系統的準確度。")
@@ -110,14 +62,13 @@ def show_feedback_ui(patient_id, template_type):
             # 嘗試從 session_state 抓取當下的摘要內容，這樣才知道使用者是在評論哪一段文字
             current_summary = st.session_state.get("final_summary", "無摘要紀錄")
 
-            with st.spinner("正在儲存您的寶貴意見..."):
-                success = save_feedback_to_db(
-                    patient_id, 
-                    template_type, 
-                    final_rating, 
-                    comment, 
-                    current_summary
-                )
+            success = save_feedback_to_db(
+                patient_id, 
+                template_type, 
+                final_rating, 
+                comment, 
+                current_summary
+            )
             
             if success:
                 st.success("✅ 回饋已送出！感謝您的協助。")
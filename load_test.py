@@ -0,0 +1,319 @@
+# load_test.py
+
+# 壓力測試：模擬 N 位護理師同時操作摘要流程，量測一個 app.py 部署能承受的同時使用人數。
+#
+# 每位模擬使用者重複執行與 UI 相同的步驟 (呼叫相同的服務函式)：
+#   1. patient_list  讀取病患清單          get_all_patients_overview
+#   2. select        選擇病患並讀取病歷    get_patient_full_history
+#   3. template      讀取模板並選擇        get_all_templates
+#   4. generate      規則摘要 + AI 摘要    generate_extractive_summary / generate_nursing_summary
+#   5. feedback      送出回饋              enqueue_feedback
+# 步驟之間依 --think 秒數 (±50% 隨機) 停頓。Streamlit 以執行緒處理各 session，這裡同樣以執行緒模擬。
+#
+# AI 預設使用 stub (LLM_CASSETTE_MODE=stub，見 ai/llm_cassette.py)，不連線也不消耗額度；
+# 資料庫請使用本機 PostgreSQL (設定方式與 app.py 相同)。
+#
+# 結果包含：流程完成數與吞吐量、各步驟延遲百分位數、錯誤數、請求合併 (single-flight) 命中率，
+# 以及每秒取樣的連線池使用量與 pg_stat_activity 連線數。
+#
+# select / generate 預設與 UI 相同經過請求合併：樣本病患不多時，多數呼叫會直接共用其他使用者的結果
+# (含 SINGLE_FLIGHT_SHARED 的 60 秒暫存)，量到的是合併後的延遲。要量測資料庫 / AI 本身的容量，
+# 請加上 --no-coalesce 直接呼叫未合併的函式 (.uncoalesced)。
+#
+# 用法：
+#   python load_test.py --users 20 --duration 120
+#   python load_test.py --users 50 --duration 300 --think 3 --llm-latency-ms 4000 --ramp-up 30
+#   python load_test.py --users 20 --duration 120 --no-coalesce
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STEPS = ["patient_list", "select", "template", "generate", "feedback"]
+PERCENTILES = (50, 90, 95, 99)
+
+
+# ==========================================
+# 1. 統計
+# ==========================================
+
+class Recorder:
+    """各步驟的延遲 (秒) 與錯誤數，多執行緒共用。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_samples = {}
+        self.workflows = 0
+
+    def record(self, step, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies[step].append(seconds)
+            else:
+                self.errors[step] += 1
+                self.error_samples.setdefault(step, str(error)[:200])
+
+    def workflow_done(self):
+        with self._lock:
+            self.workflows += 1
+
+
+def percentile(sorted_values, pct):
+    """最近排名法 (nearest-rank) 百分位數。"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class DbSampler(threading.Thread):
+    """每隔 interval 秒記錄本程序的連線池狀態與資料庫端的連線數。"""
+
+    def __init__(self, interval=1.0):
+        super().__init__(daemon=True, name="db-sampler")
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        import psycopg2
+        from db.db_connector import get_db_connection, get_pool_stats
+
+        # 取樣用的連線只建立一次，不計入結果
+        conn = get_db_connection(readonly=True)
+        while not self._stop_event.is_set():
+            sample = {"t": time.monotonic(), **get_pool_stats()}
+            if conn:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("""
+                            SELECT COUNT(*),
+                                   COUNT(*) FILTER (WHERE state = 'active'),
+                                   COUNT(*) FILTER (WHERE state IN ('idle in transaction', 'idle in transaction (aborted)'))
+                            FROM pg_stat_activity
+                            WHERE datname = current_database() AND pid <> pg_backend_pid()
+                        """)
+                        sample["db_total"], sample["db_active"], sample["db_idle_in_tx"] = cur.fetchone()
+                    conn.rollback()
+                except psycopg2.Error as e:
+                    print(f"⚠️ 讀取 pg_stat_activity 失敗: {e}")
+                    conn.close()
+                    conn = None
+            self.samples.append(sample)
+            self._stop_event.wait(self.interval)
+        if conn:
+            conn.close()
+
+
+# ==========================================
+# 2. 模擬使用者
+# ==========================================
+
+def _think(mean_seconds, stop_event):
+    if mean_seconds > 0:
+        stop_event.wait(mean_seconds * random.uniform(0.5, 1.5))
+
+
+def _timed(recorder, step, fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        recorder.record(step, time.perf_counter() - started, error=e)
+        return None, False
+    recorder.record(step, time.perf_counter() - started)
+    return result, True
+
+
+def simulated_user(user_no, args, recorder, stop_event, deadline):
+    from db.patient_service import get_all_patients_overview, get_patient_full_history
+    from db.template_service import get_all_templates
+    from db.feedback_queue import enqueue_feedback
+    from ai.ai_summarizer import generate_nursing_summary, is_failed_summary
+    from ai.extractive_summarizer import generate_extractive_summary
+
+    if args.no_coalesce:
+        get_patient_full_history = get_patient_full_history.uncoalesced
+        generate_nursing_summary = generate_nursing_summary.uncoalesced
+
+    rng = random.Random(args.seed + user_no if args.seed is not None else None)
+    iterations = 0
+    while not stop_event.is_set() and time.monotonic() < deadline:
+        if args.iterations and iterations >= args.iterations:
+            break
+        iterations += 1
+
+        patients, ok = _timed(recorder, "patient_list", get_all_patients_overview)
+        if not ok or not patients:
+            if ok:
+                recorder.record("patient_list", 0, error="病患清單為空")
+            _think(args.think, stop_event)
+            continue
+        _think(args.think, stop_event)
+
+        patient_ids = args.patients or [p["病歷號"] for p in patients]
+        patient_id = rng.choice(patient_ids)
+        patient_data, ok = _timed(recorder, "select", get_patient_full_history, patient_id)
+        if not ok or not patient_data:
+            if ok:
+                recorder.record("select", 0, error=f"讀不到病患 {patient_id}")
+            continue
+        _think(args.think, stop_event)
+
+        templates, ok = _timed(recorder, "template", get_all_templates)
+        if not ok:
+            continue
+        template_name = args.template or (rng.choice(sorted(templates)) if templates else "default")
+        _think(args.think, stop_event)
+
+        def _generate():
+            generate_extractive_summary(patient_id, patient_data, template_name)
+            summary = generate_nursing_summary(patient_id, patient_data, template_name)
+            if is_failed_summary(summary):
+                raise RuntimeError(summary)
+            return summary
+
+        summary, ok = _timed(recorder, "generate", _generate)
+        if not ok:
+            continue
+        _think(args.think, stop_event)
+
+        _timed(recorder, "feedback", enqueue_feedback,
+               patient_id, template_name, rng.randint(3, 5), "load test", summary)
+        recorder.workflow_done()
+        _think(args.think, stop_event)
+
+
+# ==========================================
+# 3. 報告
+# ==========================================
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.0f}"
+
+
+def print_report(recorder, sampler, elapsed, args):
+    print("\n" + "=" * 72)
+    print(f"使用者 {args.users} 位 | 執行 {elapsed:.1f} 秒 | 思考時間 {args.think} 秒 | "
+          f"AI: {os.getenv('LLM_CASSETTE_MODE') or 'real'} | 請求合併: {'停用' if args.no_coalesce else '啟用'}")
+    print(f"完成流程 {recorder.workflows} 次，吞吐量 {recorder.workflows / elapsed:.2f} 流程/秒 "
+          f"({recorder.workflows * 60 / elapsed:.1f} 流程/分鐘)")
+    print("-" * 72)
+    header = "".join(f"{'p' + str(p):>8}" for p in PERCENTILES)
+    print(f"{'步驟':<14}{'次數':>7}{'錯誤':>6}{'每秒':>8}{header}{'max':>8}  (ms)")
+    for step in STEPS:
+        values = sorted(recorder.latencies.get(step, []))
+        pcts = "".join(f"{_ms(percentile(values, p)):>8}" for p in PERCENTILES)
+        print(f"{step:<14}{len(values):>7}{recorder.errors.get(step, 0):>6}"
+              f"{len(values) / elapsed:>8.2f}{pcts}{_ms(values[-1] if values else None):>8}")
+    for step, message in recorder.error_samples.items():
+        print(f"  ⚠️ {step} 錯誤範例：{message}")
+
+    print("-" * 72)
+    if args.no_coalesce:
+        print("請求合併：已停用 (--no-coalesce)，select / generate 每次都實際查詢資料庫 / 呼叫 AI")
+    else:
+        from db.single_flight import get_single_flight_stats
+
+        for name, stats in sorted(get_single_flight_stats().items()):
+            hits = stats["shared"] + stats["cached"]
+            rate = hits / stats["calls"] if stats["calls"] else 0
+            print(f"請求合併 {name}：呼叫 {stats['calls']} 次，共用結果 {hits} 次 ({rate:.0%}；"
+                  f"同程序 {stats['shared']}、跨程序暫存 {stats['cached']})，實際執行 {stats['calls'] - hits} 次")
+        print("  (命中率高時延遲主要反映共用結果；量測實際容量請加 --no-coalesce)")
+
+    samples = sampler.samples if sampler else []
+    if samples:
+        print("-" * 72)
+        last = samples[-1]
+        in_use = [s["pool_in_use"] for s in samples]
+        print(f"連線池：同時借出 平均 {sum(in_use) / len(in_use):.1f} / 最多 {last['pool_peak_in_use']}，"
+              f"閒置 讀 {last['pool_idle_read']} 寫 {last['pool_idle_write']}，"
+              f"重複使用 {last['pool_reused']} 次")
+        print(f"本程序建立連線 {last['opened']} 條 ({last['opened'] / elapsed:.1f} 條/秒)，失敗 {last['failed']} 條")
+        db_samples = [s for s in samples if "db_total" in s]
+        if db_samples:
+            totals = [s["db_total"] for s in db_samples]
+            actives = [s["db_active"] for s in db_samples]
+            print(f"資料庫連線 (pg_stat_activity)：平均 {sum(totals) / len(totals):.1f} / 最多 {max(totals)}，"
+                  f"執行中 最多 {max(actives)}，idle in transaction 最多 "
+                  f"{max(s['db_idle_in_tx'] for s in db_samples)}")
+    print("=" * 72)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="摘要流程壓力測試")
+    parser.add_argument("--users", type=int, default=10, help="同時使用者數")
+    parser.add_argument("--duration", type=float, default=60, help="測試秒數")
+    parser.add_argument("--iterations", type=int, default=0, help="每位使用者最多執行幾次流程 (0 為不限)")
+    parser.add_argument("--think", type=float, default=2.0, help="步驟間的平均思考秒數")
+    parser.add_argument("--ramp-up", type=float, default=0, help="在幾秒內逐步啟動所有使用者")
+    parser.add_argument("--patients", nargs="*", help="只使用這些病歷號 (預設從病患清單隨機挑選)")
+    parser.add_argument("--template", help="固定使用的模板名稱 (預設隨機)")
+    parser.add_argument("--llm", choices=["stub", "replay", "real"], default="stub",
+                        help="AI 呼叫方式；real 會實際呼叫供應商")
+    parser.add_argument("--llm-latency-ms", type=float, help="stub 模擬的 AI 回應時間 (預設 LLM_STUB_LATENCY_MS)")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="連線數取樣間隔秒數")
+    parser.add_argument("--seed", type=int, help="亂數種子 (重現同一組病患順序)")
+    parser.add_argument("--no-coalesce", action="store_true",
+                        help="select / generate 不經過請求合併，每次都實際查詢 / 呼叫 AI")
+    args = parser.parse_args(argv)
+
+    # 需在載入 ai 模組前設定
+    if args.llm == "real":
+        os.environ.pop("LLM_CASSETTE_MODE", None)
+    else:
+        os.environ["LLM_CASSETTE_MODE"] = args.llm
+    if args.llm_latency_ms is not None:
+        os.environ["LLM_STUB_LATENCY_MS"] = str(args.llm_latency_ms)
+
+    from db.feedback_queue import flush_feedback
+
+    recorder = Recorder()
+    sampler = DbSampler(args.sample_interval)
+    sampler.start()
+
+    stop_event = threading.Event()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = []
+    try:
+        for user_no in range(args.users):
+            thread = threading.Thread(target=simulated_user, name=f"user-{user_no}",
+                                      args=(user_no, args, recorder, stop_event, deadline), daemon=True)
+            thread.start()
+            threads.append(thread)
+            if args.ramp_up and user_no < args.users - 1:
+                time.sleep(args.ramp_up / args.users)
+        print(f"已啟動 {args.users} 位模擬使用者，執行 {args.duration:.0f} 秒 (Ctrl+C 提前結束)...")
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        print("\n中止，等待進行中的步驟結束...")
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    elapsed = time.monotonic() - started
+    sampler.stop()
+    _timed(recorder, "feedback_flush", flush_feedback)
+    print_report(recorder, sampler, elapsed, args)
+    return 0 if not recorder.errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
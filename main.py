@@ -3,8 +3,18 @@
 import sys
 import os
 from dotenv import load_dotenv
-from db.patient_service import get_patient_full_history
-from ai.ai_summarizer import generate_nursing_summary
+from ai.ai_summarizer import generate_nursing_summary, is_failed_summary
+from ai.extractive_summarizer import generate_extractive_summary
+from ai.llm_cassette import is_offline_mode
+
+load_dotenv()
+
+# === 資料來源 ===
+# HISTORY_SOURCE=csv 時直接讀取 data/ 下的 HIS 匯出 CSV (透過 .idx 索引)，不需要資料庫
+if os.getenv("HISTORY_SOURCE", "db").lower() == "csv":
+    from data.csv_index import get_patient_full_history, get_order_report_texts, list_patient_encounters
+else:
+    from db.patient_service import get_patient_full_history, get_order_report_texts, list_patient_encounters
 
 # 設定病歷號
 TEST_PATIENT_ID = '0002452972' 
@@ -14,20 +24,29 @@ TEST_PATIENT_ID = '0002452972'
 # 如果設為 None，代表不限制
 FILTER_START_TIME = None
 FILTER_END_TIME   = '20251115153000'
+# 只讀取最近一次就診 (False 則包含該病患所有就診)
+CURRENT_VISIT_ONLY = True
 
 def main():
     print(f"=== 啟動 AI 護理摘要系統 ===")
     print(f"目標: {TEST_PATIENT_ID}")
     print(f"區間: {FILTER_START_TIME} ~ {FILTER_END_TIME}")
+    print(f"來源: {os.getenv('HISTORY_SOURCE', 'db')}")
 
-    load_dotenv()
+    encounter_id = None
+    if CURRENT_VISIT_ONLY:
+        encounters = list_patient_encounters(TEST_PATIENT_ID)
+        if encounters:
+            encounter_id = encounters[0]["encounter_id"]
+            print(f"就診: 急診號 {encounter_id} (共 {len(encounters)} 次就診，只讀取最近一次)")
     
     # 1. 撈取資料 (帶入時間參數)
     print("\n1. 正在撈取指定時間內的資料...")
     patient_data = get_patient_full_history(
         TEST_PATIENT_ID, 
         start_time=FILTER_START_TIME, 
-        end_time=FILTER_END_TIME
+        end_time=FILTER_END_TIME,
+        encounter_id=encounter_id
     )
 
     if not patient_data:
@@ -50,18 +69,31 @@ def main():
         print("此時段無資料，結束程式。")
         return
 
-    # 2. 呼叫 AI
-    if os.getenv("GROQ_API_KEY"):
+    # 2. 呼叫 AI (未設定 Key 或呼叫失敗時，改用規則式摘要)
+    template_name = "emergency_summary"
+    summary = None
+    # LLM_CASSETTE_MODE=replay / stub 時不連線，不需要 Key
+    if os.getenv("GROQ_API_KEY") or is_offline_mode():
         print("\n2. 正在呼叫 Groq AI 生成摘要...")
-        summary = generate_nursing_summary(TEST_PATIENT_ID, patient_data,template_name="emergency_summary")
-        
-        print("\n" + "="*40)
-        print("       急診病程摘要 (AI Generated)")
-        print("="*40)
-        print(summary)
-        print("="*40)
+        summary = generate_nursing_summary(TEST_PATIENT_ID, patient_data,template_name=template_name,
+                                           report_loader=get_order_report_texts)
+        if is_failed_summary(summary):
+            print(f"\n{summary}")
+            summary = None
     else:
         print("\n未偵測到 GROQ_API_KEY。")
 
+    title = "急診病程摘要 (AI Generated)"
+    if summary is None:
+        print("改用規則式摘要...")
+        summary = generate_extractive_summary(TEST_PATIENT_ID, patient_data, template_name=template_name)
+        title = "急診病程摘要 (規則擷取)"
+
+    print("\n" + "="*40)
+    print(f"       {title}")
+    print("="*40)
+    print(summary)
+    print("="*40)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
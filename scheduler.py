@@ -0,0 +1,162 @@
+# scheduler.py
+
+# 交班前預先產生摘要：
+#   每個交班時間 (預設 07:00 / 15:00 / 23:00) 前 N 分鐘，列出病房總覽中仍在急診的病患，
+#   以「交班」模板建立背景摘要工作 (summary_jobs)，並把執行時間平均分散在整個時段，
+#   避免交班當下大家同時按下生成、撞上 Groq 的速率限制。
+#   實際產生摘要的是 worker.py，這裡只負責排程。
+#
+# 用法：
+#   python scheduler.py            # 常駐，每個交班前自動排程
+#   python scheduler.py --once     # 只為下一個交班排程一次 (可搭配 cron)
+
+import os
+import time
+import argparse
+from datetime import datetime, timedelta, time as dtime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 交班時間，可用環境變數覆寫，例如 SHIFT_TIMES=08:00,16:00,00:00
+SHIFT_TIMES = os.getenv("SHIFT_TIMES", "07:00,15:00,23:00")
+# 交班前多少分鐘開始預產生
+PREGEN_LEAD_MINUTES = int(os.getenv("PREGEN_LEAD_MINUTES", "45"))
+# 最後一筆工作至少在交班前幾分鐘送出
+PREGEN_FINISH_MARGIN_MINUTES = int(os.getenv("PREGEN_FINISH_MARGIN_MINUTES", "5"))
+# 供應商每分鐘可接受的請求數 (預留給使用者手動生成的額度後)
+PREGEN_REQUESTS_PER_MINUTE = float(os.getenv("PREGEN_REQUESTS_PER_MINUTE", "10"))
+# 查不到就診號時，摘要涵蓋的時間範圍 (交班前 N 小時)；有就診號時摘要整次就診
+HANDOFF_LOOKBACK_HOURS = int(os.getenv("HANDOFF_LOOKBACK_HOURS", "24"))
+# 視為「仍在急診」的病患：最後護理紀錄在幾小時內
+ACTIVE_PATIENT_HOURS = int(os.getenv("ACTIVE_PATIENT_HOURS", "12"))
+
+HANDOFF_TEMPLATE_KEYWORD = "交班"
+JOB_PRIORITY_SCHEDULE = 0
+
+
+def shift_boundaries():
+    result = []
+    for text in SHIFT_TIMES.split(","):
+        hour, minute = text.strip().split(":")
+        result.append(dtime(int(hour), int(minute)))
+    return sorted(result)
+
+
+def next_shift_boundary(now=None):
+    """下一個交班時間 (datetime)。"""
+    now = now or datetime.now()
+    for day_offset in (0, 1):
+        day = (now + timedelta(days=day_offset)).date()
+        for boundary in shift_boundaries():
+            candidate = datetime.combine(day, boundary)
+            if candidate > now:
+                return candidate
+    return None
+
+
+def find_handoff_template():
+    """找出名稱含「交班」的模板，可用 HANDOFF_TEMPLATE_NAME 指定。"""
+    name = os.getenv("HANDOFF_TEMPLATE_NAME")
+    if name:
+        return name
+    from db.template_service import get_all_templates
+    return next((t for t in (get_all_templates() or {}) if HANDOFF_TEMPLATE_KEYWORD in t), None)
+
+
+def plan_run_times(count, boundary, now=None):
+    """
+    把 count 筆工作的執行時間平均分散在「交班前 PREGEN_LEAD_MINUTES 分鐘」到
+    「交班前 PREGEN_FINISH_MARGIN_MINUTES 分鐘」之間，且間隔不小於速率限制。
+    """
+    now = now or datetime.now()
+    window_start = max(now, boundary - timedelta(minutes=PREGEN_LEAD_MINUTES))
+    window_end = boundary - timedelta(minutes=PREGEN_FINISH_MARGIN_MINUTES)
+    if count == 0:
+        return []
+
+    window_seconds = max(0.0, (window_end - window_start).total_seconds())
+    min_spacing = 60.0 / PREGEN_REQUESTS_PER_MINUTE
+    spacing = max(min_spacing, window_seconds / count)
+    return [window_start + timedelta(seconds=i * spacing) for i in range(count)]
+
+
+def schedule_handoff_summaries(boundary, now=None):
+    """
+    為指定交班時間建立預產生工作；已排過的病患不重複建立。
+
+    Returns:
+        int: 新建立的工作數
+    """
+    from db.patient_service import get_ward_board, list_patient_encounters
+    from db.job_queue import enqueue_summary_job, get_scheduled_patient_ids
+    from db.template_service import get_all_templates
+    from ai.prompt_builder import apply_style, default_focus_areas, DEFAULT_STYLE_OPTION
+
+    template_name = find_handoff_template()
+    if not template_name:
+        print("找不到交班模板，略過預產生 (可設定 HANDOFF_TEMPLATE_NAME)。")
+        return 0
+
+    # 與 UI 預設設定 (預設風格 + 預設關注項目) 相同，護理師開啟頁面時才會對應到這份預產生摘要
+    template_text = (get_all_templates() or {}).get(template_name)
+    system_prompt = apply_style(template_text, DEFAULT_STYLE_OPTION) if template_text else None
+    focus_areas = default_focus_areas(template_name)
+
+    # 病房總覽已依異常檢驗數排序，較危急的病患會先產生
+    board = get_ward_board(active_hours=ACTIVE_PATIENT_HOURS, as_of=now)
+    window_start = boundary - timedelta(minutes=PREGEN_LEAD_MINUTES)
+    already = get_scheduled_patient_ids(template_name, window_start)
+    patients = [p["病歷號"] for p in board if p["病歷號"] not in already]
+
+    run_times = plan_run_times(len(patients), boundary, now)
+    if run_times and run_times[-1] > boundary:
+        print(f"⚠️ 病患數 {len(patients)} 超過速率限制可在交班前完成的數量，部分摘要會在交班後產生。")
+
+    created = 0
+    for patient_id, run_after in zip(patients, run_times):
+        # 與 UI 預設相同，只摘要目前這次就診；查不到就診號時退回交班前 N 小時
+        encounters = list_patient_encounters(patient_id)
+        encounter_id = encounters[0]["encounter_id"] if encounters else None
+        job_id = enqueue_summary_job(
+            patient_id, template_name,
+            start_time=None if encounter_id else boundary - timedelta(hours=HANDOFF_LOOKBACK_HOURS),
+            encounter_id=encounter_id,
+            custom_system_prompt=system_prompt, focus_areas=focus_areas,
+            priority=JOB_PRIORITY_SCHEDULE, run_after=run_after, source="schedule"
+        )
+        if job_id:
+            created += 1
+    print(f"[{datetime.now():%H:%M:%S}] 交班 {boundary:%m-%d %H:%M}：已排程 {created} 位病患 "
+          f"(略過已排程 {len(already)} 位)，模板「{template_name}」")
+    return created
+
+
+def run_forever():
+    print(f"交班預產生排程已啟動 (交班時間 {SHIFT_TIMES}，提前 {PREGEN_LEAD_MINUTES} 分鐘)")
+    while True:
+        boundary = next_shift_boundary()
+        trigger_at = boundary - timedelta(minutes=PREGEN_LEAD_MINUTES)
+        wait_seconds = (trigger_at - datetime.now()).total_seconds()
+        if wait_seconds > 0:
+            print(f"下一次排程：{trigger_at:%m-%d %H:%M} (交班 {boundary:%H:%M})")
+            time.sleep(wait_seconds)
+        schedule_handoff_summaries(boundary)
+        # 等過了這個交班時間再計算下一個
+        time.sleep(max(1.0, (boundary - datetime.now()).total_seconds() + 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="交班前預先產生摘要")
+    parser.add_argument("--once", action="store_true", help="只為下一個交班排程一次")
+    args = parser.parse_args(argv)
+
+    if args.once:
+        schedule_handoff_summaries(next_shift_boundary())
+    else:
+        run_forever()
+
+
+if __name__ == "__main__":
+    main()
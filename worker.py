@@ -0,0 +1,138 @@
+# worker.py
+
+# 背景摘要 worker：從 summary_jobs 取件，執行 generate_nursing_summary 並寫入 summary_results。
+# 與 Streamlit 分開部署，worker 數量可獨立調整。
+#
+# 用法：
+#   python worker.py                # 預設 2 個 worker 程序
+#   python worker.py --workers 4
+
+import os
+import signal
+import socket
+import argparse
+import multiprocessing
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 沒有工作時等待 NOTIFY 的最長秒數 (逾時後仍會再檢查一次，涵蓋延後執行的工作)
+IDLE_WAIT_SECONDS = 10
+# 每隔多久回收一次卡住的工作
+STALE_CHECK_SECONDS = 300
+
+
+def _data_until(patient_data):
+    """摘要涵蓋到的最後一筆資料時間，供之後判斷是否有新資料。"""
+    from data.time_utils import parse_his_datetime
+
+    times = [parse_his_datetime(item.get("PROCDTTM")) for item in patient_data.get("nursing", [])]
+    times += [parse_his_datetime(item.get("PROCDTTM")) for item in patient_data.get("vitals", [])]
+    times += [parse_his_datetime(item.get("CHRCPDTM")) for item in patient_data.get("labs", [])]
+    times = [t for t in times if t]
+    return max(times) if times else None
+
+
+def run_job(job):
+    """
+    執行單一工作。
+
+    Returns:
+        (summary, data_until)；失敗時拋出 RuntimeError
+    """
+    from db.patient_service import get_patient_full_history
+    from ai.ai_summarizer import generate_nursing_summary, is_failed_summary
+
+    patient_data = get_patient_full_history(
+        job["patient_id"], start_time=job["start_time"], end_time=job["end_time"],
+        abnormal_only=job["abnormal_only"], encounter_id=job["encounter_id"]
+    )
+    if not patient_data:
+        raise RuntimeError("無法讀取病患資料")
+
+    summary = generate_nursing_summary(
+        job["patient_id"], patient_data, job["template_name"],
+        custom_system_prompt=job["custom_system_prompt"],
+        focus_areas=job["focus_areas"]
+    )
+    if is_failed_summary(summary):
+        raise RuntimeError(summary)
+    return summary, _data_until(patient_data)
+
+
+def worker_loop(worker_name, stop_event):
+    import time
+    from db.db_connector import get_db_connection
+    from db.job_queue import (
+        claim_next_job, complete_job, fail_job, requeue_stale_jobs,
+        listen, wait_for_notify, CHANNEL_NEW_JOB
+    )
+
+    # 子程序不處理 Ctrl+C，由主程序統一通知結束
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    work_conn = get_db_connection()
+    listen_conn = get_db_connection()
+    if not work_conn or not listen_conn:
+        print(f"[{worker_name}] 無法建立資料庫連線，結束。")
+        return
+
+    listen(listen_conn, CHANNEL_NEW_JOB)
+    print(f"[{worker_name}] 已啟動，等待工作...")
+    last_stale_check = 0
+
+    try:
+        while not stop_event.is_set():
+            if time.monotonic() - last_stale_check > STALE_CHECK_SECONDS:
+                requeued, failed = requeue_stale_jobs(work_conn)
+                if requeued or failed:
+                    print(f"[{worker_name}] 逾時工作：重新排入 {requeued} 筆，超過重試上限標記失敗 {failed} 筆")
+                last_stale_check = time.monotonic()
+
+            job = claim_next_job(work_conn, worker_name)
+            if not job:
+                wait_for_notify(listen_conn, IDLE_WAIT_SECONDS)
+                continue
+
+            print(f"[{worker_name}] 工作 #{job['id']}: {job['patient_id']} / {job['template_name']}")
+            try:
+                summary, data_until = run_job(job)
+                complete_job(work_conn, job, summary, data_until)
+                print(f"[{worker_name}] 工作 #{job['id']} 完成")
+            except Exception as e:
+                work_conn.rollback()
+                fail_job(work_conn, job, str(e))
+                print(f"[{worker_name}] 工作 #{job['id']} 失敗 (第 {job['attempts']} 次): {e}")
+    finally:
+        work_conn.close()
+        listen_conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="背景摘要 worker")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SUMMARY_WORKERS", "2")))
+    args = parser.parse_args(argv)
+
+    stop_event = multiprocessing.Event()
+    host = socket.gethostname()
+    processes = [
+        multiprocessing.Process(target=worker_loop, args=(f"{host}-{os.getpid()}-{i}", stop_event))
+        for i in range(args.workers)
+    ]
+    for p in processes:
+        p.start()
+
+    def _shutdown(signum, frame):
+        print("收到結束訊號，等待執行中的工作完成...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()